@@ -0,0 +1,187 @@
+"""Benchmarks the ticket sorter on synthetic schools of different sizes
+
+Usage (from the root of the repository):
+    python dev/benchmark.py                                 # 1k, 5k, 20k and 100k tickets
+    python dev/benchmark.py --sizes 1000 5000 -o new.json   # save the results as JSON
+    python dev/benchmark.py --compare old.json              # compare against a previous run
+"""
+import os
+import sys
+import json
+import math
+import random
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ticketing"))
+
+from ticket_sorter import TicketSorter, TicketList, TicketToSort, CLASSROOM_GEOGRAPHIC_ORDER  # noqa: E402
+
+DEFAULT_SIZES = (1000, 5000, 20000, 100000)
+
+# Roughly the mix of items from 2023
+ITEM_MIX = {"Rose": 0.44, "Chocolate": 0.31, "Serenade": 0.21, "Special Serenade": 0.04}
+TICKETS_PER_RECIPIENT = 2.3     # recipients receive 2.3 tickets on average (but some receive far more)
+STUDENTS_PER_CLASS = 25
+BAD_ROOMS = ("OVALA", "OVALB", "OVALC", "OVALD", "POOL")
+BAD_ROOM_CHANCE = 0.02          # chance that a class is in a bad room
+SPECIAL_ROOMS = ("LIBA", "LIBB", "LIBC", "LIBD")
+SPECIAL_ROOM_CHANCE = 0.02      # chance that a class is in the library
+
+
+def generate_rooms(num_rooms: int, rng: random.Random) -> list[str]:
+    """Rooms are spread evenly across the blocks in CLASSROOM_GEOGRAPHIC_ORDER, e.g. C317 or I1.23"""
+    rooms = []
+    rooms_per_block = math.ceil(num_rooms / len(CLASSROOM_GEOGRAPHIC_ORDER))
+    for block in CLASSROOM_GEOGRAPHIC_ORDER:
+        separator = "." if rng.random() < 0.5 else ""
+        for index in range(rooms_per_block):
+            floor = "G123"[index % 4]
+            rooms.append(f"{block}{floor}{separator}{index // 4 + 1:02}")
+    return rooms[:num_rooms]
+
+
+def generate_students(num_students: int, rng: random.Random) -> dict[str, dict[str, str]]:
+    """
+    Each period, the students are split into classes of about STUDENTS_PER_CLASS which share a room
+    (like a real timetable), so that tickets have classmates to be delivered with.
+    """
+    students = {f"Student {index} [{7 + index % 6}{chr(65 + index % 26)}]": {}
+                for index in range(num_students)}
+    rooms = generate_rooms(max(1, num_students // STUDENTS_PER_CLASS), rng)
+
+    for period in range(1, 5):
+        student_ids = list(students)
+        rng.shuffle(student_ids)
+        for start in range(0, len(student_ids), STUDENTS_PER_CLASS):
+            random_number = rng.random()
+            if random_number < BAD_ROOM_CHANCE:
+                room = rng.choice(BAD_ROOMS)
+            elif random_number < BAD_ROOM_CHANCE + SPECIAL_ROOM_CHANCE:
+                room = rng.choice(SPECIAL_ROOMS)
+            else:
+                room = rooms[(start // STUDENTS_PER_CLASS) % len(rooms)]
+            for student_id in student_ids[start:start + STUDENTS_PER_CLASS]:
+                students[student_id][f"P{period}"] = room
+
+    return students
+
+
+def generate_tickets(num_tickets: int, rng: random.Random) -> TicketList:
+    """Generates a school just big enough for the tickets, where some recipients are very popular"""
+    students = generate_students(max(1, round(num_tickets / TICKETS_PER_RECIPIENT)), rng)
+    student_ids = list(students)
+    popularity = [rng.paretovariate(1.5) for _ in student_ids]
+
+    recipients = rng.choices(student_ids, weights=popularity, k=num_tickets)
+    item_types = rng.choices(list(ITEM_MIX), weights=list(ITEM_MIX.values()), k=num_tickets)
+
+    tickets = TicketList()
+    for pk, (recipient_id, item_type) in enumerate(zip(recipients, item_types), start=1):
+        student = students[recipient_id]
+        ss_period = rng.randint(1, 4) if item_type == "Special Serenade" else None
+        tickets.append(TicketToSort(
+            pk, recipient_id, item_type,
+            student["P1"], student["P2"], student["P3"], student["P4"],
+            ss_period
+        ))
+    return tickets
+
+
+def run_benchmark(num_tickets: int, seed: int, serenading_groups: int,
+                  non_serenading_groups: int, use_arrays: bool = False) -> dict:
+    rng = random.Random(seed)
+    tickets = generate_tickets(num_tickets, rng)
+
+    random.seed(seed)
+    ticket_sorter = TicketSorter(
+        tickets, serenading_groups, non_serenading_groups,
+        max_serenades_per_class=2,
+        max_non_serenades_per_serenading_class=3,
+        extra_special_serenades=True,
+        enforce_distribution=True,
+        use_arrays=use_arrays,
+        measure_memory=True
+    )
+    report = ticket_sorter.report
+    profile = ticket_sorter.profile
+
+    return {
+        "num_tickets": num_tickets,
+        "num_recipients": len({ticket.recipient_id for ticket in tickets}),
+        "seconds": profile.total_seconds,
+        "peak_memory": max(phase["peak_memory"] for phase in profile.phases),
+        "classroom_visits": report.total_visits,
+        "group_imbalance": report.group_imbalance,
+        "undelivered_tickets": len(report.undelivered_tickets),
+        "phases": profile.phases,
+    }
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old: dict, new: dict):
+    old_results = {result["num_tickets"]: result for result in old["results"]}
+    print(f"\nComparing {old.get('commit')} (old) to {new.get('commit')} (new):")
+    print("Tickets\tSeconds\tPeak Memory\tVisits\tImbalance")
+    for result in new["results"]:
+        old_result = old_results.get(result["num_tickets"])
+        if old_result is None:
+            continue
+        changes = []
+        for key in ("seconds", "peak_memory", "classroom_visits", "group_imbalance"):
+            if old_result[key]:
+                changes.append(f"{(result[key] - old_result[key]) / old_result[key]:+.1%}")
+            else:
+                changes.append(f"{result[key] - old_result[key]:+}")
+        print(f"{result['num_tickets']}\t" + "\t".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the ticket sorter on synthetic schools")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="the numbers of tickets to benchmark")
+    parser.add_argument("--seed", type=int, default=56)
+    parser.add_argument("--serenading-groups", type=int, default=10)
+    parser.add_argument("--non-serenading-groups", type=int, default=10)
+    parser.add_argument("--use-arrays", action="store_true", help="choose the classrooms with numpy arrays")
+    parser.add_argument("-o", "--output", help="file to write the results to as JSON")
+    parser.add_argument("--compare", help="JSON file from a previous run to compare against")
+    args = parser.parse_args()
+
+    results = {
+        "commit": get_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "seed": args.seed,
+        "use_arrays": args.use_arrays,
+        "results": [],
+    }
+
+    print("Tickets\tSeconds\tPeak Memory (KB)\tVisits\tImbalance")
+    for num_tickets in args.sizes:
+        result = run_benchmark(num_tickets, args.seed, args.serenading_groups, args.non_serenading_groups,
+                               args.use_arrays)
+        results["results"].append(result)
+        print(f"{num_tickets}\t{result['seconds']}\t{round(result['peak_memory'] / 1024)}\t"
+              f"{result['classroom_visits']}\t{result['group_imbalance']}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
+
+
+if __name__ == "__main__":
+    main()
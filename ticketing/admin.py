@@ -1,15 +1,22 @@
 from django.contrib import admin
 from django.http import HttpResponseRedirect
-from django.urls import reverse
-from django.db.models import Q
-from django.utils.html import format_html
+from django.urls import reverse, path
+from django.shortcuts import render
+from django.contrib import messages
+from django.core.exceptions import PermissionDenied
+from django.forms import modelform_factory
+from django.db import transaction
+from django.db.models import Q, F
+from django.utils.html import format_html, format_html_join
 from .constants import DirectoryLocations, STUDENTS
-from .models import Ticket, TicketCode, TicketCodePDF, SortTicketsRequest, DeliveryGroup
+from .models import Ticket, TicketCode, TicketCodePDF, SortTicketsRequest, DeliveryGroup, PrintJob
 from .code_generator import CodesToPDF, generate_codes
-from .ticket_sorter import sort_tickets
+from .forms import SortSweepForm
+from .sorting import sweep_settings, sort_new_tickets, save_assignments, start_sort_worker
+from .printing import start_print_workers
+from .workers import is_stale
 from vdaywebsite.settings import ORG_NAME, NUM_TICKETS_PER_PDF
 import os
-import math
 import shutil
 import random
 
@@ -161,51 +168,128 @@ class TicketAdmin(admin.ModelAdmin):
 
 
 class SortTicketAdmin(admin.ModelAdmin):
-    list_display = ('pk', 'num_serenaders', 'num_non_serenaders', 'url', 'date')
-    actions = ('delete_queryset_and_children',)
+    list_display = ('pk', 'num_serenaders', 'num_non_serenaders', 'engine', 'status', 'url', 'date')
+    actions = ('delete_queryset_and_children', 'add_new_tickets')
     date_hierarchy = "date"
+    readonly_fields = ('status', 'sort_profile', 'error')
+    change_list_template = "admin/ticketing/sortticketsrequest/change_list.html"
+
+    # Every combination in a sweep is sorted with this seed, so that committing one gives the same sort
+    SWEEP_SEED = 0
+    # The arguments of TicketSorter which are named differently to the fields of SortTicketsRequest
+    SORTER_ARGUMENT_NAMES = {'num_serenaders': 'serenading_groups',
+                             'num_non_serenaders': 'non_serenading_groups'}
 
     @admin.display(description='URL')
     def url(self, obj):
         url = reverse("ticketing:tickets", args=[obj.pk])
         return format_html("<a href='{url}'>{url}</a>", url=url)
 
+    @admin.display(description='Sort Profile')
+    def sort_profile(self, obj):
+        if not obj.profile:
+            return "-"
+        rows = format_html_join(
+            "", "<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>",
+            ((phase["name"], phase["seconds"], phase["tickets"], phase["classrooms"],
+              round(phase["peak_memory"] / 1024) if "peak_memory" in phase else "-")
+             for phase in obj.profile["phases"])
+        )
+        return format_html(
+            "<table><tr><th>Phase</th><th>Seconds</th><th>Tickets</th><th>Classrooms</th>"
+            "<th>Peak Memory (KB)</th></tr>{}<tr><th>Total</th><th>{}</th></tr></table>",
+            rows, obj.profile["total_seconds"]
+        )
+
+    def get_urls(self):
+        urls = [
+            path('sweep/', self.admin_site.admin_view(self.sweep_view),
+                 name='ticketing_sortticketsrequest_sweep'),
+            path('sweep/commit/', self.admin_site.admin_view(self.sweep_commit_view),
+                 name='ticketing_sortticketsrequest_sweep_commit'),
+        ]
+        return urls + super().get_urls()
+
+    def sweep_view(self, request):
+        """Sorts the tickets with every combination of the settings in the form (without saving)"""
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+
+        results = None
+        if request.method == 'POST':
+            form = SortSweepForm(request.POST)
+            if form.is_valid():
+                combinations = [{self.SORTER_ARGUMENT_NAMES.get(field, field): value
+                                 for field, value in combination.items()}
+                                for combination in form.combinations]
+                results = sweep_settings(Ticket.objects.all(), combinations, seed=self.SWEEP_SEED,
+                                         time_budget=form.cleaned_data['time_budget'])
+                for result in results:
+                    # the fields of SortTicketsRequest, to commit the combination with
+                    result['fields'] = {field: result['settings'][self.SORTER_ARGUMENT_NAMES.get(field, field)]
+                                        for field in SortSweepForm.SETTINGS}
+                if len(results) < len(combinations):
+                    messages.warning(request, f"Only {len(results)} of the {len(combinations)} "
+                                              f"combinations were sorted within the time budget.")
+        else:
+            form = SortSweepForm()
+
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': "Sweep sort settings",
+            'form': form,
+            'results': results,
+        }
+        return render(request, "admin/ticketing/sortticketsrequest/sweep.html", context)
+
+    def sweep_commit_view(self, request):
+        """Creates a Sort Tickets Request with the settings of a combination from the sweep"""
+        if not self.has_add_permission(request) or request.method != 'POST':
+            raise PermissionDenied
+
+        form = modelform_factory(SortTicketsRequest, fields=SortSweepForm.SETTINGS)(request.POST)
+        if not form.is_valid():
+            messages.error(request, f"Invalid settings: {form.errors.as_text()}")
+            return HttpResponseRedirect(reverse("admin:ticketing_sortticketsrequest_sweep"))
+
+        obj = form.save(commit=False)
+        obj.seed = self.SWEEP_SEED
+        obj.save()
+        start_sort_worker()
+        self.log_addition(request, obj, [{"added": {}}])
+        return HttpResponseRedirect(reverse("ticketing:tickets", args=[obj.pk]))
+
     def save_model(self, request, obj, form, change):
         super().save_model(request=request, obj=obj, form=form, change=change)
+        if not change:
+            # The tickets are sorted in the background (the tickets page shows the progress)
+            start_sort_worker()
 
-        # Sort tickets
-        tickets = Ticket.objects.all()
-        groups_split = sort_tickets(
-            tickets, obj.num_serenaders, obj.num_non_serenaders,
-            max_serenades_per_class=obj.max_serenades_per_class,
-            max_non_serenades_per_serenading_class=obj.max_non_serenades_per_serenading_class,
-            extra_special_serenades=obj.extra_special_serenades,
-            enforce_distribution=obj.enforce_distribution
-        )
-
-        for is_serenading, groups in groups_split.items():
-            for group_index, group in enumerate(groups):
-                tickets = []
-                for ticket_index, ticket_to_sort in enumerate(group.tickets):
-                    ticket = Ticket.objects.get(pk=ticket_to_sort.pk)
-                    ticket.p1 = ticket_to_sort.p1.original_name
-                    ticket.p2 = ticket_to_sort.p2.original_name
-                    ticket.p3 = ticket_to_sort.p3.original_name
-                    ticket.p4 = ticket_to_sort.p4.original_name
-                    ticket.period = ticket_to_sort.chosen_period
-                    sort_order = int(f"{'1' if is_serenading else '0'}{group_index + 1}{str(ticket_index).zfill(4)}")
-                    ticket.sort_order = sort_order
-                    ticket.save()
-                    tickets.append(ticket)
-
-                delivery_group = DeliveryGroup(
-                    code=group.name,
-                    is_serenading_group=is_serenading,
-                    sort_request=obj,
-                    parts_printed=[]
-                )
-                delivery_group.save()
-                delivery_group.tickets.add(*tickets)
+    @admin.action(description="Add tickets redeemed after sorting (without changing printed tickets)")
+    def add_new_tickets(self, request, queryset):
+        for obj in queryset:
+            if obj.status != 'done':
+                self.message_user(request, f"Sort Tickets Request #{obj.pk} hasn't finished sorting.",
+                                  level=messages.ERROR)
+                continue
+            delivery_groups = list(obj.deliverygroup_set.all())
+            new_tickets = Ticket.objects.filter(date__gt=obj.date, deliverygroup=None)
+            assignments, undelivered_tickets = sort_new_tickets(delivery_groups, new_tickets)
+
+            # The new tickets are added to the end, starting from a new part if the last was printed
+            with transaction.atomic():
+                save_assignments(assignments, {delivery_group.code: delivery_group
+                                               for delivery_group in delivery_groups})
+            num_added = len(assignments)
+
+            self.message_user(request, f"Added {num_added} new tickets to Sort Tickets Request #{obj.pk}.")
+            if undelivered_tickets:
+                self.message_user(
+                    request,
+                    f"Could not add these tickets to any group: "
+                    f"{', '.join(str(ticket.pk) for ticket in undelivered_tickets)}",
+                    level=messages.WARNING)
 
     def response_add(self, request, obj, post_url_continue=None):
         return HttpResponseRedirect(reverse(f"ticketing:tickets", args=[obj.pk]))
@@ -246,16 +330,10 @@ class DeliveryGroupAdmin(admin.ModelAdmin):
         num_tickets = obj.tickets.count()
 
         if num_tickets > 0:
-            num_printed_tickets = 0
-            for part in obj.parts_printed:
-
-                if part == num_tickets // NUM_TICKETS_PER_PDF + 1:
-                    # If the last part, might not be a multiple of NUM_TICKETS_PER_PDF
-                    # so calculate remainder
-                    num_printed_tickets += num_tickets - (part - 1) * NUM_TICKETS_PER_PDF
-                else:
-                    # If not the last part, it's just the NUM_TICKETS_PER_PDF
-                    num_printed_tickets += NUM_TICKETS_PER_PDF
+            # Parts aren't always full (e.g. if tickets were added after sorting)
+            num_printed_tickets = obj.tickets.annotate(
+                part=F('position') / NUM_TICKETS_PER_PDF + 1
+            ).filter(part__in=obj.parts_printed).count()
             return f"{min(100, round(num_printed_tickets / num_tickets * 100))}%"
         else:
             return "100%"
@@ -264,12 +342,13 @@ class DeliveryGroupAdmin(admin.ModelAdmin):
     def unprint(self, request, queryset):
         for obj in queryset:
             sort_request = obj.sort_request
-            for part in range(math.ceil(obj.tickets.count() / NUM_TICKETS_PER_PDF)):
+            for part in range(obj.num_parts):
                 pdf_path = f"{DirectoryLocations().SORTED_TICKETS}/{sort_request.pk}/{obj.code}_{part + 1}.pdf"
 
                 if os.path.exists(pdf_path):
                     os.remove(pdf_path)
 
+        PrintJob.objects.filter(delivery_group__in=queryset).delete()
         queryset.update(parts_printed=[])
 
     def delete_model(self, request, obj):
@@ -286,11 +365,29 @@ class DeliveryGroupAdmin(admin.ModelAdmin):
         super().delete_queryset(request=request, queryset=queryset)
 
 
+class PrintJobAdmin(admin.ModelAdmin):
+    list_display = ('delivery_group', 'part', 'status', 'attempts', 'date')
+    list_filter = ('status',)
+    readonly_fields = ('error',)
+    actions = ('retry',)
+    date_hierarchy = "date"
+
+    @admin.action(description="Print again")
+    def retry(self, request, queryset):
+        # Parts which are still being printed would be printed twice (parts left by a worker which died are retried)
+        num_queued = queryset.filter(~Q(status='printing') | is_stale()).update(status='queued', attempts=0, error='')
+        if num_queued < queryset.count():
+            self.message_user(request, f"{queryset.count() - num_queued} of the parts are still being printed.",
+                              messages.WARNING)
+        start_print_workers()
+
+
 admin.site.register(Ticket, TicketAdmin)
 admin.site.register(TicketCode, TicketCodeAdmin)
 admin.site.register(TicketCodePDF, TicketCodePDFAdmin)
 admin.site.register(SortTicketsRequest, SortTicketAdmin)
 admin.site.register(DeliveryGroup, DeliveryGroupAdmin)
+admin.site.register(PrintJob, PrintJobAdmin)
 
 admin.site.site_header = f"{ORG_NAME} Valentine's Day Ticketing System"
 admin.site.site_title = ORG_NAME
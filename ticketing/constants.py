@@ -10,6 +10,8 @@ class DirectoryLocations:
     GENERATED_TICKET_CODES = "generated_codes"  # the folder containing filled PDFs of ticket codes
     REDEEMED_TICKETS = "redeemed_tickets"       # the folder containing the handwritten messages of redeemed tickets
     SORTED_TICKETS = "sorted_tickets"           # the folder containing the PDFs of the tickets to print
+    RENDERED_MESSAGES = "rendered_messages"     # the folder containing the messages rendered as PDFs (cache)
+    SORT_CACHE = "sort_cache"                   # the folder containing the classrooms chosen by recent sorts (cache)
     TIMETABLES = "timetables"                   # the folder containing the CSV with all the people data
     TIMETABLES_INPUT = f"{TIMETABLES}/uploaded_timetables"  # the folder containing the timetable CSVs of each grade
     DEV_STUFF = "dev"                           # the folder containing files for development/testing
@@ -1,4 +1,6 @@
 from django import forms
+import math
+import itertools
 
 
 class MultipleFileInput(forms.ClearableFileInput):
@@ -21,3 +23,78 @@ class MultipleFileField(forms.FileField):
 
 class CSVFileForm(forms.Form):
     files = MultipleFileField()
+
+
+class IntegerRangeField(forms.CharField):
+    """A comma separated list of integers and ranges (e.g. "5, 8-10" is [5, 8, 9, 10])"""
+    def __init__(self, *args, min_value: int = 0, max_value: int = 100, **kwargs):
+        self.min_value = min_value
+        self.max_value = max_value
+        kwargs.setdefault("help_text", "Comma separated numbers or ranges, e.g. 5, 8-10")
+        super().__init__(*args, **kwargs)
+
+    def clean(self, value):
+        value = super().clean(value)
+        numbers = []
+        try:
+            for part in value.split(","):
+                if "-" in part:
+                    start, end = part.split("-")
+                    if int(start) > int(end):
+                        raise forms.ValidationError(f"'{part.strip()}' is backwards (the smaller number goes first).")
+                    numbers.extend(range(int(start), int(end) + 1))
+                else:
+                    numbers.append(int(part))
+        except ValueError:
+            raise forms.ValidationError(f"'{value}' is not a list of numbers or ranges.")
+
+        for number in numbers:
+            if not self.min_value <= number <= self.max_value:
+                raise forms.ValidationError(
+                    f"Numbers must be between {self.min_value} and {self.max_value} (inclusive).")
+        return sorted(set(numbers))
+
+
+class BooleanChoicesField(forms.TypedMultipleChoiceField):
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("choices", [("True", "On"), ("False", "Off")])
+        kwargs.setdefault("coerce", lambda value: value == "True")
+        kwargs.setdefault("widget", forms.CheckboxSelectMultiple)
+        kwargs.setdefault("initial", ["True"])
+        super().__init__(*args, **kwargs)
+
+
+class SortSweepForm(forms.Form):
+    # Sorting every combination of too many settings would take forever
+    MAX_COMBINATIONS = 100
+    # The combinations are sorted while the page loads, so they must finish before the request times out
+    MAX_TIME_BUDGET = 120
+
+    num_serenaders = IntegerRangeField(initial="10", min_value=1)
+    num_non_serenaders = IntegerRangeField(initial="10", min_value=1)
+    max_serenades_per_class = IntegerRangeField(initial="5")
+    max_non_serenades_per_serenading_class = IntegerRangeField(initial="10")
+    extra_special_serenades = BooleanChoicesField()
+    enforce_distribution = BooleanChoicesField()
+    time_budget = forms.FloatField(
+        initial=60, min_value=1, max_value=MAX_TIME_BUDGET, label="Time budget (seconds)",
+        help_text="Combinations which haven't been sorted after this many seconds are abandoned.")
+
+    SETTINGS = ("num_serenaders", "num_non_serenaders", "max_serenades_per_class",
+                "max_non_serenades_per_serenading_class", "extra_special_serenades",
+                "enforce_distribution")
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if all(setting in cleaned_data for setting in self.SETTINGS):
+            num_combinations = math.prod(len(cleaned_data[setting]) for setting in self.SETTINGS)
+            if num_combinations > self.MAX_COMBINATIONS:
+                raise forms.ValidationError(
+                    f"There are {num_combinations} combinations, but the maximum is {self.MAX_COMBINATIONS}.")
+        return cleaned_data
+
+    @property
+    def combinations(self) -> list[dict]:
+        """Every combination of the chosen settings (keys are the fields of SortTicketsRequest)"""
+        values = [self.cleaned_data[setting] for setting in self.SETTINGS]
+        return [dict(zip(self.SETTINGS, combination)) for combination in itertools.product(*values)]
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from ticketing.models import Ticket
+from ticketing.sorting import sort_tickets
+
+
+class Command(BaseCommand):
+    help = "Sorts the current tickets with every engine and compares the results (doesn't save anything)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('num_serenaders', nargs='?', type=int, default=10)
+        parser.add_argument('num_non_serenaders', nargs='?', type=int, default=10)
+        parser.add_argument('--max-serenades-per-class', type=int, default=5)
+        parser.add_argument('--max-non-serenades-per-serenading-class', type=int, default=10)
+        parser.add_argument('--no-extra-special-serenades', action='store_true')
+        parser.add_argument('--no-enforce-distribution', action='store_true')
+
+    def handle(self, *args, **options):
+        tickets = Ticket.objects.all()
+
+        results = {}
+        engines = ("full", "numpy", "preview")
+        for engine in engines:
+            assignments, report, profile = sort_tickets(
+                tickets, options['num_serenaders'], options['num_non_serenaders'],
+                max_serenades_per_class=options['max_serenades_per_class'],
+                max_non_serenades_per_serenading_class=options['max_non_serenades_per_serenading_class'],
+                extra_special_serenades=not options['no_extra_special_serenades'],
+                enforce_distribution=not options['no_enforce_distribution'],
+                engine=engine,
+                # a cached sort would skip choosing the classrooms, so its time couldn't be compared
+                use_cache=False
+            )
+            results[engine] = (report, profile)
+
+        output_string = f"Sorted {len(tickets)} tickets:\n"
+        output_string += f"{'':<24}{'Full':>10}{'NumPy':>10}{'Preview':>10}\n"
+        rows = (
+            ("Classroom visits", lambda report, profile: report.total_visits),
+            ("Group imbalance", lambda report, profile: report.group_imbalance),
+            ("Undelivered tickets", lambda report, profile: len(report.undelivered_tickets)),
+            ("Seconds", lambda report, profile: profile.total_seconds),
+        )
+        for name, get_value in rows:
+            output_string += f"{name:<24}" + "".join(
+                f"{get_value(*results[engine]):>10}" for engine in engines) + "\n"
+
+        self.stdout.write(self.style.SUCCESS(output_string))
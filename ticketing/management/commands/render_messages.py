@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from ticketing.models import Ticket
+from ticketing.printing import render_messages
+
+
+class Command(BaseCommand):
+    help = "Renders the messages of redeemed tickets ahead of printing (the print worker renders new tickets' messages)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('tickets', nargs='*', type=int,
+                            help="the IDs of the tickets to render (defaults to every ticket)")
+        parser.add_argument('--padding', type=int, default=0,
+                            help="the padding the tickets will be printed with (only used with --enforce-boundaries)")
+        parser.add_argument('--enforce-boundaries', action='store_true',
+                            help="render the messages for printing with enforced boundaries")
+
+    def handle(self, *args, **options):
+        ticket_pks = options['tickets'] or list(Ticket.objects.values_list('pk', flat=True))
+        errors = render_messages(ticket_pks, options['padding'], options['enforce_boundaries'])
+
+        for ticket_pk, error in errors.items():
+            self.stderr.write(self.style.ERROR(f"Couldn't render the message of ticket #{ticket_pk}:\n{error}"))
+        self.stdout.write(self.style.SUCCESS(f"Rendered {len(ticket_pks) - len(errors)} of {len(ticket_pks)} messages."))
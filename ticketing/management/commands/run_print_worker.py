@@ -0,0 +1,43 @@
+import multiprocessing
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from vdaywebsite.settings import PRINT_WORKERS
+from ticketing.ticket_printer import warm_asset_cache
+
+
+def work(once: bool, poll_interval: float):
+    # Spawned processes (where forking isn't available) have to set up Django again
+    django.setup()
+    from ticketing.printing import run_worker
+    run_worker(once, poll_interval)
+
+
+class Command(BaseCommand):
+    help = "Prints queued parts of delivery groups and renders the messages of newly redeemed tickets with a pool of " \
+           "processes (started automatically by the tickets page)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=PRINT_WORKERS,
+                            help="number of parts to print at once (defaults to PRINT_WORKERS)")
+        parser.add_argument('--once', action='store_true',
+                            help="exit once there are no queued parts (instead of waiting for more)")
+        parser.add_argument('--poll-interval', type=float, default=2,
+                            help="seconds to wait between checking for queued parts")
+
+    def handle(self, *args, **options):
+        if "fork" in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context("fork")
+        else:
+            mp_context = multiprocessing.get_context()
+
+        # Forked processes share the fonts, templates and images loaded before forking
+        warm_asset_cache()
+        # Each process needs its own database connection
+        connections.close_all()
+        workers = [mp_context.Process(target=work, args=(options['once'], options['poll_interval']))
+                   for _ in range(max(1, options['processes']))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
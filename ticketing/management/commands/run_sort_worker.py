@@ -0,0 +1,29 @@
+import time
+from django.core.management.base import BaseCommand
+from ticketing.sorting import claim_next_request, run_request
+
+
+class Command(BaseCommand):
+    help = "Sorts queued Sort Tickets Requests in the background (started automatically by the admin)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="exit once there are no queued requests (instead of waiting for more)")
+        parser.add_argument('--poll-interval', type=float, default=2,
+                            help="seconds to wait between checking for queued requests")
+
+    def handle(self, *args, **options):
+        while True:
+            obj = claim_next_request()
+            if obj is None:
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+                continue
+
+            self.stdout.write(f"Sorting Sort Tickets Request #{obj.pk}...")
+            run_request(obj)
+            if obj.status == 'failed':
+                self.stderr.write(self.style.ERROR(f"Sort Tickets Request #{obj.pk} failed:\n{obj.error}"))
+            else:
+                self.stdout.write(self.style.SUCCESS(f"Sorted Sort Tickets Request #{obj.pk}."))
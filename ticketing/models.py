@@ -1 +1 @@
-from django.db import modelsfrom django.utils import timezonefrom django.core.validators import MaxValueValidator, MinValueValidatorfrom django.core.exceptions import ValidationErrorfrom .constants import MaxLengths, STUDENTS, TEMPLATESclass TicketCodePDF(models.Model):    num_of_items = models.PositiveIntegerField(        default=100, validators=[MinValueValidator(1), MaxValueValidator(3000)],        help_text="The number of codes you want to generate. Multiple of 100 recommended."    )    item_type = models.CharField(        max_length=20,        choices=[            ('Chocolate', 'Chocolate'),            ('Rose', 'Rose'),            ('Serenade', 'Serenade'),            ('Special Serenade', 'Special Serenade')        ],        default='Serenade'    )    date = models.DateTimeField(default=timezone.now, verbose_name="Date Created")    def __str__(self):        return f'<{self.pk}> {self.num_of_items} {self.item_type}s'    class Meta:        verbose_name = "Ticket Code PDF"        verbose_name_plural = "Ticket Codes PDFs"class TicketCode(models.Model):    code = models.CharField(max_length=MaxLengths.TICKET_CODE)    is_unconsumed = models.BooleanField(default=True)    item_type = models.CharField(        max_length=20,        choices=[            ('Chocolate', 'Chocolate'),            ('Rose', 'Rose'),            ('Serenade', 'Serenade'),            ('Special Serenade', 'Special Serenade')        ],        default='Serenade'    )    # links ticket codes to the pdf which created them. can also be null if created individually    pdf = models.ForeignKey(        TicketCodePDF, on_delete=models.SET_NULL, null=True, blank=True,        verbose_name="Corresponding TicketCodePDF (optional)",        help_text="Links the code to the PDF which generated it. Leave it blank if you are "                  "manually creating the code (which you probably shouldn't be doing anyway).")    date = models.DateTimeField(default=timezone.now, help_text="Date created")    def __str__(self):        if self.is_unconsumed:            return f'!{self.item_type} ({self.code})'        else:            return f'{self.item_type} ({self.code})'    def clean(self):        if len(self.code) != MaxLengths.TICKET_CODE:            raise ValidationError(f"Code must be exactly {MaxLengths.TICKET_CODE} characters long.")    class Meta:        verbose_name = "Ticket Code"        verbose_name_plural = "Ticket Codes"class Ticket(models.Model):    recipient_id = models.CharField(        max_length=100, verbose_name="Recipient ID",        help_text="A unique identifier for each student. "                  "Is represented by their full name and ARC class.")    item_type = models.CharField(        max_length=20,        choices=[            ('Chocolate', 'Chocolate'),            ('Rose', 'Rose'),            ('Serenade', 'Serenade'),            ('Special Serenade', 'Special Serenade')        ],        default='Serenade'    )    template = models.CharField(max_length=100)    ss_period = models.PositiveIntegerField(        null=True, blank=True, verbose_name="Special Serenade Period",        help_text="The period that the special serenade is requested to be in."    )    is_handwritten = models.BooleanField(default=False)    # links ticket to the code which made it. can also be null if it was manually created by prefect    code = models.OneToOneField(        TicketCode, on_delete=models.SET_NULL, null=True, blank=True,        verbose_name="Corresponding TicketCode (optional)",        help_text="Links the ticket to the code which made it. "                  "Leave it blank if you are manually creating the ticket.")    period = models.PositiveIntegerField(        null=True, blank=True, editable=False,        help_text="The period chosen by the ticket sorter. "                  "Will be automatically determined so do not touch.")    p1 = models.CharField(        null=True, blank=True, max_length=4, editable=False, verbose_name="Period 1 Classroom",        help_text="Will be automatically determined so do not touch.")    p2 = models.CharField(        null=True, blank=True, max_length=4, editable=False, verbose_name="Period 2 Classroom",        help_text="Will be automatically determined so do not touch.")    p3 = models.CharField(        null=True, blank=True, max_length=4, editable=False, verbose_name="Period 3 Classroom",        help_text="Will be automatically determined so do not touch.")    p4 = models.CharField(        null=True, blank=True, max_length=4, editable=False, verbose_name="Period 4 Classroom",        help_text="Will be automatically determined so do not touch.")    sort_order = models.PositiveIntegerField(        null=True, blank=True, editable=False,        help_text="Used to determine what order the tickets should be when printing. "                  "Will be automatically determined so do not touch.")    date = models.DateTimeField(default=timezone.now, help_text="Date created")    def __str__(self):        return f'{self.recipient_id} ({self.item_type})'    def clean(self):        if self.item_type == "Special Serenade":            if self.ss_period is None:                raise ValidationError("Must specify a period for special serenade.")            else:                if not 1 <= self.ss_period <= 4:                    raise ValidationError("Period must be between 1 and 4 (inclusive).")        if self.recipient_id not in STUDENTS:            raise ValidationError("Invalid Recipient (student not found).")        if self.template != "Blank" and self.template not in TEMPLATES.keys():            raise ValidationError(f"Template '{self.template}' not found (case sensitive).")    class Meta:        verbose_name = "Ticket"        verbose_name_plural = "Tickets"        ordering = ['sort_order', '-date']class SortTicketsRequest(models.Model):    num_serenaders = models.IntegerField(        default=10, validators=[MaxValueValidator(100), MinValueValidator(1)],        verbose_name="Number of serenading delivery groups")    num_non_serenaders = models.IntegerField(        default=10, validators=[MaxValueValidator(100), MinValueValidator(1)],        verbose_name="Number of non-serenading delivery groups")    max_serenades_per_class = models.IntegerField(        default=5, verbose_name="Max number of serenades per class visit",        help_text="Lower values increase number of class visits required and "                  "shifts load towards serenading groups. "                  "Set to 0 to disable limit.")    max_non_serenades_per_serenading_class = models.IntegerField(        default=10,        verbose_name="Max number of non-serenades per class visit",        help_text="Only enforced for classes with at least one serenade. "                  "Lower values increase number of class visits required and "                  "shifts load towards non-serenading groups. "                  "Set to 0 to disable limit.")    extra_special_serenades = models.BooleanField(        default=True,        help_text="Special serenades will not be grouped with regular "                  "serenades. Can be guaranteed but some classes may have to "                  "be visited twice. "                  "Increases number of class visits required.")    enforce_distribution = models.BooleanField(        default=True,        help_text="Splits up serenades between periods. "                  "Tries to prevent that people from receiving multiple "                  "serenades at once (no guarantees though). "                  "Increases number of class visits required.")    date = models.DateTimeField(default=timezone.now, help_text="Date created")    class Meta:        verbose_name = "Sort Tickets Request"        verbose_name_plural = "Sort Tickets Requests"class DeliveryGroup(models.Model):    code = models.CharField(max_length=10)    is_serenading_group = models.BooleanField()    # A JSON list containing which parts have been printed as numbers (e.g. [1, 2, 4])    parts_printed = models.JSONField()    sort_request = models.ForeignKey(SortTicketsRequest, on_delete=models.CASCADE)    tickets = models.ManyToManyField(Ticket)    date = models.DateTimeField(default=timezone.now, help_text="Date created")    class Meta:        verbose_name = "Delivery Group"
\ No newline at end of file
+from django.db import modelsfrom django.utils import timezonefrom django.core.validators import MaxValueValidator, MinValueValidatorfrom django.core.exceptions import ValidationErrorfrom .constants import MaxLengths, STUDENTS, TEMPLATESfrom vdaywebsite.settings import NUM_TICKETS_PER_PDFclass TicketCodePDF(models.Model):    num_of_items = models.PositiveIntegerField(        default=100, validators=[MinValueValidator(1), MaxValueValidator(3000)],        help_text="The number of codes you want to generate. Multiple of 100 recommended."    )    item_type = models.CharField(        max_length=20,        choices=[            ('Chocolate', 'Chocolate'),            ('Rose', 'Rose'),            ('Serenade', 'Serenade'),            ('Special Serenade', 'Special Serenade')        ],        default='Serenade'    )    date = models.DateTimeField(default=timezone.now, verbose_name="Date Created")    def __str__(self):        return f'<{self.pk}> {self.num_of_items} {self.item_type}s'    class Meta:        verbose_name = "Ticket Code PDF"        verbose_name_plural = "Ticket Codes PDFs"class TicketCode(models.Model):    code = models.CharField(max_length=MaxLengths.TICKET_CODE)    is_unconsumed = models.BooleanField(default=True)    item_type = models.CharField(        max_length=20,        choices=[            ('Chocolate', 'Chocolate'),            ('Rose', 'Rose'),            ('Serenade', 'Serenade'),            ('Special Serenade', 'Special Serenade')        ],        default='Serenade'    )    # links ticket codes to the pdf which created them. can also be null if created individually    pdf = models.ForeignKey(        TicketCodePDF, on_delete=models.SET_NULL, null=True, blank=True,        verbose_name="Corresponding TicketCodePDF (optional)",        help_text="Links the code to the PDF which generated it. Leave it blank if you are "                  "manually creating the code (which you probably shouldn't be doing anyway).")    date = models.DateTimeField(default=timezone.now, help_text="Date created")    def __str__(self):        if self.is_unconsumed:            return f'!{self.item_type} ({self.code})'        else:            return f'{self.item_type} ({self.code})'    def clean(self):        if len(self.code) != MaxLengths.TICKET_CODE:            raise ValidationError(f"Code must be exactly {MaxLengths.TICKET_CODE} characters long.")    class Meta:        verbose_name = "Ticket Code"        verbose_name_plural = "Ticket Codes"class Ticket(models.Model):    recipient_id = models.CharField(        max_length=100, verbose_name="Recipient ID",        help_text="A unique identifier for each student. "                  "Is represented by their full name and ARC class.")    item_type = models.CharField(        max_length=20,        choices=[            ('Chocolate', 'Chocolate'),            ('Rose', 'Rose'),            ('Serenade', 'Serenade'),            ('Special Serenade', 'Special Serenade')        ],        default='Serenade'    )    template = models.CharField(max_length=100)    ss_period = models.PositiveIntegerField(        null=True, blank=True, verbose_name="Special Serenade Period",        help_text="The period that the special serenade is requested to be in."    )    is_handwritten = models.BooleanField(default=False)    # links ticket to the code which made it. can also be null if it was manually created by prefect    code = models.OneToOneField(        TicketCode, on_delete=models.SET_NULL, null=True, blank=True,        verbose_name="Corresponding TicketCode (optional)",        help_text="Links the ticket to the code which made it. "                  "Leave it blank if you are manually creating the ticket.")    period = models.PositiveIntegerField(        null=True, blank=True, editable=False,        help_text="The period chosen by the ticket sorter. "                  "Will be automatically determined so do not touch.")    p1 = models.CharField(        null=True, blank=True, max_length=4, editable=False, verbose_name="Period 1 Classroom",        help_text="Will be automatically determined so do not touch.")    p2 = models.CharField(        null=True, blank=True, max_length=4, editable=False, verbose_name="Period 2 Classroom",        help_text="Will be automatically determined so do not touch.")    p3 = models.CharField(        null=True, blank=True, max_length=4, editable=False, verbose_name="Period 3 Classroom",        help_text="Will be automatically determined so do not touch.")    p4 = models.CharField(        null=True, blank=True, max_length=4, editable=False, verbose_name="Period 4 Classroom",        help_text="Will be automatically determined so do not touch.")    position = models.PositiveIntegerField(        null=True, blank=True, editable=False,        help_text="The position of the ticket in its delivery group (the order to deliver in). "                  "Will be automatically determined so do not touch.")    sort_order = models.PositiveIntegerField(        null=True, blank=True, editable=False,        help_text="Used to determine what order the tickets should be when printing. "                  "Will be automatically determined so do not touch.")    # The message is rendered ahead of printing by the print worker (python manage.py run_print_worker)    message_status = models.CharField(        max_length=10,        choices=[            ('queued', 'Queued'),            ('rendering', 'Rendering'),            ('done', 'Done'),            ('failed', 'Failed')        ],        default='queued', editable=False)    date = models.DateTimeField(default=timezone.now, help_text="Date created")    def __str__(self):        return f'{self.recipient_id} ({self.item_type})'    def clean(self):        if self.item_type == "Special Serenade":            if self.ss_period is None:                raise ValidationError("Must specify a period for special serenade.")            else:                if not 1 <= self.ss_period <= 4:                    raise ValidationError("Period must be between 1 and 4 (inclusive).")        if self.recipient_id not in STUDENTS:            raise ValidationError("Invalid Recipient (student not found).")        if self.template != "Blank" and self.template not in TEMPLATES.keys():            raise ValidationError(f"Template '{self.template}' not found (case sensitive).")    class Meta:        verbose_name = "Ticket"        verbose_name_plural = "Tickets"        ordering = ['sort_order', '-date']class SortTicketsRequest(models.Model):    num_serenaders = models.IntegerField(        default=10, validators=[MaxValueValidator(100), MinValueValidator(1)],        verbose_name="Number of serenading delivery groups")    num_non_serenaders = models.IntegerField(        default=10, validators=[MaxValueValidator(100), MinValueValidator(1)],        verbose_name="Number of non-serenading delivery groups")    engine = models.CharField(        max_length=10,        choices=[            ('full', 'Full'),            ('numpy', 'NumPy'),            ('preview', 'Preview')        ],        default='full',        verbose_name="Sorting engine",        help_text="NumPy is faster for very large schools (100k+ tickets) but follows the "                  "options below less strictly. Preview is even faster but visits more classes and "                  "ignores every option below (besides the number of groups). Useful for "                  "previewing a sort of a large school.")    max_serenades_per_class = models.IntegerField(        default=5, verbose_name="Max number of serenades per class visit",        help_text="Lower values increase number of class visits required and "                  "shifts load towards serenading groups. "                  "Set to 0 to disable limit.")    max_non_serenades_per_serenading_class = models.IntegerField(        default=10,        verbose_name="Max number of non-serenades per class visit",        help_text="Only enforced for classes with at least one serenade. "                  "Lower values increase number of class visits required and "                  "shifts load towards non-serenading groups. "                  "Set to 0 to disable limit.")    extra_special_serenades = models.BooleanField(        default=True,        help_text="Special serenades will not be grouped with regular "                  "serenades. Can be guaranteed but some classes may have to "                  "be visited twice. "                  "Increases number of class visits required.")    enforce_distribution = models.BooleanField(        default=True,        help_text="Splits up serenades between periods. "                  "Tries to prevent that people from receiving multiple "                  "serenades at once (no guarantees though). "                  "Increases number of class visits required.")    split_components = models.BooleanField(        default=False,        help_text="Splits the tickets into groups of classes which share no students "                  "and sorts each group separately (in parallel). Faster for large "                  "schools, but periods may be less evenly balanced.")    improve_time_budget = models.FloatField(        default=0, validators=[MinValueValidator(0)],        verbose_name="Improvement time (seconds)",        help_text="Spends up to this many seconds moving tickets between classes "                  "to remove more class visits after sorting. "                  "Set to 0 to disable.")    optimise_time_limit = models.FloatField(        default=0, validators=[MinValueValidator(0)],        verbose_name="Exact optimisation time (seconds)",        help_text="Spends up to this many seconds searching for the minimum number "                  "of class visits with a MILP solver, and reports how far the sort "                  "is from the minimum. Set to 0 to disable.")    num_starts = models.IntegerField(        default=1, validators=[MaxValueValidator(64), MinValueValidator(1)],        verbose_name="Number of random starts",        help_text="Sorts the tickets this many times (in parallel) with different "                  "random seeds and keeps the sort with the fewest class visits. "                  "Higher values may reduce class visits but take longer.")    time_budget = models.FloatField(        null=True, blank=True, validators=[MinValueValidator(0)],        verbose_name="Time budget (seconds)",        help_text="Random starts which haven't finished after this many seconds "                  "are abandoned. Leave blank for no limit.")    # Statistics about the sort (a SortReport converted to JSON)    report = models.JSONField(null=True, blank=True, editable=False)    # How long each phase of the sort took (a SortProfile converted to JSON)    profile = models.JSONField(null=True, blank=True, editable=False)    # The tickets are sorted in the background by a worker (python manage.py run_sort_worker)    status = models.CharField(        max_length=10,        choices=[            ('queued', 'Queued'),            ('sorting', 'Sorting'),            ('persisting', 'Saving'),            ('done', 'Done'),            ('failed', 'Failed')        ],        default='queued', editable=False)    # When the worker sorting it last showed that it's still alive (see workers.py)    heartbeat = models.DateTimeField(null=True, blank=True, editable=False)    # The names of the phases of the sort which have started so far (the last is the current phase)    progress = models.JSONField(default=list, blank=True, editable=False)    # The traceback if the sort failed    error = models.TextField(blank=True, editable=False)    # The random seed to sort with (e.g. when committing a sweep). Leave blank for a random sort    seed = models.IntegerField(null=True, blank=True, editable=False)    date = models.DateTimeField(default=timezone.now, help_text="Date created")    class Meta:        verbose_name = "Sort Tickets Request"        verbose_name_plural = "Sort Tickets Requests"class DeliveryGroup(models.Model):    code = models.CharField(max_length=10)    is_serenading_group = models.BooleanField()    # A JSON list containing which parts have been printed as numbers (e.g. [1, 2, 4])    parts_printed = models.JSONField(default=list)    sort_request = models.ForeignKey(SortTicketsRequest, on_delete=models.CASCADE)    tickets = models.ManyToManyField(Ticket)    date = models.DateTimeField(default=timezone.now, help_text="Date created")    # Tickets added after sorting may leave a gap in the positions so that printed parts don't change    @property    def last_position(self) -> int | None:        return self.tickets.aggregate(last_position=models.Max('position'))['last_position']    @property    def num_parts(self) -> int:        last_position = self.last_position        if last_position is None:            return 0        return last_position // NUM_TICKETS_PER_PDF + 1    def get_part(self, part: int) -> list[Ticket]:        """The tickets in a part (parts start from 1)"""        return list(self.tickets.filter(position__gte=(part - 1) * NUM_TICKETS_PER_PDF,                                        position__lt=part * NUM_TICKETS_PER_PDF).order_by('position'))    @property    def next_position(self) -> int:        """Where to add more tickets without changing any parts which have already been printed"""        last_position = self.last_position        next_position = 0 if last_position is None else last_position + 1        # after the last printed part, even if some of its tickets have been removed since        return max(next_position, max(self.parts_printed, default=0) * NUM_TICKETS_PER_PDF)    class Meta:        verbose_name = "Delivery Group"class PrintJob(models.Model):    """A part of a delivery group to print (as a PDF) in the background"""    # How many times to try printing a part before giving up    MAX_ATTEMPTS = 3    delivery_group = models.ForeignKey(DeliveryGroup, on_delete=models.CASCADE)    part = models.PositiveIntegerField()    padding = models.PositiveIntegerField(default=0)    enforce_boundaries = models.BooleanField(default=False)    status = models.CharField(        max_length=10,        choices=[            ('queued', 'Queued'),            ('printing', 'Printing'),            ('done', 'Done'),            ('failed', 'Failed')        ],        default='queued')    # When the worker printing it last showed that it's still alive (see workers.py)    heartbeat = models.DateTimeField(null=True, blank=True, editable=False)    attempts = models.PositiveIntegerField(default=0)    # The traceback of the last failed attempt    error = models.TextField(blank=True)    date = models.DateTimeField(default=timezone.now, help_text="Date created")    def __str__(self):        return f'{self.delivery_group.code} part {self.part} ({self.status})'    class Meta:        verbose_name = "Print Job"        verbose_name_plural = "Print Jobs"        constraints = [models.UniqueConstraint(fields=['delivery_group', 'part'], name='unique_print_job_part')]
\ No newline at end of file
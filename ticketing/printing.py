@@ -0,0 +1,155 @@
+"""Prints the parts of delivery groups (as PDFs) in background worker processes"""
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from vdaywebsite.settings import BASE_DIR, NUM_TICKETS_PER_PDF
+from .constants import DirectoryLocations
+from .models import Ticket, DeliveryGroup, PrintJob
+from .ticket_printer import TicketsToPDF, get_message_pdf
+from .workers import heartbeat, is_stale
+import os
+import sys
+import time
+import subprocess
+import traceback
+
+
+@transaction.atomic
+def queue_parts(parts: list[tuple[DeliveryGroup, int]], padding: int = 0, enforce_boundaries: bool = False):
+    """
+    Adds the parts to the print queue (parts which are already queued or printing aren't added again,
+    but parts which haven't started printing yet are printed with the new settings)
+    """
+    for delivery_group, part in parts:
+        print_job, created = PrintJob.objects.get_or_create(
+            delivery_group=delivery_group, part=part,
+            defaults={'padding': padding, 'enforce_boundaries': enforce_boundaries}
+        )
+        if created or print_job.status == 'printing':
+            continue
+        fields = {'padding': padding, 'enforce_boundaries': enforce_boundaries}
+        if print_job.status in ('done', 'failed'):
+            # Print it again
+            fields.update(status='queued', attempts=0, error='')
+        PrintJob.objects.filter(pk=print_job.pk, status=print_job.status).update(**fields)
+
+
+def start_print_workers():
+    """
+    Starts a pool of workers in separate processes, which print every queued part then exit.
+    Does nothing if a worker is still printing (it prints the newly queued parts before it exits).
+    """
+    if PrintJob.objects.filter(status='printing').exclude(is_stale()).exists():
+        return
+    subprocess.Popen([sys.executable, str(BASE_DIR / "manage.py"), "run_print_worker", "--once"],
+                     cwd=BASE_DIR, start_new_session=True,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def render_messages(ticket_pks: list[int], padding: int = 0, enforce_boundaries: bool = False) -> dict[int, str]:
+    """
+    Renders the messages which aren't cached yet (messages which fail are rendered again when printed).
+    :return: the error of each ticket whose message couldn't be rendered
+    """
+    errors = {}
+    for ticket_pk in ticket_pks:
+        try:
+            get_message_pdf(ticket_pk, padding, enforce_boundaries)
+        except Exception:
+            errors[ticket_pk] = traceback.format_exc()
+    return errors
+
+
+def claim_next_message() -> int | None:
+    """
+    Marks the oldest redeemed ticket whose message hasn't been rendered yet as rendering and returns its ID
+    (None if there are none)
+    """
+    while True:
+        ticket_pk = Ticket.objects.filter(message_status='queued').order_by('date', 'pk') \
+            .values_list('pk', flat=True).first()
+        if ticket_pk is None:
+            return None
+        # Only succeeds for one worker if several try to claim the same ticket
+        if Ticket.objects.filter(pk=ticket_pk, message_status='queued').update(message_status='rendering'):
+            return ticket_pk
+
+
+def render_message(ticket_pk: int):
+    """
+    Renders the message of a claimed ticket. Messages which fail (or are left rendering by a worker
+    which died) are rendered again when they're printed.
+    """
+    errors = render_messages([ticket_pk])
+    Ticket.objects.filter(pk=ticket_pk).update(message_status='failed' if errors else 'done')
+
+
+def claim_next_job() -> PrintJob | None:
+    """
+    Marks the oldest queued part (or part left by a worker which died) as printing and returns it
+    (None if there are none)
+    """
+    # A worker dying counts as a failed attempt
+    PrintJob.objects.filter(is_stale(), status='printing', attempts__gte=PrintJob.MAX_ATTEMPTS).update(
+        status='failed', error="The worker printing this part stopped responding.")
+    while True:
+        print_job = PrintJob.objects.filter(
+            Q(status='queued') | Q(is_stale(), status='printing')
+        ).order_by('date', 'pk').first()
+        if print_job is None:
+            return None
+        # Only succeeds for one worker if several try to claim the same part
+        if PrintJob.objects.filter(pk=print_job.pk, status=print_job.status, heartbeat=print_job.heartbeat).update(
+                status='printing', attempts=F('attempts') + 1, heartbeat=timezone.now()):
+            print_job.refresh_from_db()
+            return print_job
+
+
+def run_job(print_job: PrintJob):
+    """Prints the part, or queues it again if it fails (until it has been tried PrintJob.MAX_ATTEMPTS times)"""
+    delivery_group = print_job.delivery_group
+    sort_request_pk = delivery_group.sort_request_id
+    try:
+        os.makedirs(f"{DirectoryLocations.SORTED_TICKETS}/{sort_request_pk}", exist_ok=True)
+        pdf_path = f"{DirectoryLocations.SORTED_TICKETS}/{sort_request_pk}/{delivery_group.code}_{print_job.part}.pdf"
+        # Shows other workers that the part is still being printed, so they only claim it again if this process dies
+        with heartbeat(PrintJob.objects.filter(pk=print_job.pk)):
+            TicketsToPDF(delivery_group.get_part(print_job.part),
+                         pdf_path,
+                         delivery_group.code,
+                         starting_index=(print_job.part - 1) * NUM_TICKETS_PER_PDF,
+                         padding=print_job.padding,
+                         enforce_boundaries=print_job.enforce_boundaries)
+    except Exception:
+        print_job.status = 'failed' if print_job.attempts >= PrintJob.MAX_ATTEMPTS else 'queued'
+        print_job.error = traceback.format_exc()
+    else:
+        print_job.status = 'done'
+        print_job.error = ''
+        with transaction.atomic():
+            # Locked so that parts of the same group finishing at the same time don't overwrite each other
+            delivery_group = DeliveryGroup.objects.select_for_update().get(pk=delivery_group.pk)
+            if print_job.part not in delivery_group.parts_printed:
+                delivery_group.parts_printed = sorted([*delivery_group.parts_printed, print_job.part])
+                delivery_group.save(update_fields=['parts_printed'])
+    # Only touches this part, so parts finishing at the same time don't overwrite each other
+    PrintJob.objects.filter(pk=print_job.pk).update(status=print_job.status, error=print_job.error)
+
+
+def run_worker(once: bool = False, poll_interval: float = 2):
+    """
+    Prints queued parts, and renders the messages of newly redeemed tickets when there are no parts to print,
+    until there are none left (or forever if not once)
+    """
+    while True:
+        print_job = claim_next_job()
+        if print_job is not None:
+            run_job(print_job)
+            continue
+        ticket_pk = claim_next_message()
+        if ticket_pk is not None:
+            render_message(ticket_pk)
+            continue
+        if once:
+            return
+        time.sleep(poll_interval)
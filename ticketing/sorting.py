@@ -0,0 +1,168 @@
+"""Connects the ticket sorter (which doesn't use Django) to the database"""
+from typing import Any
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from vdaywebsite.settings import BASE_DIR
+from .constants import STUDENTS, DirectoryLocations
+from .models import Ticket, DeliveryGroup, SortTicketsRequest
+from .workers import heartbeat, is_stale
+from .ticket_sorter import TicketRecord, Assignment, SortReport, SortProfile, ClassroomCache, \
+    sort_records, sweep_records, sort_new_records
+import sys
+import subprocess
+import traceback
+
+# The fields of Ticket which are set by the sort
+ASSIGNMENT_FIELDS = ('p1', 'p2', 'p3', 'p4', 'period', 'position', 'sort_order')
+# The number of rows written per query when saving a sort
+BULK_BATCH_SIZE = 500
+# The classrooms chosen by recent sorts, saved as files so that they're shared by every process (e.g. each
+# sort worker) instead of being lost when the process exits
+CLASSROOM_CACHE = ClassroomCache(directory=DirectoryLocations.SORT_CACHE)
+
+
+def to_record(ticket: Ticket) -> TicketRecord:
+    timetable = STUDENTS[ticket.recipient_id]
+    ss_period = ticket.ss_period if ticket.item_type == "Special Serenade" else None
+    return TicketRecord(ticket.pk, ticket.recipient_id, ticket.item_type,
+                        timetable["P1"], timetable["P2"], timetable["P3"], timetable["P4"], ss_period)
+
+
+def sort_tickets(tickets: list[Ticket], *args, **kwargs) -> tuple[list[Assignment], SortReport, SortProfile]:
+    """Sorts the tickets with the same arguments as ticket_sorter.sort_records (caching in CLASSROOM_CACHE)"""
+    kwargs.setdefault("cache", CLASSROOM_CACHE)
+    return sort_records((to_record(ticket) for ticket in tickets), *args, **kwargs)
+
+
+def sweep_settings(tickets: list[Ticket], combinations: list[dict[str, Any]], seed: int = 0,
+                   time_budget: float | None = None) -> list[dict[str, Any]]:
+    return sweep_records((to_record(ticket) for ticket in tickets), combinations, seed, time_budget)
+
+
+def sort_new_tickets(delivery_groups: list[DeliveryGroup], new_tickets: list[Ticket]) \
+        -> tuple[list[Assignment], list[TicketRecord]]:
+    """
+    Adds tickets redeemed after a sort was committed to its delivery groups (without moving printed tickets).
+    :return: where each new ticket was sorted into and the tickets which couldn't be delivered
+    """
+    committed_groups = {
+        delivery_group.code: (
+            delivery_group.is_serenading_group,
+            [(ticket.recipient_id, ticket.period, getattr(ticket, f"p{ticket.period}"))
+             for ticket in delivery_group.tickets.all() if ticket.period is not None]
+        )
+        for delivery_group in delivery_groups
+    }
+    next_positions = {delivery_group.code: delivery_group.next_position for delivery_group in delivery_groups}
+    return sort_new_records(committed_groups, (to_record(ticket) for ticket in new_tickets), next_positions)
+
+
+"""Background Sorting"""
+
+
+def start_sort_worker():
+    """
+    Starts a worker in a separate process, which sorts every queued Sort Tickets Request then exits.
+    Does nothing to requests which another worker has already started.
+    The chosen classrooms are cached in files (CLASSROOM_CACHE), so the next worker can still reuse them.
+    """
+    subprocess.Popen([sys.executable, str(BASE_DIR / "manage.py"), "run_sort_worker", "--once"],
+                     cwd=BASE_DIR, start_new_session=True,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def claim_next_request() -> SortTicketsRequest | None:
+    """
+    Marks the oldest queued request (or request left by a worker which died) as sorting and returns it
+    (None if there are none)
+    """
+    while True:
+        obj = SortTicketsRequest.objects.filter(
+            Q(status='queued') | Q(is_stale(), status__in=('sorting', 'persisting'))
+        ).order_by('date', 'pk').first()
+        if obj is None:
+            return None
+        # Only succeeds for one worker if several try to claim the same request
+        now = timezone.now()
+        if SortTicketsRequest.objects.filter(pk=obj.pk, status=obj.status, heartbeat=obj.heartbeat).update(
+                status='sorting', heartbeat=now):
+            obj.status = 'sorting'
+            obj.heartbeat = now
+            return obj
+
+
+def run_request(obj: SortTicketsRequest):
+    """Sorts the tickets with the settings of obj and saves the delivery groups (or the error)"""
+    # Shows other workers that obj is still being sorted, so they only claim it again if this process dies
+    with heartbeat(SortTicketsRequest.objects.filter(pk=obj.pk)):
+        sort_request(obj)
+
+
+def sort_request(obj: SortTicketsRequest):
+    def on_phase(name: str):
+        obj.progress.append(name)
+        SortTicketsRequest.objects.filter(pk=obj.pk).update(progress=obj.progress)
+
+    try:
+        obj.progress = []
+        assignments, report, profile = sort_tickets(
+            Ticket.objects.all(), obj.num_serenaders, obj.num_non_serenaders,
+            max_serenades_per_class=obj.max_serenades_per_class,
+            max_non_serenades_per_serenading_class=obj.max_non_serenades_per_serenading_class,
+            extra_special_serenades=obj.extra_special_serenades,
+            enforce_distribution=obj.enforce_distribution,
+            split_components=obj.split_components,
+            improve_time_budget=obj.improve_time_budget,
+            optimise_time_limit=obj.optimise_time_limit,
+            measure_memory=True,
+            num_starts=obj.num_starts,
+            time_budget=obj.time_budget,
+            engine=obj.engine,
+            seed=obj.seed,
+            on_phase=on_phase
+        )
+
+        SortTicketsRequest.objects.filter(pk=obj.pk).update(status='persisting')
+        save_sort(obj, assignments, report, profile)
+    except Exception:
+        obj.status = 'failed'
+        obj.error = traceback.format_exc()
+        obj.save(update_fields=['status', 'error'])
+
+
+@transaction.atomic
+def save_sort(obj: SortTicketsRequest, assignments: list[Assignment], report: SortReport, profile: SortProfile):
+    """Saves the result of a sort in one transaction"""
+    obj.report = report.to_json()
+    obj.profile = profile.to_json()
+    obj.status = 'done'
+    obj.save(update_fields=['report', 'profile', 'status'])
+
+    delivery_groups = DeliveryGroup.objects.bulk_create(
+        DeliveryGroup(
+            code=group["name"],
+            is_serenading_group=is_serenading,
+            sort_request=obj
+        )
+        for is_serenading, groups in ((True, report.serenading_groups), (False, report.non_serenading_groups))
+        for group in groups
+    )
+    save_assignments(assignments, {delivery_group.code: delivery_group for delivery_group in delivery_groups})
+
+
+def save_assignments(assignments: list[Assignment], delivery_groups: dict[str, DeliveryGroup]):
+    """Saves where each ticket was sorted into (delivery_groups is by code)"""
+    Ticket.objects.bulk_update(
+        (Ticket(pk=assignment.pk, **{field: getattr(assignment, field) for field in ASSIGNMENT_FIELDS})
+         for assignment in assignments),
+        fields=ASSIGNMENT_FIELDS,
+        batch_size=BULK_BATCH_SIZE
+    )
+
+    DeliveryGroup.tickets.through.objects.bulk_create(
+        (DeliveryGroup.tickets.through(deliverygroup_id=delivery_groups[assignment.group].pk,
+                                       ticket_id=assignment.pk)
+         for assignment in assignments),
+        batch_size=BULK_BATCH_SIZE
+    )
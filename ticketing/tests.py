@@ -1,3 +1,551 @@
-from django.test import TestCase
+import io
+import os
+import random
+import itertools
+import tempfile
+from unittest import mock
+from types import SimpleNamespace
+import numpy as np
+from datetime import timedelta
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from django.core.exceptions import ValidationError
+from pypdf import PdfReader, PdfWriter, PageObject
+from pypdf.generic import ArrayObject, NameObject
+from reportlab.pdfgen import canvas
+from vdaywebsite.settings import NUM_TICKETS_PER_PDF
+from .models import Ticket, SortTicketsRequest, DeliveryGroup, PrintJob
+from .forms import IntegerRangeField, SortSweepForm
+from .sorting import claim_next_request
+from .printing import claim_next_job, claim_next_message, queue_parts, run_job, run_worker, start_print_workers
+from .ticket_printer import TicketsToPDF
+from .ticket_sorter import TicketSorter, ArraySorter, IncrementalSorter, TicketToSort, TicketList, TicketSet, \
+    TicketRecord, Classroom, ClassroomList, ClassroomCache, PeriodGroupList, EliminationQueue, Assignment, \
+    load_tickets, sort_records
 
-# Create your tests here.
+
+def make_classroom(name: str, period: int, item_types: list[str]) -> Classroom:
+    classroom = Classroom(name, period)
+    for pk, item_type in enumerate(item_types):
+        classroom.tickets.add(TicketToSort(pk, f"Person {pk}", item_type, "A101", "A102", "A103", "A104", period))
+    return classroom
+
+
+def make_tickets(num_tickets: int, seed: int = 0) -> list[TicketToSort]:
+    """Tickets for a made up school, where each recipient has four of its classrooms"""
+    rng = random.Random(seed)
+    rooms = [f"{block}{room}" for block in "ABCD" for room in range(101, 111)]
+    timetables = [rng.sample(rooms, 4) for _ in range(num_tickets // 3)]
+    item_types = rng.choices(["Special Serenade", "Serenade", "Rose", "Chocolate"], weights=[1, 4, 10, 5],
+                             k=num_tickets)
+
+    tickets = []
+    for pk, item_type in enumerate(item_types):
+        recipient = rng.randrange(len(timetables))
+        ss_period = rng.randint(1, 4) if item_type == "Special Serenade" else None
+        tickets.append(TicketToSort(pk, f"Person {recipient}", item_type, *timetables[recipient], ss_period))
+    return tickets
+
+
+class EliminationQueueTests(SimpleTestCase):
+    def test_serenades_then_smallest_first(self):
+        small = make_classroom("A101", 1, ["Rose"])
+        large = make_classroom("A102", 1, ["Rose", "Rose"])
+        serenade = make_classroom("A103", 1, ["Serenade", "Rose", "Rose"])
+        queue = EliminationQueue(ClassroomList([large, small, serenade]))
+
+        self.assertEqual([queue.pop(1) for _ in range(3)], [serenade, small, large])
+        self.assertEqual(queue.num_remaining[1], 0)
+
+    def test_update_re_keys(self):
+        first = make_classroom("A101", 2, ["Rose"])
+        second = make_classroom("A102", 2, ["Rose", "Rose"])
+        queue = EliminationQueue(ClassroomList([first, second]))
+
+        first.tickets.add(TicketToSort(10, "Person 10", "Rose", "A101", "A101", "A101", "A101"))
+        first.tickets.add(TicketToSort(11, "Person 11", "Rose", "A101", "A101", "A101", "A101"))
+        queue.update(first)
+        self.assertIs(queue.pop(2), second)
+
+    def test_same_output_for_a_seed(self):
+        classrooms = ClassroomList(make_classroom(f"A1{index:02}", 3, ["Rose"]) for index in range(20))
+        orders = []
+        for _ in range(2):
+            random.seed(4)
+            queue = EliminationQueue(classrooms)
+            orders.append([queue.pop(3) for _ in classrooms])
+        self.assertEqual(orders[0], orders[1])
+        self.assertNotEqual(orders[0], list(classrooms))
+
+
+class ExactOptimiserTests(SimpleTestCase):
+    def test_optimises_a_small_sort(self):
+        random.seed(0)
+        tickets = make_tickets(100)
+        ticket_sorter = TicketSorter(tickets, 3, 3,
+                                     max_serenades_per_class=2,
+                                     max_non_serenades_per_serenading_class=3,
+                                     extra_special_serenades=True,
+                                     enforce_distribution=True,
+                                     optimise_time_limit=30)
+        result = ticket_sorter.report.optimiser
+
+        self.assertEqual(result["gap"], 0)
+        self.assertLess(result["visits_after"], result["visits_before"])
+        self.assertEqual(result["visits_after"], result["lower_bound"])
+        self.assertEqual(sum(1 for classroom in ticket_sorter.classrooms if len(classroom.tickets) > 0),
+                         result["visits_after"])
+        for classroom in ticket_sorter.classrooms:
+            self.assertLessEqual(classroom.tickets.num_serenades, 2)
+        self.assertEqual(sum(len(classroom.tickets) for classroom in ticket_sorter.classrooms), len(tickets))
+
+
+    def test_reports_when_nothing_was_found(self):
+        random.seed(0)
+        timed_out = SimpleNamespace(message="Time limit reached.", x=None, fun=None, mip_dual_bound=None)
+        with mock.patch("scipy.optimize.milp", return_value=timed_out):
+            ticket_sorter = TicketSorter(make_tickets(100), 3, 3,
+                                         max_serenades_per_class=2,
+                                         max_non_serenades_per_serenading_class=3,
+                                         extra_special_serenades=True,
+                                         enforce_distribution=True,
+                                         optimise_time_limit=1)
+        result = ticket_sorter.report.optimiser
+
+        self.assertFalse(result["found_solution"])
+        self.assertEqual(result["visits_after"], result["visits_before"])
+        self.assertIn(f"No solution found (visits unchanged at {result['visits_before']})", str(ticket_sorter.report))
+        self.assertIn("No lower bound found", str(ticket_sorter.report))
+
+
+class ArraySorterTests(SimpleTestCase):
+    def test_rank_within_groups(self):
+        self.assertEqual(ArraySorter.rank_within_groups(np.array([5, 5, 7, 9, 9, 9])).tolist(), [0, 1, 0, 0, 1, 2])
+        self.assertEqual(ArraySorter.rank_within_groups(np.array([], dtype=np.int32)).tolist(), [])
+
+    def test_special_serenades(self):
+        tickets = [
+            TicketToSort(1, "Alice", "Special Serenade", "A101", "A102", "A103", "A104", ss_period=2),
+            # can go elsewhere, so is kept away from the special serenade
+            TicketToSort(2, "Alice", "Serenade", "A101", "A102", "A103", "A104"),
+            # can't go anywhere else, so the special serenade gets a special classroom
+            TicketToSort(3, "Bob", "Special Serenade", "A201", "A202", "A203", "A204", ss_period=3),
+            TicketToSort(4, "Carol", "Serenade", "", "", "A203", ""),
+            # not a classroom, so is sorted like a serenade (as TicketSorter does)
+            TicketToSort(5, "Dave", "Special Serenade", "A301", "", "A303", "A304", ss_period=2),
+        ]
+        with self.assertLogs("ticketing.ticket_sorter", "WARNING") as logs:
+            array_sorter = ArraySorter(tickets, enforce_distribution=True)
+        self.assertEqual(logs.output, ["WARNING:ticketing.ticket_sorter:Classroom name unknown: 2-"])
+        choices = array_sorter.choices
+
+        self.assertEqual(choices[0], (2, False))
+        self.assertNotEqual(choices[1][0], 2)
+        self.assertEqual(choices[2], (3, True))
+        self.assertEqual(choices[3], (3, False))
+        self.assertIn(choices[4], [(1, False), (3, False), (4, False)])
+
+    def test_sorts_every_ticket(self):
+        random.seed(0)
+        tickets = make_tickets(300)
+        ticket_sorter = TicketSorter(tickets, 10, 10,
+                                     max_serenades_per_class=2,
+                                     max_non_serenades_per_serenading_class=3,
+                                     extra_special_serenades=True,
+                                     enforce_distribution=True,
+                                     use_arrays=True)
+
+        self.assertEqual(ticket_sorter.report.undelivered_tickets, [])
+        self.assertEqual(sum(len(classroom.tickets) for classroom in ticket_sorter.classrooms), len(tickets))
+        for ticket in tickets:
+            self.assertIn(ticket.chosen_classroom, ticket_sorter.classrooms)
+            if ticket.item_type == "Special Serenade":
+                self.assertEqual(ticket.chosen_period, ticket.ss_period)
+
+    def test_numpy_engine_is_repeatable(self):
+        records = [TicketRecord(ticket.pk, ticket.recipient_id, ticket.item_type, *ticket.classrooms, ticket.ss_period)
+                   for ticket in make_tickets(300)]
+        first = sort_records(records, 10, 10, 2, 3, True, True, engine="numpy", seed=5, use_cache=False)
+        second = sort_records(records, 10, 10, 2, 3, True, True, engine="numpy", seed=5, use_cache=False)
+        self.assertEqual(first[0], second[0])
+
+
+class PeriodGroupListTests(SimpleTestCase):
+    def test_partition(self):
+        self.assertEqual(PeriodGroupList.partition([1, 2, 3, 4, 5], 2), [0, 3, 5])
+        self.assertEqual(PeriodGroupList.partition([5, 1, 1, 1, 1, 1], 3), [0, 1, 3, 6])
+        # not enough loads for every group
+        self.assertEqual(PeriodGroupList.partition([3], 2), [0, 0, 1])
+
+    def test_partition_minimises_the_largest_group(self):
+        random.seed(0)
+        for _ in range(50):
+            loads = [random.randint(0, 9) for _ in range(random.randint(1, 8))]
+            num_groups = random.randint(1, 4)
+            with self.subTest(loads=loads, num_groups=num_groups):
+                boundaries = PeriodGroupList.partition(loads, num_groups)
+                self.assertEqual(len(boundaries), num_groups + 1)
+                self.assertEqual((boundaries[0], boundaries[-1]), (0, len(loads)))
+                self.assertEqual(boundaries, sorted(boundaries))
+                if len(loads) >= num_groups:
+                    self.assertEqual(len(set(boundaries)), num_groups + 1)
+
+                # every way of splitting the loads into num_groups groups
+                best = min(
+                    max(sum(loads[start:end]) for start, end in zip((0, *splits), (*splits, len(loads))))
+                    for splits in itertools.combinations_with_replacement(range(len(loads) + 1), num_groups - 1)
+                )
+                self.assertEqual(max(sum(loads[start:end]) for start, end in zip(boundaries, boundaries[1:])),
+                                 best)
+
+
+class TicketSetTests(SimpleTestCase):
+    def setUp(self):
+        self.tickets = [TicketToSort(pk, f"Person {pk}", item_type, "A101", "A102", "A103", "A104", 1)
+                        for pk, item_type in enumerate(["Rose", "Serenade", "Chocolate", "Special Serenade"])]
+
+    def test_keeps_insertion_order_without_duplicates(self):
+        rose, serenade, chocolate, _ = self.tickets
+        ticket_set = TicketSet([chocolate, rose])
+        ticket_set.add(serenade)
+        ticket_set.append(rose)
+
+        self.assertEqual(list(ticket_set), [chocolate, rose, serenade])
+        self.assertEqual(len(ticket_set), 3)
+        self.assertEqual(ticket_set[1], rose)
+        self.assertIsInstance(ticket_set[:2], TicketList)
+        self.assertEqual(ticket_set[:2], [chocolate, rose])
+
+    def test_item_counts(self):
+        rose, serenade, chocolate, special_serenade = self.tickets
+        ticket_set = TicketSet(self.tickets)
+        self.assertEqual((ticket_set.num_serenades, ticket_set.num_non_serenades), (2, 2))
+
+        ticket_set.discard(serenade)
+        ticket_set.discard(serenade)
+        ticket_set.remove(special_serenade)
+        self.assertFalse(ticket_set.has_serenades)
+        self.assertEqual(ticket_set.num_items(("Rose",)), 1)
+        self.assertEqual(ticket_set.filter_by_item_type(("Chocolate",)).item_counts["Chocolate"], 1)
+        with self.assertRaises(ValueError):
+            ticket_set.remove(serenade)
+
+    def test_copy_and_sort(self):
+        ticket_set = TicketSet(self.tickets)
+        copy = ticket_set.copy()
+        copy.discard(self.tickets[0])
+        self.assertIn(self.tickets[0], ticket_set)
+
+        ticket_set.sort_by_item_type()
+        self.assertEqual([ticket.item_type for ticket in ticket_set],
+                         ["Chocolate", "Rose", "Serenade", "Special Serenade"])
+
+
+class IncrementalSorterTests(SimpleTestCase):
+    def test_adds_tickets_without_moving_committed_ones(self):
+        committed_groups = {
+            "S1": (True, [("Alice", 2, "A101")]),
+            "N1": (False, [("Bob", 1, "B101")]),
+            "N2": (False, [("Bob", 2, "B102"), ("Eve", 2, "B102")]),
+        }
+        tickets = [
+            # joins the serenading group already visiting A101 in period 2
+            TicketToSort(1, "Carol", "Serenade", "C101", "A101", "C103", "C104"),
+            # joins the visit to B101 in period 1
+            TicketToSort(2, "Dave", "Rose", "B101", "D102", "D103", "D104"),
+            # starts a visit in the least loaded non-serenading group, in a period Dave has no tickets in
+            TicketToSort(3, "Dave", "Chocolate", "E101", "E102", "E103", "E104"),
+            # has no classrooms
+            TicketToSort(4, "Frank", "Rose", "", "", "", ""),
+        ]
+        incremental_sorter = IncrementalSorter(committed_groups, tickets)
+
+        output = {name: [(ticket.pk, ticket.chosen_period, ticket.chosen_classroom.original_name)
+                         for ticket in group_tickets]
+                  for name, group_tickets in incremental_sorter.output.items()}
+        self.assertEqual(output, {"S1": [(1, 2, "A101")], "N1": [(2, 1, "B101"), (3, 2, "E102")], "N2": []})
+        self.assertEqual([ticket.pk for ticket in incremental_sorter.undelivered_tickets], [4])
+
+    def test_serenades_only_go_to_serenading_groups(self):
+        committed_groups = {"S1": (True, []), "N1": (False, [("Alice", 1, "A101")])}
+        incremental_sorter = IncrementalSorter(
+            committed_groups, [TicketToSort(1, "Bob", "Serenade", "A101", "", "", "")])
+
+        self.assertEqual(incremental_sorter.output["N1"], [])
+        self.assertEqual([ticket.pk for ticket in incremental_sorter.output["S1"]], [1])
+
+
+class ClassroomCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_shared_between_caches_with_the_same_directory(self):
+        ClassroomCache(directory=self.directory).set("key", ([("A101", 1, False, [0, 1])], None, []))
+
+        # e.g. in another process
+        self.assertEqual(ClassroomCache(directory=self.directory).get("key"), [[["A101", 1, False, [0, 1]]], None, []])
+        self.assertIsNone(ClassroomCache(directory=self.directory).get("other key"))
+
+    def test_removes_least_recently_used(self):
+        cache = ClassroomCache(max_entries=2, directory=self.directory)
+        cache.set("first", 1)
+        cache.set("second", 2)
+        os.utime(os.path.join(self.directory, "first.json"), (0, 0))
+        os.utime(os.path.join(self.directory, "second.json"), (1, 1))
+        ClassroomCache(directory=self.directory).get("first")
+        cache.set("third", 3)
+
+        other_cache = ClassroomCache(directory=self.directory)
+        self.assertEqual(len(other_cache), 2)
+        self.assertEqual(other_cache.get("first"), 1)
+        self.assertIsNone(other_cache.get("second"))
+
+    def test_sort_records_reuses_classrooms_from_directory(self):
+        records = [TicketRecord(ticket.pk, ticket.recipient_id, ticket.item_type, *ticket.classrooms, ticket.ss_period)
+                   for ticket in load_tickets()]
+        first = sort_records(records, 10, 10, 2, 3, True, True, seed=5,
+                             cache=ClassroomCache(directory=self.directory))
+        second = sort_records(records, 10, 10, 2, 3, True, True, seed=5,
+                              cache=ClassroomCache(directory=self.directory))
+
+        self.assertEqual(first[0], second[0])
+        self.assertEqual([phase["name"] for phase in second[2].phases],
+                         ["restore_chosen_classrooms", "assign_tickets_to_groups", "report"])
+
+        # sorts without a seed are random, so they aren't cached
+        cache = ClassroomCache(directory=self.directory)
+        sort_records(records, 10, 10, 2, 3, True, True, cache=cache)
+        self.assertEqual(len(cache), 1)
+
+
+class SortSweepFormTests(SimpleTestCase):
+    def test_integer_ranges(self):
+        field = IntegerRangeField(max_value=20)
+        self.assertEqual(field.clean("5, 8-10, 9"), [5, 8, 9, 10])
+        for value in ("10-8", "5, x", "21"):
+            with self.subTest(value=value):
+                with self.assertRaises(ValidationError):
+                    field.clean(value)
+
+    def test_time_budget_is_required_and_bounded(self):
+        data = {"num_serenaders": "10", "num_non_serenaders": "10", "max_serenades_per_class": "5",
+                "max_non_serenades_per_serenading_class": "10", "extra_special_serenades": ["True"],
+                "enforce_distribution": ["True"]}
+        self.assertTrue(SortSweepForm({**data, "time_budget": "60"}).is_valid())
+        self.assertIn("time_budget", SortSweepForm(data).errors)
+        self.assertIn("time_budget", SortSweepForm({**data, "time_budget": "1000"}).errors)
+
+class ClaimNextRequestTests(TestCase):
+    def test_claims_queued_requests_in_order(self):
+        first = SortTicketsRequest.objects.create()
+        second = SortTicketsRequest.objects.create()
+
+        self.assertEqual(claim_next_request(), first)
+        self.assertEqual(claim_next_request(), second)
+        self.assertIsNone(claim_next_request())
+        self.assertIsNotNone(SortTicketsRequest.objects.get(pk=first.pk).heartbeat)
+
+    def test_reclaims_requests_left_by_a_worker_which_died(self):
+        alive = SortTicketsRequest.objects.create(status='sorting', heartbeat=timezone.now())
+        dead = SortTicketsRequest.objects.create(status='persisting',
+                                                 heartbeat=timezone.now() - timedelta(minutes=5))
+
+        claimed = claim_next_request()
+        self.assertEqual(claimed, dead)
+        self.assertEqual(SortTicketsRequest.objects.get(pk=dead.pk).status, 'sorting')
+        self.assertGreater(claimed.heartbeat, dead.heartbeat)
+        self.assertIsNone(claim_next_request())
+        self.assertEqual(SortTicketsRequest.objects.get(pk=alive.pk).heartbeat, alive.heartbeat)
+
+
+class DeliveryGroupTests(TestCase):
+    def setUp(self):
+        self.delivery_group = DeliveryGroup.objects.create(code="S1", is_serenading_group=True,
+                                                           sort_request=SortTicketsRequest.objects.create())
+
+    def add_tickets(self, positions: list[int]) -> list[Ticket]:
+        tickets = [Ticket.objects.create(recipient_id=f"Person {position}", position=position)
+                   for position in positions]
+        self.delivery_group.tickets.add(*tickets)
+        return tickets
+
+    def test_parts(self):
+        self.assertEqual(self.delivery_group.num_parts, 0)
+        self.assertEqual(self.delivery_group.next_position, 0)
+
+        # more tickets than sort_order used to hold positions for
+        first, second, last = self.add_tickets([1, 0, 20050])
+        self.assertEqual(self.delivery_group.num_parts, 20050 // NUM_TICKETS_PER_PDF + 1)
+        self.assertEqual(self.delivery_group.get_part(1), [second, first])
+        self.assertEqual(self.delivery_group.get_part(2), [])
+        self.assertEqual(self.delivery_group.get_part(self.delivery_group.num_parts), [last])
+
+    def test_next_position_skips_printed_parts(self):
+        self.add_tickets([0, 1])
+        self.assertEqual(self.delivery_group.next_position, 2)
+
+        self.delivery_group.parts_printed = [1]
+        self.assertEqual(self.delivery_group.next_position, NUM_TICKETS_PER_PDF)
+
+        # positions in a printed part aren't reused after its last tickets are removed
+        self.delivery_group.parts_printed = [1, 2]
+        self.assertEqual(self.delivery_group.next_position, 2 * NUM_TICKETS_PER_PDF)
+
+    def test_sort_order(self):
+        def sort_order(group: str, position: int) -> int:
+            return Assignment(0, group, position, 1, "A101", "A101", "A101", "A101", "A101").sort_order
+
+        self.assertLess(sort_order("N11", 0), sort_order("S1", 0))
+        self.assertLess(sort_order("S1", 10000), sort_order("S2", 0))
+        self.assertLess(sort_order("S2", 0), sort_order("S10", 0))
+        self.assertLess(sort_order("S100", Assignment.MAX_POSITIONS - 1), 2 ** 31)
+
+
+class ClaimNextJobTests(TestCase):
+    def setUp(self):
+        self.delivery_group = DeliveryGroup.objects.create(code="N1", is_serenading_group=False,
+                                                           sort_request=SortTicketsRequest.objects.create())
+
+    def test_reclaims_parts_left_by_a_worker_which_died(self):
+        long_ago = timezone.now() - timedelta(minutes=5)
+        PrintJob.objects.create(delivery_group=self.delivery_group, part=1, status='printing',
+                                attempts=1, heartbeat=timezone.now())
+        dead = PrintJob.objects.create(delivery_group=self.delivery_group, part=2, status='printing',
+                                       attempts=1, heartbeat=long_ago)
+        out_of_attempts = PrintJob.objects.create(delivery_group=self.delivery_group, part=3, status='printing',
+                                                  attempts=PrintJob.MAX_ATTEMPTS, heartbeat=long_ago)
+
+        claimed = claim_next_job()
+        self.assertEqual(claimed, dead)
+        self.assertEqual(claimed.attempts, 2)
+        self.assertGreater(claimed.heartbeat, long_ago)
+        self.assertIsNone(claim_next_job())
+        out_of_attempts.refresh_from_db()
+        self.assertEqual(out_of_attempts.status, 'failed')
+
+
+class PlaceFormsTests(SimpleTestCase):
+    @staticmethod
+    def make_page(text: str) -> PageObject:
+        stream = io.BytesIO()
+        pdf_canvas = canvas.Canvas(stream, pagesize=(200, 200))
+        pdf_canvas.drawString(10, 10, text)
+        pdf_canvas.save()
+        return PdfReader(stream).pages[0]
+
+    @staticmethod
+    def write(pdf: PdfWriter) -> PageObject:
+        stream = io.BytesIO()
+        pdf.write(stream)
+        return PdfReader(stream).pages[0]
+
+    def test_places_forms(self):
+        pdf = PdfWriter()
+        page = pdf.add_page(self.make_page("background"))
+        blank_page = PageObject.create_blank_page(width=200, height=200)
+        TicketsToPDF.place_forms(pdf, page, [(self.make_page("message"), 50, 50, (0, 0, 100, 100)),
+                                             (blank_page, 0, 0, blank_page.mediabox)])
+
+        page = self.write(pdf)
+        self.assertEqual(list(page["/Resources"]["/XObject"]), ["/Form0"])
+        self.assertEqual(page.extract_text().split(), ["background", "message"])
+
+    def test_merges_forms_with_several_content_streams(self):
+        pdf = PdfWriter()
+        page = pdf.add_page(PageObject.create_blank_page(width=200, height=200))
+        form_page = self.make_page("message")
+        form_page[NameObject("/Contents")] = ArrayObject([form_page["/Contents"]])
+        TicketsToPDF.place_forms(pdf, page, [(form_page, 50, 50, (0, 0, 100, 100))])
+
+        self.assertEqual(self.write(pdf).extract_text().split(), ["message"])
+
+
+class PrintJobTests(TestCase):
+    def setUp(self):
+        self.delivery_group = DeliveryGroup.objects.create(code="N1", is_serenading_group=False,
+                                                           sort_request=SortTicketsRequest.objects.create())
+        patcher = mock.patch("ticketing.printing.os.makedirs")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_claims_queued_parts_in_order(self):
+        queue_parts([(self.delivery_group, 2), (self.delivery_group, 1)])
+
+        first, second = claim_next_job(), claim_next_job()
+        self.assertEqual((first.part, first.status, first.attempts), (2, 'printing', 1))
+        self.assertEqual(second.part, 1)
+        self.assertIsNone(claim_next_job())
+
+    def test_retries_until_out_of_attempts(self):
+        queue_parts([(self.delivery_group, 1)])
+        with mock.patch("ticketing.printing.TicketsToPDF", side_effect=RuntimeError("out of paper")):
+            for attempt in range(1, PrintJob.MAX_ATTEMPTS + 1):
+                print_job = claim_next_job()
+                self.assertEqual(print_job.attempts, attempt)
+                run_job(print_job)
+
+        print_job.refresh_from_db()
+        self.assertEqual(print_job.status, 'failed')
+        self.assertIn("out of paper", print_job.error)
+        self.assertIsNone(claim_next_job())
+
+        # queueing a failed part again prints it again
+        queue_parts([(self.delivery_group, 1)])
+        with mock.patch("ticketing.printing.TicketsToPDF") as tickets_to_pdf:
+            print_job = claim_next_job()
+            self.assertEqual(print_job.attempts, 1)
+            run_job(print_job)
+        tickets_to_pdf.assert_called_once()
+        print_job.refresh_from_db()
+        self.assertEqual((print_job.status, print_job.error), ('done', ''))
+        self.delivery_group.refresh_from_db()
+        self.assertEqual(self.delivery_group.parts_printed, [1])
+
+    def test_doesnt_queue_parts_twice(self):
+        queue_parts([(self.delivery_group, 1)])
+        claim_next_job()
+        queue_parts([(self.delivery_group, 1)])
+
+        self.assertEqual(PrintJob.objects.get().status, 'printing')
+        self.assertIsNone(claim_next_job())
+
+    def test_queueing_again_updates_the_settings_of_queued_parts(self):
+        queue_parts([(self.delivery_group, 1), (self.delivery_group, 2)])
+        claim_next_job()
+        queue_parts([(self.delivery_group, 1), (self.delivery_group, 2)], padding=5, enforce_boundaries=True)
+
+        printing, queued = PrintJob.objects.order_by('part')
+        self.assertEqual((printing.padding, printing.enforce_boundaries), (0, False))
+        self.assertEqual((queued.padding, queued.enforce_boundaries), (5, True))
+
+    def test_only_starts_workers_if_none_are_printing(self):
+        queue_parts([(self.delivery_group, 1)])
+        with mock.patch("ticketing.printing.subprocess.Popen") as popen:
+            start_print_workers()
+            claim_next_job()
+            start_print_workers()
+            # the worker which claimed the part died
+            PrintJob.objects.update(heartbeat=timezone.now() - timedelta(minutes=5))
+            start_print_workers()
+        self.assertEqual(popen.call_count, 2)
+
+    def test_renders_messages_when_there_is_nothing_to_print(self):
+        rendered, failed = Ticket.objects.create(recipient_id="Alice"), Ticket.objects.create(recipient_id="Bob")
+        queue_parts([(self.delivery_group, 1)])
+        calls = []
+
+        def get_message_pdf(ticket_pk, padding, enforce_boundaries):
+            calls.append(ticket_pk)
+            if ticket_pk == failed.pk:
+                raise FileNotFoundError(ticket_pk)
+
+        with mock.patch("ticketing.printing.TicketsToPDF", side_effect=lambda *args, **kwargs: calls.append("print")), \
+                mock.patch("ticketing.printing.get_message_pdf", side_effect=get_message_pdf):
+            run_worker(once=True)
+
+        self.assertEqual(calls, ["print", rendered.pk, failed.pk])
+        self.assertEqual(Ticket.objects.get(pk=rendered.pk).message_status, 'done')
+        self.assertEqual(Ticket.objects.get(pk=failed.pk).message_status, 'failed')
+        self.assertIsNone(claim_next_message())
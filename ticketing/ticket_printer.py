@@ -1,6 +1,10 @@
 import cairosvg
 import io
+import os
 import random
+import hashlib
+import functools
+import logging
 from lxml import etree
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm
@@ -10,8 +14,11 @@ from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
 from reportlab.platypus.tables import Table, TableStyle
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.graphics import renderPDF
 from svglib.svglib import svg2rlg
-from pypdf import PdfReader, PdfWriter, Transformation
+from pypdf import PdfReader, PdfWriter, PageObject, Transformation
+from pypdf.generic import ArrayObject, DecodedStreamObject, DictionaryObject, NameObject, NullObject, \
+    RectangleObject, StreamObject
 
 
 if __name__ == "__main__":
@@ -21,8 +28,110 @@ if __name__ == "__main__":
 else:
     from .constants import DirectoryLocations, STUDENTS, PICKUP_LINES, TEMPLATES, FONTS
 
+logger = logging.getLogger(__name__)
+
+
+"""Assets (loaded once per process and shared by every TicketsToPDF)"""
+# The item images with their scales
+ITEM_IMAGES = {
+    "Chocolate": ("chocolate.svg", 0.033),
+    "Rose": ("rose.svg", 0.043),
+    "Serenade": ("serenade.svg", 0.025),
+    "Special Serenade": ("special_serenade.svg", 0.09),
+}
+
+
+@functools.cache
+def register_font(font: str):
+    pdfmetrics.registerFont(TTFont(font, f'{DirectoryLocations.STATIC}/fonts/{FONTS[font]["filename"]}.ttf'))
+
+
+@functools.cache
+def get_template(template_name: str, scale_factor: float):
+    """Templates are only loaded when a ticket uses them (once for each scale, i.e. padding)"""
+    template = svg2rlg(f"{DirectoryLocations.STATIC}/templates/{TEMPLATES[template_name]['filename']}")
+    template.setProperties({"hAlign": "CENTER", "vAlign": "MIDDLE", "renderScale": scale_factor})
+    return template
+
+
+@functools.cache
+def get_item_image(item_type: str):
+    filename, scale = ITEM_IMAGES[item_type]
+    image = svg2rlg(f'{DirectoryLocations.STATIC}/item_types/{filename}')
+    image.setProperties({"renderScale": scale})
+    return image
+
+
+@functools.cache
+def get_delivery_info_styles(padding: int) -> tuple[ParagraphStyle, ParagraphStyle, ParagraphStyle, ParagraphStyle]:
+    """The styles of the back of a ticket: default, centre aligned, centre aligned (small) and large"""
+    stylesheet = getSampleStyleSheet()
+    default_style = ParagraphStyle(name="Default", parent=stylesheet['Normal'], fontSize=10, leading=11,
+                                   fontName="Chasing Hearts")
+    centre_align = ParagraphStyle(name="Center", parent=default_style, alignment=1)
+    centre_align_small = ParagraphStyle(name="Center Small", parent=default_style, alignment=1, fontSize=8,
+                                        leading=9)
+    large_style = ParagraphStyle(name="Large", parent=default_style, alignment=1,
+                                 fontSize=max(12, round(16 - padding / 3)),
+                                 leading=max(13, round(18 - padding / 3)))
+    return default_style, centre_align, centre_align_small, large_style
+
+
+def warm_asset_cache(paddings: tuple[int, ...] = (0,)):
+    """Loads every asset ahead of time (e.g. before forking print workers, so they share them)"""
+    for font in FONTS:
+        register_font(font)
+    for item_type in ITEM_IMAGES:
+        get_item_image(item_type)
+    for padding in paddings:
+        get_delivery_info_styles(padding)
+        scale_factor = TicketsToPDF.get_scale_factor(padding)
+        for template_name in TEMPLATES:
+            get_template(template_name, scale_factor)
+
+
+"""Messages (rendered by the print worker after a ticket is redeemed, so printing only has to place them)"""
+
+
+def get_message_path(svg: bytes, padding: int = 0, enforce_boundaries: bool = False) -> str:
+    """Rendered messages are cached by the content of the message (padding only changes enforced boundaries)"""
+    digest = hashlib.sha256(svg).hexdigest()
+    if enforce_boundaries:
+        return f"{DirectoryLocations.RENDERED_MESSAGES}/{digest}_{padding}.pdf"
+    return f"{DirectoryLocations.RENDERED_MESSAGES}/{digest}.pdf"
+
+
+def get_message_pdf(ticket_pk: int, padding: int = 0, enforce_boundaries: bool = False) -> bytes | None:
+    """The message of a ticket as a PDF the size of a cell (None if it's blank), rendering it if it isn't cached"""
+    with open(f"{DirectoryLocations.REDEEMED_TICKETS}/{ticket_pk}.svg", 'rb') as file:
+        svg = file.read()
+
+    message_path = get_message_path(svg, padding, enforce_boundaries)
+    if os.path.exists(message_path):
+        with open(message_path, 'rb') as file:
+            return file.read() or None      # blank messages are cached as empty files
+
+    message_pdf = TicketsToPDF.render_message(svg, padding, enforce_boundaries)
+    if message_pdf is None:
+        logger.warning("Ticket %s is blank.", ticket_pk)
+
+    # several processes can render the same message, so never leave a half-written file where they'd read it
+    temp_path = f"{message_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(message_pdf or b"")
+    os.replace(temp_path, message_path)
+    return message_pdf
+
 
 class TicketsToPDF:
+    # The layout of the pages (class attributes so that templates can be scaled before printing)
+    NUM_COLUMNS = 2
+    NUM_ROWS = 5
+    MARGIN = 1 * cm                 # an additional 0.5cm will be added to the table
+    # dimensions of canvas from signature pad in pixels
+    CANVAS_WIDTH = 602
+    CANVAS_HEIGHT = 358
+
     def __init__(self, tickets, pdf_output_path: str, pdf_name: str, starting_index: int = 0,
                  padding: int = 0, enforce_boundaries: bool = False):
         self.tickets = tickets
@@ -35,68 +144,37 @@ class TicketsToPDF:
         self.RATIO = 4                      # multiplies DPI by this ratio. only used if vector messages is false
 
         self.background_pdf = None
-        self.foreground_pdf = None          # only if vector messages is false
-        self.message_pdfs = []              # only if vector messages is true
+        self.foreground_pdf = None          # the cut lines drawn over the messages (and the messages if not vector)
+        self.message_pdfs = []              # only if vector messages is true (None for blank messages)
 
         """Constants and Settings"""
         # flip the order of the cells in the back page
         # required for double-sided printing of tickets flipped along the long edge
         self.HORIZONTAL_FLIP = True
 
-        self.NUM_COLUMNS = 2
-        self.NUM_ROWS = 5
         self.NUM_CODES_PER_PAGE = self.NUM_COLUMNS * self.NUM_ROWS
 
-        self.MARGIN = 1 * cm            # an additional 0.5cm will be added to the table
         self.PADDING = padding          # the padding for each cell in the table
         self.PAGE_WIDTH, self.PAGE_HEIGHT = A4
 
         self.TABLE_WIDTH = self.PAGE_WIDTH - 2 * self.MARGIN - cm
         self.TABLE_HEIGHT = self.PAGE_HEIGHT - 2 * self.MARGIN - cm
-        self.CELL_WIDTH = self.TABLE_WIDTH / self.NUM_COLUMNS
-        self.CELL_HEIGHT = self.TABLE_HEIGHT / self.NUM_ROWS
-
-        # dimensions of canvas from signature pad in pixels
-        self.CANVAS_WIDTH = 602
-        self.CANVAS_HEIGHT = 358
+        self.CELL_WIDTH, self.CELL_HEIGHT = self.get_cell_size()
+        # bottom left corner of the table (which is centred in the frame, padded by 6pt)
+        self.TABLE_X = (self.PAGE_WIDTH - self.TABLE_WIDTH) / 2
+        self.TABLE_Y = self.PAGE_HEIGHT - self.MARGIN - 6 - self.TABLE_HEIGHT
 
         """Load Fonts"""
-        if self.VECTOR_MESSAGES and not self.ENFORCE_BOUNDARIES:
-            for font, font_info in FONTS.items():
-                pdfmetrics.registerFont(TTFont(font, f'{DirectoryLocations.STATIC}/fonts/{font_info["filename"]}.ttf'))
-        else:
-            pdfmetrics.registerFont(TTFont("Chasing Hearts", f'{DirectoryLocations.STATIC}/fonts/Chasing Hearts.ttf'))
+        register_font("Chasing Hearts")
 
-        """Load Templates"""
-        self.TEMPLATES = {}
-
-        for template_name, template_info in TEMPLATES.items():
-            template = svg2rlg(f"{DirectoryLocations.STATIC}/templates/{template_info['filename']}")
-            scale_factor = min(1 - (self.PADDING * 2 / self.CELL_WIDTH), 1 - (self.PADDING * 2 / self.CELL_HEIGHT))
-            template.setProperties({"hAlign": "CENTER", "vAlign": "MIDDLE", "renderScale": scale_factor})
-            self.TEMPLATES[template_name] = template
-
-        """Load Item Images"""
-        self.ITEM_IMAGES = {}
-
-        chocolate_image = svg2rlg(f'{DirectoryLocations.STATIC}/item_types/chocolate.svg')
-        chocolate_image.setProperties({"renderScale": 0.033})
-        self.ITEM_IMAGES["Chocolate"] = chocolate_image
-
-        rose_image = svg2rlg(f'{DirectoryLocations.STATIC}/item_types/rose.svg')
-        rose_image.setProperties({"renderScale": 0.043})
-        self.ITEM_IMAGES["Rose"] = rose_image
-
-        serenade_image = svg2rlg(f'{DirectoryLocations.STATIC}/item_types/serenade.svg')
-        serenade_image.setProperties({"renderScale": 0.025})
-        self.ITEM_IMAGES["Serenade"] = serenade_image
-
-        special_serenade_image = svg2rlg(f'{DirectoryLocations.STATIC}/item_types/special_serenade.svg')
-        special_serenade_image.setProperties({"renderScale": 0.09})
-        self.ITEM_IMAGES["Special Serenade"] = special_serenade_image
+        # templates are shrunk to fit within the padding
+        self.TEMPLATE_SCALE = self.get_scale_factor(self.PADDING)
 
         """Build PDF"""
         self.generate_background_pdf()
+        if self.VECTOR_MESSAGES:
+            self.message_pdfs = [get_message_pdf(ticket.pk, self.PADDING, self.ENFORCE_BOUNDARIES)
+                                 for ticket in self.tickets]
         self.generate_foreground_pdf()
         self.combine_pdfs()
 
@@ -105,20 +183,14 @@ class TicketsToPDF:
         for index, page in enumerate(self.background_pdf.pages):
             if index % 2 == 0:
                 page_num = index // 2
-                if self.ENFORCE_BOUNDARIES:
-                    for message_index, message_pdf in enumerate(self.message_pdfs[page_num * self.NUM_CODES_PER_PAGE: (page_num + 1) * self.NUM_CODES_PER_PAGE]):
-                        if message_pdf is None:
-                            continue
-
-                        message_index = message_index % self.NUM_CODES_PER_PAGE
-                        message_page = PdfReader(message_pdf).pages[0]
-                        transformation = Transformation()\
-                            .translate(self.MARGIN * 1.5, self.MARGIN * 1.79)\
-                            .translate((message_index % self.NUM_COLUMNS) * self.CELL_WIDTH + self.PADDING,
-                                       self.TABLE_HEIGHT - ((message_index // 2 + 1) * self.CELL_HEIGHT) + self.PADDING)
-                        page.merge_transformed_page(message_page, transformation)
-                else:
-                    page.merge_page(self.foreground_pdf.pages[page_num])
+                foreground_page = self.foreground_pdf.pages[page_num]
+                if self.VECTOR_MESSAGES:
+                    # the cut lines are drawn over the messages
+                    page = pdf.add_page(page)
+                    self.place_forms(pdf, page, [*self.get_message_forms(page_num),
+                                                 (foreground_page, 0, 0, foreground_page.mediabox)])
+                    continue
+                page.merge_page(foreground_page)
             pdf.add_page(page)
 
         pdf.compress_identical_objects(remove_identicals=True,
@@ -133,6 +205,76 @@ class TicketsToPDF:
         else:
             print(f"[Ticket Printer] Error: unknown type of self.pdf_output_path {self.pdf_output_path}")
 
+    def get_message_forms(self, page_num: int) -> list[tuple[PageObject, float, float, RectangleObject]]:
+        """The rendered messages of the page, with where to place them and what to crop them to"""
+        forms = []
+        for message_index, message_pdf in enumerate(self.message_pdfs[page_num * self.NUM_CODES_PER_PAGE: (page_num + 1) * self.NUM_CODES_PER_PAGE]):
+            if message_pdf is None:
+                continue
+
+            # bottom left corner of the cell
+            x = self.TABLE_X + (message_index % self.NUM_COLUMNS) * self.CELL_WIDTH
+            y = self.TABLE_Y + self.TABLE_HEIGHT - (message_index // self.NUM_COLUMNS + 1) * self.CELL_HEIGHT
+
+            message_page = PdfReader(io.BytesIO(message_pdf)).pages[0]
+            if self.ENFORCE_BOUNDARIES:
+                # the message is rendered within the padding (and cropped to it)
+                forms.append((message_page, x + self.PADDING, y + self.PADDING, message_page.cropbox))
+            else:
+                # the message can be drawn outside its cell (but not the page)
+                forms.append((message_page, x, y,
+                              RectangleObject((-x, -y, self.PAGE_WIDTH - x, self.PAGE_HEIGHT - y))))
+        return forms
+
+    @staticmethod
+    def place_forms(pdf: PdfWriter, page: PageObject, forms: list[tuple[PageObject, float, float, RectangleObject]]):
+        """
+        Draws each page of forms onto the page at (x, y), cropped to its box, as form XObjects.
+        Unlike merging the pages, this doesn't parse their contents (or the contents of the page for every merge).
+        """
+        form_contents = [form_page.get("/Contents", NullObject()).get_object() for form_page, _, _, _ in forms]
+        if any(isinstance(contents, ArrayObject) for contents in form_contents):
+            # only pages with one content stream can be copied as forms, so these are merged instead
+            for form_page, x, y, bounding_box in forms:
+                form_page.cropbox = RectangleObject(bounding_box)
+                page.merge_transformed_page(form_page, Transformation().translate(x, y))
+            return
+
+        xobjects = DictionaryObject()
+        operations = []
+        for form_index, ((form_page, x, y, bounding_box), contents) in enumerate(zip(forms, form_contents)):
+            if not isinstance(contents, StreamObject):
+                # the page is blank
+                continue
+            form = contents.clone(pdf, force_duplicate=True)
+            if form.get("/Filter") != "/FlateDecode":
+                # e.g. reportlab also encodes streams as ASCII85, which makes them larger
+                data = form.get_data()
+                form[NameObject("/Filter")] = NameObject("/FlateDecode")
+                form.pop("/DecodeParms", None)
+                form.set_data(data)
+            form.update({
+                NameObject("/Type"): NameObject("/XObject"),
+                NameObject("/Subtype"): NameObject("/Form"),
+                NameObject("/BBox"): RectangleObject(bounding_box),
+                NameObject("/Resources"): form_page.get("/Resources", DictionaryObject()).clone(pdf),
+            })
+            name = f"/Form{form_index}"
+            xobjects[NameObject(name)] = form.indirect_reference
+            operations.append(f"q 1 0 0 1 {x:.4f} {y:.4f} cm {name} Do Q")
+
+        resources = page.setdefault(NameObject("/Resources"), DictionaryObject()).get_object()
+        if "/XObject" in resources:
+            xobjects.update(resources["/XObject"].get_object())
+        resources[NameObject("/XObject")] = xobjects
+
+        # the contents of the page are isolated so they can't move the forms
+        page_contents = page.get_contents()
+        contents = DecodedStreamObject()
+        contents.set_data(b"q\n" + (page_contents.get_data() if page_contents is not None else b"") + b"\nQ\n"
+                          + "\n".join(operations).encode())
+        page.replace_contents(contents.flate_encode())
+
     def generate_foreground_pdf(self):
         foreground_pdf_stream = io.BytesIO()
         doc = SimpleDocTemplate(foreground_pdf_stream, pageSize=A4,
@@ -177,6 +319,10 @@ class TicketsToPDF:
         self.background_pdf = PdfReader(background_pdf_stream)
 
     def create_images(self, tickets: list) -> list:
+        if self.VECTOR_MESSAGES:
+            # the rendered messages are placed instead, so the foreground only has the cut lines
+            return [""] * len(tickets)
+
         images = []
         for ticket in tickets:
             # resize the canvas
@@ -187,52 +333,64 @@ class TicketsToPDF:
 
             # check if message is blank
             if float(xml_file.get('width')) > 0 and float(xml_file.get('height')) > 0:
-                if self.VECTOR_MESSAGES:
-                    xml_file.set('width', str(self.CELL_WIDTH))
-                    xml_file.set('height', str(self.CELL_HEIGHT))
+                img_bytes = io.BytesIO(cairosvg.svg2png(
+                    bytestring=etree.tostring(xml_file), write_to=None,
+                    output_width=self.CANVAS_WIDTH * self.RATIO, output_height=self.CANVAS_HEIGHT * self.RATIO))
 
-                    if self.ENFORCE_BOUNDARIES:
-                        img_bytes = io.BytesIO(cairosvg.svg2pdf(
-                            bytestring=etree.tostring(xml_file), write_to=None,
-                            output_width=4 / 3 * (self.CELL_WIDTH - 2 * self.PADDING),
-                            output_height=4 / 3 * (self.CELL_HEIGHT - 2 * self.PADDING)))
+                image = Image(img_bytes)
+                self.scale_image(image, self.CELL_WIDTH - 2 * self.PADDING, self.CELL_HEIGHT - 2 * self.PADDING)
+            else:
+                print(f"[Ticket Printer] Warning: Ticket {ticket.pk} is blank.")
+                image = ""
 
-                        self.message_pdfs.append(img_bytes)
-                        image = ""  # just return a blank image and add it later by merging pdfs
+            images.append(image)
 
-                    else:
-                        if float(xml_file.get('width')) < self.CANVAS_WIDTH:
-                            # if fabric, remove font spaces in names
-                            for child in xml_file.iter("{http://www.w3.org/2000/svg}text"):  # need svg prefix on tags
-                                font = child.get("font-family")
+        return images
 
-                                if " " not in font:
-                                    break
+    @classmethod
+    def render_message(cls, svg: bytes, padding: int = 0, enforce_boundaries: bool = False) -> bytes | None:
+        """Renders a message as a PDF the size of a cell (or within the padding if enforcing boundaries)"""
+        xml_file = etree.parse(io.BytesIO(svg)).getroot()
+        # change the view box to the dimensions of the canvas
+        xml_file.set('viewBox', f'0 0 {cls.CANVAS_WIDTH} {cls.CANVAS_HEIGHT}')
 
-                                font = font.replace(" ", "")
-                                child.set("font-family", font)
+        # check if message is blank
+        if float(xml_file.get('width')) <= 0 or float(xml_file.get('height')) <= 0:
+            return None
 
-                        image = svg2rlg(io.StringIO(etree.tostring(xml_file).decode('utf-8')))
-                        image.setProperties({"hAlign": "CENTER", "vAlign": "MIDDLE"})
+        cell_width, cell_height = cls.get_cell_size()
+        xml_file.set('width', str(cell_width))
+        xml_file.set('height', str(cell_height))
 
-                else:
-                    img_bytes = io.BytesIO(cairosvg.svg2png(
-                        bytestring=etree.tostring(xml_file), write_to=None,
-                        output_width=self.CANVAS_WIDTH * self.RATIO, output_height=self.CANVAS_HEIGHT * self.RATIO))
+        if enforce_boundaries:
+            return cairosvg.svg2pdf(
+                bytestring=etree.tostring(xml_file), write_to=None,
+                output_width=4 / 3 * (cell_width - 2 * padding),
+                output_height=4 / 3 * (cell_height - 2 * padding))
 
-                    image = Image(img_bytes)
-                    self.scale_image(image, self.CELL_WIDTH - 2 * self.PADDING, self.CELL_HEIGHT - 2 * self.PADDING)
-            else:
-                print(f"[Ticket Printer] Warning: Ticket {ticket.pk} is blank.")
-                image = ""
+        if float(xml_file.get('width')) < cls.CANVAS_WIDTH:
+            # if fabric, remove font spaces in names
+            for child in xml_file.iter("{http://www.w3.org/2000/svg}text"):  # need svg prefix on tags
+                font = child.get("font-family")
 
-                # add a placeholder
-                if self.VECTOR_MESSAGES and self.ENFORCE_BOUNDARIES:
-                    self.message_pdfs.append(None)
+                if " " not in font:
+                    break
 
-            images.append(image)
+                font = font.replace(" ", "")
+                child.set("font-family", font)
 
-        return images
+        for font in FONTS:
+            register_font(font)
+        return renderPDF.drawToString(svg2rlg(io.StringIO(etree.tostring(xml_file).decode('utf-8'))))
+
+    @classmethod
+    def get_cell_size(cls) -> tuple[float, float]:
+        return (A4[0] - 2 * cls.MARGIN - cm) / cls.NUM_COLUMNS, (A4[1] - 2 * cls.MARGIN - cm) / cls.NUM_ROWS
+
+    @classmethod
+    def get_scale_factor(cls, padding: int) -> float:
+        cell_width, cell_height = cls.get_cell_size()
+        return min(1 - (padding * 2 / cell_width), 1 - (padding * 2 / cell_height))
 
     def create_templates(self, tickets: list) -> list:
         images = []
@@ -240,20 +398,12 @@ class TicketsToPDF:
             if ticket.template == "Blank":
                 image = ""
             else:
-                image = self.TEMPLATES[ticket.template]
+                image = get_template(ticket.template, self.TEMPLATE_SCALE)
             images.append(image)
         return images
 
     def create_delivery_info(self, tickets: list, page_index: int) -> list:
-        stylesheet = getSampleStyleSheet()
-        default_style = ParagraphStyle(name="Default", parent=stylesheet['Normal'], fontSize=10, leading=11,
-                                       fontName="Chasing Hearts")
-        centre_align = ParagraphStyle(name="Center", parent=default_style, alignment=1)
-        centre_align_small = ParagraphStyle(name="Center Small", parent=default_style, alignment=1, fontSize=8,
-                                            leading=9)
-        large_style = ParagraphStyle(name="Large", parent=default_style, alignment=1,
-                                     fontSize=max(12, round(16 - self.PADDING / 3)),
-                                     leading=max(13, round(18 - self.PADDING / 3)))
+        default_style, centre_align, centre_align_small, large_style = get_delivery_info_styles(self.PADDING)
 
         ticket_backs = []
         for index, ticket in enumerate(tickets):
@@ -266,8 +416,8 @@ class TicketsToPDF:
                                       colWidths=self.CELL_WIDTH / 4)
 
             """Bottom Right: Item Type (including image)"""
-            if ticket.item_type in self.ITEM_IMAGES:
-                item_type_image = self.ITEM_IMAGES[ticket.item_type]
+            if ticket.item_type in ITEM_IMAGES:
+                item_type_image = get_item_image(ticket.item_type)
             else:
                 raise KeyError("Unknown item type")
 
@@ -5,57 +5,378 @@ import csv
 import json
 import random
 import math
+import heapq
+import bisect
+import itertools
+import contextlib
+import time
+import tracemalloc
+import os
+import pickle
+import functools
+import hashlib
+import collections
+import argparse
+import multiprocessing
+import logging
+import numpy as np
 from datetime import datetime
-from typing import Literal, Any, Sequence, Generator
+from typing import Literal, Any, Sequence, Generator, Callable, Iterable, NamedTuple
 
 # Tells the algorithm what order the classrooms are physically located in
 # (only linear unfortunately)
 CLASSROOM_GEOGRAPHIC_ORDER = "LBCDAEFGOPTJHIRX" # noqa
 
+logger = logging.getLogger(__name__)
+
 
 ItemType = Literal["Special Serenade", "Serenade", "Rose", "Chocolate"]
+ITEM_TYPES: tuple[ItemType, ...] = ("Special Serenade", "Serenade", "Rose", "Chocolate")
 PeriodType = Literal[1, 2, 3, 4]
 
 
-if __name__ == "__main__":
-    from constants import DirectoryLocations
+# The sorter doesn't depend on Django (ticketing/sorting.py connects it to the database)
+if __package__:
+    from .timetable_parser import ROOM_FORMAT, BAD_ROOM_FORMAT
+else:
+    # Running as a script (or imported from the ticketing folder, e.g. by dev/benchmark.py)
     from timetable_parser import ROOM_FORMAT, BAD_ROOM_FORMAT
 
-    # Can't import so use a dummy class
-    class Ticket:
-        pass
+# The example data used when running this file
+DEV_PEOPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dev", "people_2023.csv")
+DEV_TICKETS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dev", "tickets_2023.json")
+
+
+class TicketRecord(NamedTuple):
+    """A ticket to sort as plain data: who it's for and where they are each period"""
+    pk: int
+    recipient_id: str
+    item_type: ItemType
+    p1: str
+    p2: str
+    p3: str
+    p4: str
+    ss_period: PeriodType | None = None     # the period chosen by the special serenade (if applicable)
+
+
+class Assignment(NamedTuple):
+    """Where a ticket was sorted into, as plain data"""
+    pk: int
+    group: str              # the name of the delivery group (e.g. S1 or N10)
+    position: int           # the position of the ticket in its group (the order to deliver in)
+    period: PeriodType      # the chosen period
+    classroom: str          # the chosen classroom (as it appears on the timetable)
+    p1: str
+    p2: str
+    p3: str
+    p4: str
+
+    # The number of positions in each group which sort_order can hold
+    MAX_POSITIONS = 1_000_000
 
-    class DeliveryGroupModel:
-        pass
+    @property
+    def sort_order(self) -> int:
+        """Orders every ticket by group (non-serenading groups first), then position"""
+        is_serenading = self.group.startswith("S")
+        return ((1000 if is_serenading else 0) + int(self.group[1:])) * self.MAX_POSITIONS + self.position
 
-    random.seed(56)
-else:
-    from .constants import STUDENTS
-    from .timetable_parser import ROOM_FORMAT, BAD_ROOM_FORMAT
-    from .models import Ticket
-    from .models import DeliveryGroup as DeliveryGroupModel
+    def to_json(self) -> dict[str, Any]:
+        return {**self._asdict(), "sort_order": self.sort_order}
 
 
-def sort_tickets(tickets: list[Ticket], num_serenading_groups: int, num_non_serenading_groups: int,
+def get_assignments(delivery_groups: Iterable[DeliveryGroup]) -> list[Assignment]:
+    assignments = []
+    for delivery_group in delivery_groups:
+        for position, ticket in enumerate(delivery_group.tickets):
+            assignments.append(Assignment(
+                ticket.pk, delivery_group.name, position, ticket.chosen_period,
+                ticket.chosen_classroom.original_name,
+                ticket.p1.original_name, ticket.p2.original_name,
+                ticket.p3.original_name, ticket.p4.original_name
+            ))
+    return assignments
+
+
+def sort_records(records: Iterable[TicketRecord], num_serenading_groups: int, num_non_serenading_groups: int,
                  max_serenades_per_class: int, max_non_serenades_per_serenading_class: int,
-                 extra_special_serenades: bool, enforce_distribution: bool) \
-        -> dict[bool, DeliveryGroupList[Any]]:
-    ticket_sorter = TicketSorter(
-        TicketList.from_sql_ticket_list(tickets), num_serenading_groups, num_non_serenading_groups,
-        max_serenades_per_class=max_serenades_per_class,
-        max_non_serenades_per_serenading_class=max_non_serenades_per_serenading_class,
-        extra_special_serenades=extra_special_serenades,
-        enforce_distribution=enforce_distribution
-    )
+                 extra_special_serenades: bool, enforce_distribution: bool,
+                 improve_time_budget: float = 0, optimise_time_limit: float = 0,
+                 split_components: bool = False, measure_memory: bool = False,
+                 num_starts: int = 1, time_budget: float | None = None,
+                 engine: str = "full", seed: int | None = None, use_cache: bool = True,
+                 cache: ClassroomCache | None = None, on_phase: Callable[[str], None] | None = None) \
+        -> tuple[list[Assignment], SortReport, SortProfile]:
+    """
+    Returns where each ticket was sorted into (serenading groups first, tickets in delivery order).
+    Tickets which couldn't be delivered aren't assigned (see report.undelivered_tickets).
+
+    If seed is given, the random module is seeded with it first (so that the sort can be repeated).
+
+    If seed is given, the classrooms chosen by the full and numpy engines are kept in cache (by
+    default CLASSROOM_CACHE, which only lasts as long as the process) unless use_cache is False, so
+    sorting the same tickets with the same options and seed again (e.g. only changing the number of
+    groups) only has to assign the classrooms to groups. Sorts without a seed are never cached, so
+    they always make new random choices.
+
+    engine is either "full" (TicketSorter), "numpy" (TicketSorter choosing the classrooms with an
+    ArraySorter, which is faster for very large schools but follows the options less strictly) or
+    "preview" (PreviewSorter, which is even faster but visits more classrooms and ignores every
+    option besides the number of groups).
+
+    If num_starts > 1, the tickets are sorted with that many different random seeds (in parallel)
+    and the seed with the fewest classroom visits (then the least group imbalance) is used.
+    Starts which haven't finished within time_budget seconds are abandoned.
+
+    Improving and optimising stop after a set time, so they aren't deterministic. They are only done
+    once the best seed has been chosen.
+
+    on_phase is called with the name of each phase of the sort as it starts (to show progress).
+    """
+    if seed is not None:
+        random.seed(seed)
+    if cache is None:
+        cache = CLASSROOM_CACHE
+
+    tickets_to_sort = TicketList.from_records(records)
+    sorter_args = (num_serenading_groups, num_non_serenading_groups)
+    sorter_kwargs = {
+        "max_serenades_per_class": max_serenades_per_class,
+        "max_non_serenades_per_serenading_class": max_non_serenades_per_serenading_class,
+        "extra_special_serenades": extra_special_serenades,
+        "enforce_distribution": enforce_distribution,
+        "split_components": split_components,
+    }
+    if engine == "numpy":
+        sorter_kwargs["use_arrays"] = True
+
+    if engine == "preview":
+        ticket_sorter = PreviewSorter(tickets_to_sort, *sorter_args, measure_memory=measure_memory,
+                                      on_phase=on_phase)
+    elif engine in ("full", "numpy"):
+        # everything which affects the chosen classrooms (i.e. not the number of groups)
+        cache_key = ClassroomCache.make_key(tickets_to_sort, {
+            **sorter_kwargs,
+            "improve_time_budget": improve_time_budget,
+            "optimise_time_limit": optimise_time_limit,
+            "num_starts": num_starts,
+            "time_budget": time_budget,
+            "seed": seed,
+        })
+        # a sort without a seed is expected to be random, so it mustn't repeat an earlier sort
+        use_cache = use_cache and seed is not None
+        cached = cache.get(cache_key) if use_cache else None
+
+        if cached is not None:
+            chosen_classrooms, optimiser_result, starts = cached
+            ticket_sorter = TicketSorter(tickets_to_sort, *sorter_args, **sorter_kwargs,
+                                         measure_memory=measure_memory,
+                                         chosen_classrooms=chosen_classrooms,
+                                         on_phase=on_phase)
+            ticket_sorter.report.optimiser = optimiser_result
+        else:
+            starts = []
+            if num_starts > 1:
+                if on_phase is not None:
+                    on_phase("random_starts")
+                starts = run_starts(tickets_to_sort, sorter_args, sorter_kwargs, num_starts, time_budget)
+                if starts:
+                    # Sorting is deterministic for a given seed, so repeat the best start to get its output
+                    random.seed(starts[0]["seed"])
+
+            ticket_sorter = TicketSorter(tickets_to_sort, *sorter_args, **sorter_kwargs,
+                                         improve_time_budget=improve_time_budget,
+                                         optimise_time_limit=optimise_time_limit,
+                                         measure_memory=measure_memory,
+                                         on_phase=on_phase)
+            if use_cache:
+                cache.set(cache_key, (ticket_sorter.chosen_classrooms,
+                                      ticket_sorter.optimiser_result, starts))
+        ticket_sorter.report.starts = starts
+    else:
+        raise ValueError(f"Unknown sorting engine '{engine}'.")
+
+    assignments = get_assignments(itertools.chain(ticket_sorter.output_serenading_groups,
+                                                  ticket_sorter.output_non_serenading_groups))
+    return assignments, ticket_sorter.report, ticket_sorter.profile
+
+
+def run_starts(tickets: TicketList, sorter_args: tuple, sorter_kwargs: dict[str, Any],
+               num_starts: int, time_budget: float | None = None) -> list[dict[str, Any]]:
+    """
+    Sorts the tickets once for each seed in range(num_starts) using a pool of processes.
+    Returns the results of the starts which finished in time, best first.
+    """
+    # Pickle once instead of once per start. Also means the tickets can't change before being sent.
+    pickled_tickets = pickle.dumps(tickets)
+    sort_seed = functools.partial(sort_with_seed, pickled_tickets,
+                                  sorter_args=sorter_args, sorter_kwargs=sorter_kwargs)
+
+    starts = map_until_deadline(sort_seed, list(range(num_starts)), time_budget)
+    starts.sort(key=lambda start: (start["visits"], start["group_imbalance"], start["seed"]))
+    return starts
+
+
+def sweep_records(records: Iterable[TicketRecord], combinations: list[dict[str, Any]], seed: int = 0,
+                  time_budget: float | None = None) -> list[dict[str, Any]]:
+    """
+    Sorts the tickets once for each combination of settings (keyword arguments of TicketSorter)
+    using a pool of processes. Nothing is saved.
+
+    Every combination is sorted with the same seed, so sort_records(..., seed=seed) with the chosen
+    combination gives the same result. Combinations which haven't finished within time_budget
+    seconds are abandoned. Returns the results of the rest, fewest classroom visits first.
+    """
+    pickled_tickets = pickle.dumps(TicketList.from_records(records))
+    sort_settings = functools.partial(sort_with_settings, pickled_tickets, seed)
+
+    results = map_until_deadline(sort_settings, combinations, time_budget)
+    results.sort(key=lambda result: (result["visits"], result["group_imbalance"]))
+    return results
+
+
+def map_until_deadline(function: Callable, items: list, time_budget: float | None = None) -> list:
+    """
+    Calls the function with each item using a pool of processes.
+    Returns the results which finished within time_budget seconds, in the order they finished.
+    """
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+
+    finished = []
+    # Leaving the with block terminates any calls which are still running
+    with get_process_pool(max(1, min(len(items), os.cpu_count() or 1))) as pool:
+        results = pool.imap_unordered(function, items)
+        for _ in range(len(items)):
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                finished.append(results.next(timeout))
+            except multiprocessing.TimeoutError:
+                break
+    return finished
+
+
+def get_process_pool(num_processes: int):
+    # Forked processes start faster because they inherit everything already imported
+    if "fork" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("fork")
+    else:
+        mp_context = multiprocessing.get_context()
+    return mp_context.Pool(num_processes)
+
+
+def sort_with_seed(pickled_tickets: bytes, seed: int, sorter_args: tuple = (),
+                   sorter_kwargs: dict[str, Any] | None = None) -> dict[str, Any]:
+    """Runs in a separate process, so only returns a summary of the result"""
+    random.seed(seed)
+    start_time = time.perf_counter()
+    ticket_sorter = TicketSorter(pickle.loads(pickled_tickets), *sorter_args, **(sorter_kwargs or {}))
+    return {
+        "seed": seed,
+        "visits": ticket_sorter.report.total_visits,
+        "group_imbalance": ticket_sorter.report.group_imbalance,
+        "seconds": round(time.perf_counter() - start_time, 4),
+    }
 
-    groups = {
-        True: ticket_sorter.output_serenading_groups,
-        False: ticket_sorter.output_non_serenading_groups
+
+def sort_with_settings(pickled_tickets: bytes, seed: int, settings: dict[str, Any]) -> dict[str, Any]:
+    """Runs in a separate process, so only returns a summary of the result"""
+    random.seed(seed)
+    start_time = time.perf_counter()
+    report = TicketSorter(pickle.loads(pickled_tickets), **settings).report
+    result = {
+        "settings": settings,
+        "visits": report.total_visits,
+        "group_imbalance": report.group_imbalance,
+        "seconds": round(time.perf_counter() - start_time, 4),
     }
-    return groups
+    for name, groups in (("serenading", report.serenading_groups),
+                         ("non_serenading", report.non_serenading_groups)):
+        totals = [group["total"] for group in groups]
+        result[f"max_{name}_load"] = max(totals, default=0)
+        result[f"min_{name}_load"] = min(totals, default=0)
+    return result
+
+
+def sort_new_records(committed_groups: dict[str, tuple[bool, list[tuple[str, PeriodType, str]]]],
+                     new_records: Iterable[TicketRecord], next_positions: dict[str, int]) \
+        -> tuple[list[Assignment], list[TicketRecord]]:
+    """
+    Adds tickets to a sort which has already been committed (see IncrementalSorter).
+    next_positions is the position in each group to start adding its new tickets from.
+    :return: where each new ticket was sorted into and the tickets which couldn't be delivered
+    """
+    new_records = list(new_records)
+    incremental_sorter = IncrementalSorter(committed_groups, TicketList.from_records(new_records))
+
+    assignments = []
+    for group_name, tickets in incremental_sorter.output.items():
+        for position, ticket in enumerate(tickets, start=next_positions[group_name]):
+            assignments.append(Assignment(
+                ticket.pk, group_name, position, ticket.chosen_period,
+                ticket.chosen_classroom.original_name,
+                ticket.p1.original_name, ticket.p2.original_name,
+                ticket.p3.original_name, ticket.p4.original_name
+            ))
+    undelivered_pks = {ticket.pk for ticket in incremental_sorter.undelivered_tickets}
+    return assignments, [record for record in new_records if record.pk in undelivered_pks]
+
+
+def choose_component_classrooms(pickled_components: bytes, seeds: list[float],
+                                sorter_kwargs: dict[str, Any]) -> list[list[tuple[int | None, bool]]]:
+    """
+    Chooses the classrooms of each component (a list of tickets) separately.
+    May run in a separate process, so only returns each ticket's chosen period (None if it has none)
+    and whether it was put in a special classroom.
+    """
+    results = []
+    for tickets, seed in zip(pickle.loads(pickled_components), seeds):
+        random.seed(seed)
+        TicketSorter(tickets, 1, 1, **sorter_kwargs, choose_classrooms_only=True)
+        results.append([
+            (ticket.chosen_period if ticket.available else None,
+             ticket.available != 0 and ticket.chosen_classroom.is_special)
+            for ticket in tickets
+        ])
+    return results
+
+
+# Lookup tables indexed by a ticket's 4-bit availability mask (bit 0 is period 1, bit 3 is period 4)
+MASK_PERIODS: tuple[tuple[PeriodType, ...], ...] = tuple(
+    tuple(period for period in range(1, 5) if mask & (1 << (period - 1)))     # noqa
+    for mask in range(16)
+)
+MASK_NUM_PERIODS: tuple[int, ...] = tuple(mask.bit_count() for mask in range(16))
+ALL_PERIODS_MASK = 0b1111
+
+
+def _classroom_property(period: PeriodType):
+    def getter(self: TicketToSort):
+        return self.classrooms[period - 1]
+
+    def setter(self: TicketToSort, classroom):
+        self.classrooms[period - 1] = classroom
+
+    return property(getter, setter)
+
+
+def _is_period_property(period: PeriodType):
+    bit = 1 << (period - 1)
+
+    def getter(self: TicketToSort) -> bool:
+        return bool(self.available & bit)
+
+    def setter(self: TicketToSort, value: bool):
+        if value:
+            self.set_available(self.available | bit)
+        else:
+            self.set_available(self.available & ~bit)
+
+    return property(getter, setter)
 
 
 class TicketToSort:
+    __slots__ = ("pk", "recipient_id", "item_type", "ss_period", "classrooms", "available",
+                 "distribution")
+
     def __init__(self, pk: int, recipient_id: str, item_type: ItemType,
                  p1: str, p2: str, p3: str, p4: str, ss_period: PeriodType | None = None):
         # Ticket info
@@ -64,55 +385,43 @@ class TicketToSort:
         self.item_type = item_type
         self.ss_period = ss_period  # the period chosen by the special serenade (if applicable)
 
-        # Where the recipient's classes are for each period
-        # Don't rename the variable or else getattr()/setattr() will break
-        self.p1 = p1
-        self.p2 = p2
-        self.p3 = p3
-        self.p4 = p4
+        # Where the recipient's classes are for each period (index 0 is period 1).
+        # Starts off as the classroom names, which get replaced by Classroom objects.
+        self.classrooms: list = [p1, p2, p3, p4]
+
+        # Bitmask of which periods the algorithm can still choose (bit 0 is period 1)
+        self.available = ALL_PERIODS_MASK
 
-        # Whether the algorithm has chosen this period.
-        # Don't rename or else getattr()/setattr() will break
-        self.is_p1 = True
-        self.is_p2 = True
-        self.is_p3 = True
-        self.is_p4 = True
+        # The live PeriodDistribution which counts this ticket once it has no choice (if tracked)
+        self.distribution: PeriodDistribution | None = None
 
         if item_type == "Special Serenade" and self.ss_period is None:
             raise AssertionError("SS_period must be specified for special serenades.")
 
-    @classmethod
-    def from_sql_ticket(cls, sql_ticket: Ticket):
-        """
-        Converts a Ticket (the object stored in the SQL database, i.e. the Django model Ticket)
-        into a TicketToSort
-        """
-        recipient_id = sql_ticket.recipient_id
-        item_type: ItemType = sql_ticket.item_type # noqa
-        period: PeriodType = sql_ticket.ss_period  # noqa
-
-        p1 = STUDENTS[sql_ticket.recipient_id]["P1"]
-        p2 = STUDENTS[sql_ticket.recipient_id]["P2"]
-        p3 = STUDENTS[sql_ticket.recipient_id]["P3"]
-        p4 = STUDENTS[sql_ticket.recipient_id]["P4"]
-
-        if sql_ticket.item_type == "Special Serenade":
-            ticket_to_sort = cls(
-                sql_ticket.pk, recipient_id, item_type,
-                p1, p2, p3, p4, period)
-        else:
-            ticket_to_sort = cls(
-                sql_ticket.pk, recipient_id, item_type, p1, p2, p3, p4)
+    # Access to individual periods by name (e.g. ticket.p1, ticket.is_p1)
+    p1 = _classroom_property(1)
+    p2 = _classroom_property(2)
+    p3 = _classroom_property(3)
+    p4 = _classroom_property(4)
+    is_p1 = _is_period_property(1)
+    is_p2 = _is_period_property(2)
+    is_p3 = _is_period_property(3)
+    is_p4 = _is_period_property(4)
 
-        return ticket_to_sort
+    @classmethod
+    def from_record(cls, record: TicketRecord):
+        if record.item_type == "Special Serenade":
+            return cls(record.pk, record.recipient_id, record.item_type,
+                       record.p1, record.p2, record.p3, record.p4, record.ss_period)
+        return cls(record.pk, record.recipient_id, record.item_type,
+                   record.p1, record.p2, record.p3, record.p4)
 
     @property
     def chosen_period(self) -> int:
         # if a ticket only has 1 period it can go to, return what it is
-        if self.has_no_choice:
-            for period in range(1, 5):
-                if getattr(self, f"is_p{period}"):
-                    return period
+        if MASK_NUM_PERIODS[self.available] <= 1:
+            if self.available:
+                return MASK_PERIODS[self.available][0]
         else:
             raise Exception(f"Tried to get only_period when there were multiple periods possible "
                             f"{str(self)}")
@@ -120,7 +429,17 @@ class TicketToSort:
     @property
     def chosen_classroom(self) -> str:
         if self.has_no_choice:
-            return getattr(self, f"p{self.chosen_period}")
+            return self.classrooms[self.chosen_period - 1]
+
+    def set_available(self, mask: int):
+        """Sets which periods are available, keeping the tracked PeriodDistribution up to date"""
+        if self.distribution is not None:
+            self.distribution.update(self, self.available, mask)
+        self.available = mask
+
+    def remove_period(self, period: PeriodType):
+        """Makes the period unavailable to this ticket (doesn't touch the classroom)"""
+        self.set_available(self.available & ~(1 << (period - 1)))
 
     def choose_period(self, chosen_period: PeriodType):
         """
@@ -132,43 +451,29 @@ class TicketToSort:
         # Remove this ticket from the non-chosen classrooms and
         # set every period to false except the chosen one
         for period in range(1, 5):
-            if period is not chosen_period:
-                setattr(self, f'is_p{period}', False)
-                classroom = getattr(self, f"p{period}")
-                if self in classroom.tickets:
-                    classroom.tickets.remove(self)
+            if period != chosen_period:
+                self.classrooms[period - 1].tickets.discard(self)
 
-        # Sets chosen period as true
-        setattr(self, f'is_p{chosen_period}', True)
+        self.set_available(1 << (chosen_period - 1))
 
         # Add this ticket to the chosen classroom (if not already)
-        chosen_classroom = getattr(self, f"p{chosen_period}")
-        if self not in chosen_classroom.tickets:
-            chosen_classroom.tickets.append(self)
+        self.classrooms[chosen_period - 1].tickets.add(self)
 
     @property
     def num_periods_available(self) -> int:
-        num_periods = 0
-        for period in range(1, 5):
-            if getattr(self, f"is_p{period}"):
-                num_periods += 1
-        return num_periods
+        return MASK_NUM_PERIODS[self.available]
 
     @property
     def has_no_choice(self) -> bool:
-        return self.num_periods_available <= 1
+        return MASK_NUM_PERIODS[self.available] <= 1
 
     @property
     def available_classrooms(self) -> list[str]:
-        return [
-            getattr(self, f"p{period}")
-            for period in range(1, 5)
-            if getattr(self, f"is_p{period}")
-        ]
+        return [self.classrooms[period - 1] for period in MASK_PERIODS[self.available]]
 
     @property
-    def available_periods(self) -> list[PeriodType]:
-        return [period for period in range(1, 5) if getattr(self, f"is_p{period}")] # noqa
+    def available_periods(self) -> tuple[PeriodType, ...]:
+        return MASK_PERIODS[self.available]
 
     def semi_available_periods(
             self,
@@ -186,7 +491,7 @@ class TicketToSort:
 
             if exclude_chosen_period and period == self.chosen_period:
                 continue
-            classroom = getattr(self, f"p{period}")
+            classroom = self.classrooms[period - 1]
             if classroom in available_classrooms:
                 semi_available_periods.append(period)
 
@@ -201,15 +506,64 @@ class TicketToSort:
 
         item = "SS" if self.item_type == "Special Serenade" else self.item_type[0]
 
-        return f"<{self.pk} {STUDENTS[self.recipient_id]['Name']} " \
+        return f"<{self.pk} {self.recipient_id} " \
                f"{self.p1}{p1} {self.p2}{p2} {self.p3}{p3} {self.p4}{p4} {item}>"
 
 
-class TicketList(list):
-    @classmethod
-    def from_sql_ticket_list(cls, sql_ticket_list: list[Ticket]):
-        return cls(TicketToSort.from_sql_ticket(sql_ticket) for sql_ticket in sql_ticket_list)
+class PeriodDistribution:
+    """
+    Live count of how many tickets have been fixed to each period (i.e. have no other choice),
+    split by item type. Tickets which are tracked update it whenever their available periods
+    change, so reading it is O(1) instead of a pass over every ticket.
+    """
+    def __init__(self):
+        self.by_item_type: dict[ItemType, dict[PeriodType, int]] = {
+            item_type: {1: 0, 2: 0, 3: 0, 4: 0}
+            for item_type in ITEM_TYPES
+        }
+        self.total: dict[PeriodType, int] = {1: 0, 2: 0, 3: 0, 4: 0}
+
+    def __repr__(self):
+        return f"<PeriodDistribution {self.total}>"
+
+    def __getitem__(self, period: PeriodType) -> int:
+        return self.total[period]
+
+    def track(self, ticket: TicketToSort):
+        """Counts the ticket (if it has no choice) and keeps counting it as it changes"""
+        ticket.distribution = self
+        self.update(ticket, ALL_PERIODS_MASK, ticket.available)
 
+    def update(self, ticket: TicketToSort, old_mask: int, new_mask: int):
+        if old_mask == new_mask:
+            return
+
+        distribution = self.by_item_type[ticket.item_type]
+        # release the ticket from its old period (if it was fixed to one)
+        if MASK_NUM_PERIODS[old_mask] == 1:
+            period = MASK_PERIODS[old_mask][0]
+            distribution[period] -= 1
+            self.total[period] -= 1
+        # fix the ticket to its new period (if it only has one left)
+        if MASK_NUM_PERIODS[new_mask] == 1:
+            period = MASK_PERIODS[new_mask][0]
+            distribution[period] += 1
+            self.total[period] += 1
+
+    def of_items(self, items: Sequence[ItemType]) -> dict[PeriodType, int]:
+        """The distribution of only the tickets with the specified item type(s)"""
+        distribution: dict[PeriodType, int] = {1: 0, 2: 0, 3: 0, 4: 0}
+        for item_type in items:
+            for period, count in self.by_item_type[item_type].items():
+                distribution[period] += count
+        return distribution
+
+
+class TicketQueries:
+    """
+    Queries shared by TicketList and TicketSet.
+    Subclasses must be iterable, constructable from an iterable and support append() and sort().
+    """
     def has_item_type(self, items=None) -> bool:
         # checks if a list of tickets contains any ticket with a given item type(s)
         for ticket in self:
@@ -308,6 +662,79 @@ class TicketList(list):
         return num_periods_available_distribution
 
 
+class TicketList(TicketQueries, list):
+    @classmethod
+    def from_records(cls, records: Iterable[TicketRecord]):
+        return cls(TicketToSort.from_record(record) for record in records)
+
+
+class TicketSet(TicketQueries):
+    """
+    An insertion-ordered set of tickets with the same API as TicketList.
+    Adding, removing and checking membership are O(1) (indexing is O(n) so avoid it).
+
+    Like a set, it cannot be modified while being iterated over (iterate over a copy instead).
+
+    Also keeps a running count of each item type, so item type queries are O(1).
+    """
+    def __init__(self, tickets=()):
+        self._tickets: dict[TicketToSort, None] = dict.fromkeys(tickets)
+        self.item_counts: dict[ItemType, int] = {item_type: 0 for item_type in ITEM_TYPES}
+        for ticket in self._tickets:
+            self.item_counts[ticket.item_type] += 1
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({list(self._tickets)})"
+
+    def __iter__(self):
+        return iter(self._tickets)
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def __contains__(self, ticket: TicketToSort) -> bool:
+        return ticket in self._tickets
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return TicketList(list(self._tickets)[index])
+        return list(self._tickets)[index]
+
+    def has_item_type(self, items=None) -> bool:
+        return self.num_items(items) > 0
+
+    def num_items(self, items: Sequence[ItemType]) -> int:
+        return sum(self.item_counts[item_type] for item_type in items)
+
+    def add(self, ticket: TicketToSort):
+        if ticket not in self._tickets:
+            self._tickets[ticket] = None
+            self.item_counts[ticket.item_type] += 1
+
+    def append(self, ticket: TicketToSort):
+        self.add(ticket)
+
+    def extend(self, tickets):
+        for ticket in tickets:
+            self.add(ticket)
+
+    def discard(self, ticket: TicketToSort):
+        if ticket in self._tickets:
+            del self._tickets[ticket]
+            self.item_counts[ticket.item_type] -= 1
+
+    def remove(self, ticket: TicketToSort):
+        if ticket not in self._tickets:
+            raise ValueError(f"{ticket} not in {self.__class__.__name__}")
+        self.discard(ticket)
+
+    def copy(self):
+        return self.__class__(self._tickets)
+
+    def sort(self, key=None, reverse: bool = False):
+        self._tickets = dict.fromkeys(sorted(self._tickets, key=key, reverse=reverse))
+
+
 class Classroom:
     # the REGEX used to determine what is a valid classroom name
     # if invalid, classroom will not be visited
@@ -321,7 +748,7 @@ class Classroom:
         self.original_name = original_name       # the name as it appears on the timetable
         self.clean_name = self.get_clean_name()
 
-        self.tickets = TicketList()
+        self.tickets = TicketSet()
         self.is_valid = self.verify_classroom_name()
         self._is_special = False  # if a duplicate class solely for a special serenade
 
@@ -336,7 +763,11 @@ class Classroom:
             return f"{self.period}-{self.clean_name}"
 
     def get_clean_name(self):
-        dotless_name = self.original_name.replace('.', '')
+        return self.to_clean_name(self.original_name)
+
+    @staticmethod
+    def to_clean_name(original_name: str) -> str:
+        dotless_name = original_name.replace('.', '')
         clean_name = re.sub("([A-Z])G", r"\g<1>0", dotless_name)
         return clean_name
 
@@ -395,7 +826,7 @@ class Classroom:
                 if ticket.item_type != "Serenade" or ticket.has_no_choice:
                     continue
 
-                setattr(ticket, f"is_p{self.period}", False)
+                ticket.remove_period(self.period)
                 self.tickets.remove(ticket)
 
                 num_serenades -= 1
@@ -430,7 +861,7 @@ class Classroom:
                 if ticket.item_type not in ("Chocolate", "Rose") or ticket.has_no_choice:
                     continue
 
-                setattr(ticket, f"is_p{self.period}", False)
+                ticket.remove_period(self.period)
                 self.tickets.remove(ticket)
 
                 num_non_serenades -= 1
@@ -441,10 +872,66 @@ class Classroom:
 
 
 class ClassroomList(list):
+    """
+    A list of classrooms which also keeps an index of extended_name -> Classroom so that
+    membership checks and lookups don't have to scan the whole list.
+
+    Note: the index is keyed by extended_name at the time the classroom was added. If a classroom
+    is renamed afterwards (e.g. made special), call refresh_index().
+    """
+    def __init__(self, classrooms=()):
+        super().__init__(classrooms)
+        self.refresh_index()
+
+    def refresh_index(self):
+        self._index: dict[str, Classroom] = {}
+        self._counts: dict[str, int] = {}
+        for classroom in self:
+            self._add_to_index(classroom)
+
+    def _add_to_index(self, classroom: Classroom):
+        name = classroom.extended_name
+        if name in self._index:
+            self._counts[name] += 1
+        else:
+            self._index[name] = classroom
+            self._counts[name] = 1
+
+    def _remove_from_index(self, classroom: Classroom):
+        name = classroom.extended_name
+        self._counts[name] -= 1
+        if self._counts[name] <= 0:
+            del self._index[name]
+            del self._counts[name]
+        elif self._index[name] is classroom:
+            # a duplicate with the same name is still in the list, so point to the first one left
+            self._index[name] = next(
+                existing_classroom for existing_classroom in self
+                if existing_classroom.extended_name == name)
+
     def __contains__(self, classroom: Classroom) -> bool:
-        return classroom.extended_name in map(
-            lambda existing_classroom: existing_classroom.extended_name, self
-        )
+        return classroom.extended_name in self._index
+
+    def append(self, classroom: Classroom):
+        super().append(classroom)
+        self._add_to_index(classroom)
+
+    def extend(self, classrooms):
+        for classroom in classrooms:
+            self.append(classroom)
+
+    def insert(self, index: int, classroom: Classroom):
+        super().insert(index, classroom)
+        self._add_to_index(classroom)
+
+    def remove(self, classroom: Classroom):
+        super().remove(classroom)
+        self._remove_from_index(classroom)
+
+    def pop(self, index: int = -1) -> Classroom:
+        classroom = super().pop(index)
+        self._remove_from_index(classroom)
+        return classroom
 
     @classmethod
     def from_tickets(cls, tickets: TicketList, existing_tickets: TicketList = None):
@@ -459,9 +946,13 @@ class ClassroomList(list):
         if existing_tickets is not None:
             for ticket in existing_tickets:
                 for period in range(1, 5):
-                    classroom = getattr(ticket, f"p{period}")
+                    classroom = ticket.classrooms[period - 1]
                     if classroom not in self:
                         self.append(classroom)
+            existing_tickets = set(existing_tickets)
+
+        # Key: (period, name of the classroom in the ticket). Saves cleaning the same name many times
+        classrooms_by_name: dict[tuple[int, str], Classroom] = {}
 
         for ticket in tickets:
             # If ticket was in existing_tickets, skip because already checked
@@ -471,34 +962,29 @@ class ClassroomList(list):
             for period in range(1, 5):
                 period: PeriodType
 
-                classroom_name = getattr(ticket, f"p{period}")
-                new_classroom = Classroom(classroom_name, period)
-
-                if new_classroom in self:
-                    existing_classroom = self.get_existing_classroom(new_classroom)
-                    existing_classroom.tickets.append(ticket)
-                    setattr(ticket, f"p{period}", existing_classroom)
-                else:
-                    new_classroom.tickets.append(ticket)
-                    setattr(ticket, f"p{period}", new_classroom)
-                    self.append(new_classroom)
+                classroom_name = ticket.classrooms[period - 1]
+                classroom = classrooms_by_name.get((period, classroom_name))
+                if classroom is None:
+                    extended_name = f"{period}-{Classroom.to_clean_name(classroom_name)}"
+                    classroom = self._index.get(extended_name)
+                    if classroom is None:
+                        classroom = Classroom(classroom_name, period)
+                        self.append(classroom)
+                    classrooms_by_name[(period, classroom_name)] = classroom
+                classroom.tickets.append(ticket)
+                ticket.classrooms[period - 1] = classroom
 
                 # prevent non-existent or bad classes from being chosen
-                if not new_classroom.is_valid:
-                    setattr(ticket, f"is_p{period}", False)
+                if not classroom.is_valid:
+                    ticket.remove_period(period)
 
         # Remove non-existent classrooms
-        for classroom in self[:]:
-            if not classroom.is_valid:
-                self.remove(classroom)
-
-        return self
+        return cls(classroom for classroom in self if classroom.is_valid)
 
     def get_existing_classroom(self, new_classroom: Classroom):
         # gets an existing classroom in the list, given a new Classroom object with the same name
-        for classroom in self:
-            if classroom.extended_name == new_classroom.extended_name:
-                return classroom
+        if new_classroom.extended_name in self._index:
+            return self._index[new_classroom.extended_name]
         raise KeyError("Classroom not found.")
 
     @property
@@ -629,81 +1115,478 @@ class ClassroomList(list):
             classrooms_by_geography.extend(classrooms)
         return classrooms_by_geography
 
-    def sorted_by_period_distribution(self, tickets: TicketList) -> Generator[Classroom]:
+    def sorted_by_period_distribution(
+            self, period_distribution: PeriodDistribution) -> Generator[Classroom]:
         """
         Sorts self by order of ticket distribution (fullest first),
         then distribution of destroyed classes.
 
-        Recalculates the smallest period after each yield so that modifications to the period
+        Reads the period distribution again after each yield so that modifications to the period
         distribution between yields are considered.
 
-        Tickets input is the TicketList which the period distribution is derived from
-        (should be a list of every ticket).
+        period_distribution should be the live PeriodDistribution of every ticket.
         """
-        classroom_copy = self.copy()
-        for i in range(len(classroom_copy)):
-            if len(classroom_copy) > 1:  # don't bother if only 1 class in list
-                ticket_period_distribution = tickets.period_distribution
-                chosen_classroom = max(
-                    classroom_copy,
-                    key=lambda classroom: ticket_period_distribution[classroom.period]
-                )
-                classroom_copy.remove(chosen_classroom)
-                yield chosen_classroom
-            else:
-                yield classroom_copy[0]
+        # classrooms of each period (the last item is the one which appears first in self)
+        remaining_by_period: dict[PeriodType, list[tuple[int, Classroom]]] = {
+            1: [], 2: [], 3: [], 4: []
+        }
+        for index, classroom in reversed(list(enumerate(self))):
+            remaining_by_period[classroom.period].append((index, classroom))
+
+        for i in range(len(self)):
+            periods = [period for period in remaining_by_period if remaining_by_period[period]]
+            fullest = max(period_distribution[period] for period in periods)
+            # out of the fullest periods, yield the classroom which appears first in self
+            chosen_period = min(
+                (period for period in periods if period_distribution[period] == fullest),
+                key=lambda period: remaining_by_period[period][-1][0]
+            )
+            yield remaining_by_period[chosen_period].pop()[1]
 
     def sorted_by_eliminated_period_distribution_then_length(
-            self, period_distribution: dict[PeriodType, int]) -> Generator[Classroom]:
+            self, period_distribution: dict[PeriodType, int],
+            queue: EliminationQueue | None = None) -> Generator[Classroom]:
         """
         Sorts by order of periods which have the least number of tickets eliminated from,
         then by length.
+
+        If the tickets of the classrooms change between yields, pass in a queue and call
+        queue.update() on the changed classrooms so that they are re-sorted.
         """
-        classroom_copy = self.copy()
+        if queue is None:
+            queue = EliminationQueue(self)
 
-        for i in range(len(classroom_copy)):
+        for i in range(len(queue)):
             emptiest_period = min(
                 period_distribution,
                 key=lambda period: period_distribution[period]
             )
 
-            classrooms_in_period = [
-                classroom for classroom in classroom_copy
-                if classroom.period == emptiest_period
-            ]
-
-            if len(classrooms_in_period) > 0:
-                chosen_classroom = min(
-                    classrooms_in_period,
-                    key=lambda classroom: (
-                        not classroom.tickets.has_serenades,
-                        len(classroom.tickets),
-                        random.random())
-                )
-
-                classroom_copy.remove(chosen_classroom)
-                yield chosen_classroom
-            else:
+            # if there are no classrooms left in the emptiest period, stop considering it
+            while queue.num_remaining[emptiest_period] == 0:
                 del period_distribution[emptiest_period]
 
                 emptiest_period = min(
                     period_distribution,
                     key=lambda period: period_distribution[period]
                 )
-                classrooms_in_period = [
-                    classroom for classroom in classroom_copy
-                    if classroom.period == emptiest_period
-                ]
-
-                chosen_classroom = min(
-                    classrooms_in_period,
-                    key=lambda classroom: (
-                        not classroom.tickets.has_serenades,
-                        len(classroom.tickets), random.random())
-                )
 
-                classroom_copy.remove(chosen_classroom)
-                yield chosen_classroom
+            yield queue.pop(emptiest_period)
+
+
+class EliminationQueue:
+    """
+    A priority queue (one heap per period) of the classrooms still to be considered by
+    eliminate_classrooms. Classrooms with serenades come first, then the smallest classrooms,
+    with ties broken randomly (each classroom gets one random tiebreak, drawn when it is first pushed).
+
+    When a classroom's tickets change, call update() to re-key it. Old entries are left in the
+    heap and skipped when popped, so each pop is O(log n).
+    """
+    def __init__(self, classrooms: ClassroomList):
+        # seeded from the module's generator, so a seeded sort stays repeatable
+        self.random = random.Random(random.getrandbits(64))
+        # entries are (key, entry id, classroom)
+        self.heaps: dict[PeriodType, list[tuple]] = {1: [], 2: [], 3: [], 4: []}
+        self.num_remaining: dict[PeriodType, int] = {1: 0, 2: 0, 3: 0, 4: 0}
+        self.tiebreaks: dict[Classroom, float] = {}
+        # the id of the most recent entry of each classroom still in the queue
+        self.entry_ids: dict[Classroom, int] = {}
+        self.entry_counter = itertools.count()
+        for classroom in classrooms:
+            if classroom not in self.entry_ids:
+                self.num_remaining[classroom.period] += 1
+                self.push(classroom)
+
+    def __len__(self):
+        return len(self.entry_ids)
+
+    def key(self, classroom: Classroom) -> tuple[bool, int, float]:
+        return not classroom.tickets.has_serenades, len(classroom.tickets), self.tiebreaks[classroom]
+
+    def push(self, classroom: Classroom):
+        if classroom not in self.tiebreaks:
+            self.tiebreaks[classroom] = self.random.random()
+        entry_id = next(self.entry_counter)
+        self.entry_ids[classroom] = entry_id
+        heapq.heappush(self.heaps[classroom.period], (self.key(classroom), entry_id, classroom))
+
+    def update(self, classroom: Classroom):
+        """Re-keys the classroom (does nothing if it has already been popped)"""
+        if classroom in self.entry_ids:
+            self.push(classroom)
+
+    def pop(self, period: PeriodType) -> Classroom:
+        """Removes and returns the first classroom of the period"""
+        heap = self.heaps[period]
+        while True:
+            key, entry_id, classroom = heapq.heappop(heap)
+            # skip entries which have been replaced by update()
+            if self.entry_ids.get(classroom) == entry_id:
+                del self.entry_ids[classroom]
+                self.num_remaining[period] -= 1
+                return classroom
+
+
+class LocalSearch:
+    """
+    Improves a finished sort by moving tickets between the classrooms which are already being
+    visited. Two kinds of moves are tried:
+        - emptying a small classroom by moving each of its tickets to another of the recipient's
+          classrooms (removes a classroom visit). Of two small classrooms, the one in the period
+          with more visits is emptied first, which evens out the visits per period.
+        - moving a single ticket to another of the recipient's classrooms which is at least as big
+          (makes smaller classrooms easier to empty later on)
+
+    A move is only made if it doesn't make the sort worse, so the current sort is always the best
+    so far. Every move is checked in O(1) using the running counts kept by each classroom's tickets
+    and the number of visits per period.
+    """
+    def __init__(self, ticket_sorter: TicketSorter):
+        self.max_serenades_per_class = ticket_sorter.MAX_SERENADES_PER_CLASS
+        self.max_non_serenades_per_serenading_class = \
+            ticket_sorter.MAX_NON_SERENADES_PER_SERENADING_CLASS
+        self.extra_special_serenades = ticket_sorter.EXTRA_SPECIAL_SERENADES
+
+        # Classrooms which only hold special serenades (or are bad) are left alone
+        self.classrooms = [classroom for classroom in ticket_sorter.classrooms
+                           if classroom.is_valid and not classroom.is_special]
+        self.visits_per_period: dict[PeriodType, int] = {1: 0, 2: 0, 3: 0, 4: 0}
+        for classroom in dict.fromkeys(ticket_sorter.classrooms):
+            if len(classroom.tickets) > 0:
+                self.visits_per_period[classroom.period] += 1
+
+        # Special serenades are pinned to their period. If distribution is enforced, serenades
+        # were deliberately spread out over the recipient's periods, so they can't move either.
+        self.movable_item_types = ("Chocolate", "Rose") if ticket_sorter.ENFORCE_DISTRIBUTION \
+            else ("Chocolate", "Rose", "Serenade")
+        self.tickets = [ticket for ticket in ticket_sorter.tickets
+                        if ticket.item_type in self.movable_item_types and ticket.has_no_choice
+                        and ticket.chosen_classroom is not None
+                        and not ticket.chosen_classroom.is_special]
+
+        self.num_moves = 0
+        self.num_visits_removed = 0
+
+    def can_add(self, ticket: TicketToSort, classroom: Classroom,
+                added_serenades: int = 0, added_non_serenades: int = 0) -> bool:
+        """
+        Whether the ticket can be moved into the classroom (which must already be visited).
+        added_serenades and added_non_serenades are tickets about to be moved into the classroom.
+        """
+        if not classroom.is_valid or classroom.is_special or len(classroom.tickets) == 0:
+            return False
+
+        item_counts = classroom.tickets.item_counts
+        num_serenades = item_counts["Serenade"] + item_counts["Special Serenade"] + added_serenades
+        num_non_serenades = item_counts["Chocolate"] + item_counts["Rose"] + added_non_serenades
+
+        if ticket.item_type == "Serenade":
+            if self.extra_special_serenades and item_counts["Special Serenade"] > 0:
+                return False
+            if 0 < self.max_serenades_per_class <= num_serenades:
+                return False
+            num_serenades += 1
+        else:
+            num_non_serenades += 1
+
+        if num_serenades > 0 and 0 < self.max_non_serenades_per_serenading_class < num_non_serenades:
+            return False
+        return True
+
+    def empty_score(self, classroom: Classroom) -> tuple[int, int]:
+        """
+        How good emptying the classroom would be (lower is better): the number of tickets to move,
+        then the change in the sum of squared visits per period (i.e. how uneven the periods become)
+        """
+        return len(classroom.tickets), 1 - 2 * self.visits_per_period[classroom.period]
+
+    def try_move_ticket(self, ticket: TicketToSort) -> bool:
+        source = ticket.chosen_classroom
+        period = source.period
+        source_size = len(source.tickets)
+
+        for target_period in random.sample(range(1, 5), 4):
+            if target_period == period:
+                continue
+            target = ticket.classrooms[target_period - 1]
+            if not self.can_add(ticket, target):
+                continue
+
+            if source_size == 1:
+                # Empties the source classroom (so removes a visit)
+                self.move(ticket, target_period)
+                self.remove_visit(period)
+                return True
+            # Otherwise the number of visits stays the same, so only move into a classroom at least
+            # as big (moving back and forth between two classrooms can't keep being accepted)
+            if len(target.tickets) >= source_size:
+                self.move(ticket, target_period)
+                return True
+        return False
+
+    def try_empty_classroom(self, classroom: Classroom) -> bool:
+        if len(classroom.tickets) == 0:
+            return False
+
+        # Key: classroom being moved into. Value: (serenades, non-serenades) being added to it
+        added: dict[Classroom, tuple[int, int]] = {}
+        moves: list[tuple[TicketToSort, PeriodType]] = []
+
+        for ticket in classroom.tickets:
+            if ticket.item_type not in self.movable_item_types:
+                return False
+
+            # Prefer moving into the biggest classroom
+            best_target = None
+            for target_period in range(1, 5):
+                target = ticket.classrooms[target_period - 1]
+                if target_period == classroom.period or \
+                        not self.can_add(ticket, target, *added.get(target, (0, 0))):
+                    continue
+                if best_target is None or len(target.tickets) > len(best_target.tickets):
+                    best_target = target
+            if best_target is None:
+                return False
+
+            added_serenades, added_non_serenades = added.get(best_target, (0, 0))
+            if ticket.item_type == "Serenade":
+                added_serenades += 1
+            else:
+                added_non_serenades += 1
+            added[best_target] = (added_serenades, added_non_serenades)
+            moves.append((ticket, best_target.period))
+
+        for ticket, target_period in moves:
+            self.move(ticket, target_period)
+        self.remove_visit(classroom.period)
+        return True
+
+    def move(self, ticket: TicketToSort, period: PeriodType):
+        ticket.choose_period(period)
+        self.num_moves += 1
+
+    def remove_visit(self, period: PeriodType):
+        self.visits_per_period[period] -= 1
+        self.num_visits_removed += 1
+
+    def run(self, time_budget: float):
+        """Keeps making moves until the time budget (in seconds) runs out or nothing improves"""
+        if not self.tickets or not self.classrooms:
+            return
+
+        deadline = time.perf_counter() + time_budget
+        # Give up after this many attempts in a row without a move
+        max_failed_attempts = max(1000, 4 * (len(self.tickets) + len(self.classrooms)))
+        failed_attempts = 0
+
+        while failed_attempts < max_failed_attempts and time.perf_counter() < deadline:
+            if random.random() < 0.5:
+                # Try to empty the better of two random classrooms
+                classroom = min(random.choice(self.classrooms), random.choice(self.classrooms),
+                                key=self.empty_score)
+                moved = self.try_empty_classroom(classroom)
+            else:
+                moved = self.try_move_ticket(random.choice(self.tickets))
+
+            failed_attempts = 0 if moved else failed_attempts + 1
+
+
+class ExactOptimiser:
+    """
+    Re-solves a finished sort as a mixed-integer program (with scipy's milp, which uses HiGHS):
+    every ticket goes to exactly one of its recipient's classrooms, and the number of classrooms
+    visited is minimised. Also finds a lower bound on the number of visits, so the optimality gap
+    of the sort can be reported.
+
+    The sort being improved is always a valid solution: special serenades stay where they are, and
+    classrooms (and recipients' periods, if distribution is enforced) are allowed to be as full as
+    they already are even if that's over the limits. The number of visits is constrained to be no
+    more than the current sort, so the solver only searches for better sorts.
+    """
+    def __init__(self, ticket_sorter: TicketSorter):
+        self.ticket_sorter = ticket_sorter
+        # Tickets which couldn't be given any classroom are left out
+        self.tickets = [ticket for ticket in ticket_sorter.tickets if ticket.available]
+        self.ticket_indices = {ticket: index for index, ticket in enumerate(self.tickets)}
+        # Statistics about the optimisation (added to the SortReport)
+        self.result: dict[str, Any] = {}
+
+        # Each ticket's chosen classroom and the classrooms it could be moved to (including itself)
+        self.options: list[list[Classroom]] = []
+        # Regular classrooms with special serenades (no serenades can be added to them)
+        special_serenade_classrooms = {
+            ticket.chosen_classroom for ticket in self.tickets if ticket.item_type == "Special Serenade"}
+
+        for ticket in self.tickets:
+            chosen_classroom = ticket.chosen_classroom
+            if ticket.item_type == "Special Serenade":
+                options = [chosen_classroom]
+            else:
+                options = [classroom for classroom in ticket.classrooms if classroom.is_valid and not (
+                    ticket.item_type == "Serenade" and ticket_sorter.EXTRA_SPECIAL_SERENADES
+                    and classroom in special_serenade_classrooms and classroom is not chosen_classroom)]
+            self.options.append(options)
+
+        # Every classroom which could be visited (in a fixed order)
+        self.classrooms: dict[Classroom, int] = {}
+        for options in self.options:
+            for classroom in options:
+                self.classrooms.setdefault(classroom, len(self.classrooms))
+
+    def build(self):
+        """Builds the matrices of the mixed-integer program: variables are x (ticket in classroom),
+        then y (classroom visited), then z (classroom has a serenade)"""
+        from scipy.sparse import csr_matrix
+
+        ticket_sorter = self.ticket_sorter
+        max_serenades = ticket_sorter.MAX_SERENADES_PER_CLASS
+        max_non_serenades = ticket_sorter.MAX_NON_SERENADES_PER_SERENADING_CLASS
+
+        # Column of each x variable
+        x_columns: list[list[int]] = []
+        num_x = 0
+        for options in self.options:
+            x_columns.append(list(range(num_x, num_x + len(options))))
+            num_x += len(options)
+        num_y = len(self.classrooms)
+        y_start = num_x
+        z_start = num_x + num_y
+
+        rows: list[int] = []
+        columns: list[int] = []
+        values: list[float] = []
+        lower_bounds: list[float] = []
+        upper_bounds: list[float] = []
+
+        def add_row(row_columns: list[int], row_values: list[float], lower: float, upper: float):
+            row = len(lower_bounds)
+            rows.extend([row] * len(row_columns))
+            columns.extend(row_columns)
+            values.extend(row_values)
+            lower_bounds.append(lower)
+            upper_bounds.append(upper)
+
+        # The x variables of each classroom, split into serenades and non-serenades
+        serenade_columns: dict[Classroom, list[int]] = {classroom: [] for classroom in self.classrooms}
+        non_serenade_columns: dict[Classroom, list[int]] = {classroom: [] for classroom in self.classrooms}
+        # Key: (recipient, period). Value: the x variables of that recipient's serenades in that period
+        recipient_columns: dict[tuple[str, int], list[int]] = {}
+
+        for ticket, options, ticket_columns in zip(self.tickets, self.options, x_columns):
+            # Each ticket is delivered exactly once
+            add_row(ticket_columns, [1] * len(ticket_columns), 1, 1)
+
+            is_serenade = ticket.item_type in ("Serenade", "Special Serenade")
+            for classroom, column in zip(options, ticket_columns):
+                # A ticket can only be delivered to a classroom which is visited
+                add_row([column, y_start + self.classrooms[classroom]], [1, -1], -math.inf, 0)
+                if is_serenade:
+                    serenade_columns[classroom].append(column)
+                    recipient_columns.setdefault((ticket.recipient_id, classroom.period), []).append(column)
+                else:
+                    non_serenade_columns[classroom].append(column)
+
+        num_z = 0
+        for classroom, y_index in self.classrooms.items():
+            num_serenades = classroom.tickets.num_serenades
+            num_non_serenades = classroom.tickets.num_non_serenades
+
+            # Limit serenades (but allow as many as there already are)
+            serenade_limit = max(max_serenades, num_serenades)
+            if max_serenades > 0 and len(serenade_columns[classroom]) > serenade_limit:
+                add_row(serenade_columns[classroom], [1] * len(serenade_columns[classroom]),
+                        -math.inf, serenade_limit)
+
+            # Limit non-serenades if there is a serenade (but allow as many as there already are)
+            non_serenade_limit = max(max_non_serenades, num_non_serenades if num_serenades > 0 else 0)
+            excess = len(non_serenade_columns[classroom]) - non_serenade_limit
+            if max_non_serenades > 0 and serenade_columns[classroom] and excess > 0:
+                z_column = z_start + num_z
+                num_z += 1
+                for column in serenade_columns[classroom]:
+                    add_row([column, z_column], [1, -1], -math.inf, 0)
+                # i.e. non-serenades <= limit if there is a serenade (z = 1), otherwise no limit
+                add_row(non_serenade_columns[classroom] + [z_column],
+                        [1] * len(non_serenade_columns[classroom]) + [excess],
+                        -math.inf, non_serenade_limit + excess)
+
+        # Spread each recipient's serenades over their periods (but allow as many as there already are)
+        if ticket_sorter.ENFORCE_DISTRIBUTION:
+            recipient_serenades: dict[str, list[TicketToSort]] = {}
+            for ticket in self.tickets:
+                if ticket.item_type in ("Serenade", "Special Serenade"):
+                    recipient_serenades.setdefault(ticket.recipient_id, []).append(ticket)
+
+            for (recipient_id, period), recipient_period_columns in recipient_columns.items():
+                serenades = recipient_serenades[recipient_id]
+                num_periods = len({classroom.period for ticket in serenades
+                                   for classroom in self.options[self.ticket_indices[ticket]]})
+                num_already = sum(1 for ticket in serenades if ticket.chosen_period == period)
+                limit = max(math.ceil(len(serenades) / num_periods), num_already)
+                if len(recipient_period_columns) > limit:
+                    add_row(recipient_period_columns, [1] * len(recipient_period_columns), -math.inf, limit)
+
+        # Only search for sorts which are at least as good as the current one
+        num_visits = sum(1 for classroom in self.classrooms if len(classroom.tickets) > 0)
+        add_row(list(range(y_start, y_start + num_y)), [1] * num_y, 0, num_visits)
+
+        num_variables = num_x + num_y + num_z
+        matrix = csr_matrix((values, (rows, columns)), shape=(len(lower_bounds), num_variables))
+        # HiGHS only accepts 32-bit indices (sparse arrays use 64-bit ones)
+        matrix.indices = matrix.indices.astype(np.int32)
+        matrix.indptr = matrix.indptr.astype(np.int32)
+        objective = [0] * num_x + [1] * num_y + [0] * num_z
+        return x_columns, objective, matrix, lower_bounds, upper_bounds, num_visits
+
+    def run(self, time_limit: float):
+        """Solves for up to time_limit seconds, then uses the best sort found (if better)"""
+        from scipy.optimize import milp, LinearConstraint, Bounds
+
+        x_columns, objective, matrix, lower_bounds, upper_bounds, num_visits = self.build()
+
+        start_time = time.perf_counter()
+        solution = milp(
+            objective,
+            constraints=LinearConstraint(matrix, lower_bounds, upper_bounds),
+            integrality=[1] * len(objective),
+            bounds=Bounds(0, 1),
+            options={"time_limit": time_limit, "disp": False},
+        )
+
+        self.result = {
+            "status": solution.message,
+            "seconds": round(time.perf_counter() - start_time, 4),
+            "visits_before": num_visits,
+            "visits_after": num_visits,
+            "lower_bound": None,
+            "gap": None,
+            # False if the time limit was hit before the solver found any sort (so the sort is unchanged)
+            "found_solution": solution.x is not None,
+        }
+        if getattr(solution, "mip_dual_bound", None) is not None:
+            self.result["lower_bound"] = math.ceil(solution.mip_dual_bound - 1e-6)
+
+        if solution.x is not None and solution.fun < num_visits - 0.5:
+            self.apply(x_columns, solution.x)
+            self.result["visits_after"] = round(solution.fun)
+
+        if self.result["lower_bound"] is not None:
+            visits = self.result["visits_after"]
+            self.result["gap"] = round((visits - self.result["lower_bound"]) / max(1, visits), 4)
+
+    def apply(self, x_columns: list[list[int]], x: Sequence[float]):
+        for ticket, options, ticket_columns in zip(self.tickets, self.options, x_columns):
+            classroom = max(zip(options, ticket_columns), key=lambda option: x[option[1]])[0]
+            if classroom is not ticket.chosen_classroom:
+                ticket.choose_period(classroom.period)
+
+        # Some classrooms which had been eliminated may be visited again
+        classrooms = self.ticket_sorter.classrooms
+        for classroom in self.classrooms:
+            if len(classroom.tickets) > 0 and classroom not in classrooms:
+                classrooms.append(classroom)
+        self.ticket_sorter.cleanup_classrooms()
 
 
 class Person:
@@ -712,7 +1595,7 @@ class Person:
         self.tickets = TicketList()
 
     def __repr__(self):
-        return STUDENTS[self.id]['Name']
+        return self.id
 
     def num_items(self, items: tuple) -> int:
         num_items = 0
@@ -725,24 +1608,25 @@ class Person:
 class People(list):
     def __init__(self, tickets: TicketList):
         super().__init__(self)
+        # Key: student id. Value: the Person in this list with that id (makes lookups O(1))
+        self._index: dict[str, Person] = {}
         for ticket in tickets:
-            new_person = Person(ticket.recipient_id)
-            if new_person in self:
-                existing_person = self.get_existing_person(new_person)
-                existing_person.tickets.append(ticket)
-            else:
-                new_person.tickets.append(ticket)
-                self.append(new_person)
+            person = self._index.get(ticket.recipient_id)
+            if person is None:
+                person = Person(ticket.recipient_id)
+                self._index[person.id] = person
+                self.append(person)
+            person.tickets.append(ticket)
 
     def __contains__(self, person: Person):
-        return person.id in map(lambda existing_person: existing_person.id, self)
+        return person.id in self._index
 
     def get_existing_person(self, new_person: Person) -> Person:
         # gets an existing person in the list, given a new Person object with the same name
-        for existing_person in self:
-            if existing_person.id == new_person.id:
-                return existing_person
-        raise KeyError("Person not found")
+        try:
+            return self._index[new_person.id]
+        except KeyError:
+            raise KeyError("Person not found")
 
     def grouped_by_num_items(
             self, items: Sequence[ItemType] | None = None, reverse: bool = True):
@@ -815,51 +1699,98 @@ class PeriodGroupList(list):
         return list((a[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)))
 
     def distribute_classrooms(self):
-        search_depth = 0
-        min_group_ticket_range = 0
-        state = []
-        while True:
-            fullest_group = self.fullest_group
-            emptiest_group = self.emptiest_group
-            fullest_group_index = self.index(fullest_group)
-            emptiest_group_index = self.index(emptiest_group)
-            if min_group_ticket_range == 0:
-                min_group_ticket_range = fullest_group.num_tickets - emptiest_group.num_tickets
-
-            if fullest_group_index < emptiest_group_index:
-                for index in range(fullest_group_index, emptiest_group_index):
-                    period_group = self[index]
-                    last_classroom = period_group.classrooms.pop()
-                    self[index + 1].classrooms.insert(0, last_classroom)
-            elif emptiest_group_index < fullest_group_index:
-                for index in range(fullest_group_index, emptiest_group_index, -1):
-                    period_group = self[index]
-                    last_classroom = period_group.classrooms.pop(0)
-                    self[index - 1].classrooms.append(last_classroom)
-            else:
-                # print("TicketSorter: Fullest group and emptiest group are the same size.")
-                return
-
-            fullest_group = self.fullest_group
-            emptiest_group = self.emptiest_group
-            # the difference in the number of tickets between the fullest and emptiest group
-            new_group_ticket_range = fullest_group.num_tickets - emptiest_group.num_tickets
-
-            if new_group_ticket_range < min_group_ticket_range:
-                min_group_ticket_range = new_group_ticket_range
-                search_depth = 0
-                # save state so that any further iterations don't mess it up
-                state = [tuple(group.classrooms) for group in self]
-            else:
-                # algorithm will keep searching 7 iterations after it has found a local min
-                search_depth += 1
-                if search_depth >= 7:
-                    break
+        """
+        Redistributes the classrooms (keeping their geographic order) so that the fullest group
+        has as few tickets as possible, while keeping the groups as even as possible.
+        """
+        classrooms = [classroom for period_group in self for classroom in period_group.classrooms]
+        loads = [len(classroom.tickets) for classroom in classrooms]
+
+        boundaries = self.partition(loads, len(self))
+        for index, period_group in enumerate(self):
+            period_group.classrooms = ClassroomList(
+                classrooms[boundaries[index]:boundaries[index + 1]])
+
+    @staticmethod
+    def partition(loads: list[int], num_groups: int) -> list[int]:
+        """
+        Splits a list of loads into num_groups contiguous groups such that the largest group total
+        is minimised. Every group gets at least one load if there are enough loads.
+
+        The minimum largest total is found by binary searching over it, checking each guess with a
+        greedy pass (O(n log S) where S is the sum of the loads). The boundaries are then picked so
+        that each group is as close as possible to an even split of what is left, without going
+        over that total.
 
-        # restore from state
-        if len(state) > 0:
-            for index, period_group in enumerate(self):
-                period_group.classrooms = ClassroomList(state[index])
+        :return: The boundaries of the groups, i.e. group i is loads[boundaries[i]:boundaries[i + 1]]
+        """
+        num_loads = len(loads)
+        prefix_sums = [0, *itertools.accumulate(loads)]
+
+        def get_next_boundaries(max_load: int) -> list[int]:
+            # next_boundaries[i] is the furthest a group starting at i can go without exceeding
+            # max_load (assumes no individual load exceeds max_load)
+            next_boundaries = [num_loads] * (num_loads + 1)
+            end = 0
+            for start in range(num_loads):
+                end = max(end, start + 1)
+                while end < num_loads and prefix_sums[end + 1] - prefix_sums[start] <= max_load:
+                    end += 1
+                next_boundaries[start] = end
+            return next_boundaries
+
+        def num_groups_required(max_load: int) -> int:
+            num_required = 0
+            start = 0
+            while start < num_loads:
+                end = bisect.bisect_right(prefix_sums, prefix_sums[start] + max_load, start + 1) - 1
+                start = max(end, start + 1)
+                num_required += 1
+            return num_required
+
+        # binary search the smallest max_load which can be done in num_groups
+        low = max(loads, default=0)
+        high = prefix_sums[-1]
+        while low < high:
+            middle = (low + high) // 2
+            if num_groups_required(middle) <= num_groups:
+                high = middle
+            else:
+                low = middle + 1
+        max_load = low
+
+        # groups_required[i] is the number of groups needed for loads[i:] (greedily packing them)
+        next_boundaries = get_next_boundaries(max_load)
+        groups_required = [0] * (num_loads + 1)
+        for start in range(num_loads - 1, -1, -1):
+            groups_required[start] = 1 + groups_required[next_boundaries[start]]
+
+        boundaries = [0]
+        start = 0
+        for group_index in range(num_groups):
+            num_groups_left = num_groups - group_index
+
+            # the group can't go past max_load, and must leave few enough loads for the other groups
+            # to fit under max_load (and enough for them to get at least one each, if possible)
+            earliest_end = start
+            while groups_required[earliest_end] > num_groups_left - 1:
+                earliest_end += 1
+            latest_end = next_boundaries[start] if start < num_loads else num_loads
+            if num_loads - start >= num_groups_left:
+                earliest_end = max(earliest_end, start + 1)
+                latest_end = min(latest_end, num_loads - num_groups_left + 1)
+
+            # out of those, pick the end which is closest to an even split of the remaining load
+            target = prefix_sums[start] + (prefix_sums[-1] - prefix_sums[start]) / num_groups_left
+            end = bisect.bisect_left(prefix_sums, target, earliest_end, latest_end + 1)
+            if end > latest_end or (end > earliest_end and
+                                    target - prefix_sums[end - 1] <= prefix_sums[end] - target):
+                end -= 1
+
+            boundaries.append(end)
+            start = end
+
+        return boundaries
 
     def sort_tickets_by_person(self):
         for period_group in self:
@@ -902,10 +1833,37 @@ class DeliveryGroup:
         self.p3 = ClassroomList()
         self.p4 = ClassroomList()
 
+        # Running count of each item type in this group. Updated by set_classrooms()
+        self.item_counts: dict[ItemType, int] = {item_type: 0 for item_type in ITEM_TYPES}
+
     def __repr__(self):
         return f"<DeliveryGroup:{self.name} " \
                f"{len(self.p1)} {len(self.p2)} {len(self.p3)} {len(self.p4)} " \
-               f"s={self.tickets.num_serenades} N={len(self.tickets)}>"
+               f"s={self.num_serenades} N={self.num_tickets}>"
+
+    def set_classrooms(self, period: PeriodType, classrooms: ClassroomList):
+        """Assigns the classrooms to visit in a period, replacing any previous ones"""
+        for classroom in getattr(self, f"p{period}"):
+            for item_type, count in classroom.tickets.item_counts.items():
+                self.item_counts[item_type] -= count
+
+        setattr(self, f"p{period}", classrooms)
+
+        for classroom in classrooms:
+            for item_type, count in classroom.tickets.item_counts.items():
+                self.item_counts[item_type] += count
+
+    @property
+    def num_tickets(self) -> int:
+        return sum(self.item_counts.values())
+
+    @property
+    def num_serenades(self) -> int:
+        return self.item_counts["Serenade"] + self.item_counts["Special Serenade"]
+
+    @property
+    def num_non_serenades(self) -> int:
+        return self.item_counts["Chocolate"] + self.item_counts["Rose"]
 
     @property
     def name(self):
@@ -936,7 +1894,7 @@ class DeliveryGroupList(list):
         for i in range(len(empty_delivery_groups)):
             emptiest_period_group = period_groups.emptiest_group
             fullest_delivery_group = empty_delivery_groups.fullest_group
-            setattr(fullest_delivery_group, f"p{period}", emptiest_period_group.classrooms)
+            fullest_delivery_group.set_classrooms(period, emptiest_period_group.classrooms)
             period_groups.remove(emptiest_period_group)
             empty_delivery_groups.remove(fullest_delivery_group)
 
@@ -947,7 +1905,7 @@ class DeliveryGroupList(list):
     @property
     def fullest_group(self) -> DeliveryGroup:
         if len(self) > 1:
-            return max(self, key=lambda group: len(group.tickets))
+            return max(self, key=lambda group: group.num_tickets)
         elif len(self) == 1:
             return self[0]
         else:
@@ -956,17 +1914,381 @@ class DeliveryGroupList(list):
     @property
     def emptiest_group(self) -> DeliveryGroup:
         if len(self) > 1:
-            return min(self, key=lambda group: len(group.tickets))
+            return min(self, key=lambda group: group.num_tickets)
         elif len(self) == 1:
             return self[0]
         else:
             raise KeyError("Cannot return min of blank.")
 
 
+class SortReport:
+    """
+    Statistics about the output of a TicketSorter, built in a single pass over the output.
+    Can be converted to and from JSON so that it can be stored with the SortTicketsRequest.
+    """
+    def __init__(self):
+        self.visits_per_period: dict[PeriodType, int] = {1: 0, 2: 0, 3: 0, 4: 0}
+        self.item_types: dict[ItemType, int] = {
+            "Chocolate": 0, "Rose": 0, "Serenade": 0, "Special Serenade": 0}
+        # Key: number of tickets in a classroom visit. Value: number of classroom visits that size
+        self.classroom_sizes: dict[int, int] = {}
+        # One dict for each group with its name, number of classrooms and tickets of each type
+        self.serenading_groups: list[dict[str, Any]] = []
+        self.non_serenading_groups: list[dict[str, Any]] = []
+        self.special_classrooms: list[str] = []
+        self.bad_classrooms: list[str] = []
+        # One dict for each ticket which wasn't put in any group with its pk and recipient
+        self.undelivered_tickets: list[dict[str, Any]] = []
+        # If multiple seeds were tried, one dict for each seed with its visits and imbalance (best first)
+        self.starts: list[dict[str, Any]] = []
+        # If the exact optimiser was used, its status, visits before and after, lower bound and gap
+        self.optimiser: dict[str, Any] | None = None
+
+    @classmethod
+    def from_ticket_sorter(cls, ticket_sorter: TicketSorter):
+        self = cls()
+
+        for classroom in ticket_sorter.classrooms:
+            self.visits_per_period[classroom.period] += 1
+            size = len(classroom.tickets)
+            self.classroom_sizes[size] = self.classroom_sizes.get(size, 0) + 1
+        self.classroom_sizes = dict(sorted(self.classroom_sizes.items()))
+
+        for ticket in ticket_sorter.tickets:
+            self.item_types[ticket.item_type] += 1
+
+        delivered_tickets: set[TicketToSort] = set()
+        for groups, group_reports in (
+                (ticket_sorter.output_serenading_groups, self.serenading_groups),
+                (ticket_sorter.output_non_serenading_groups, self.non_serenading_groups)):
+            for group in groups:
+                for period in range(1, 5):
+                    for classroom in getattr(group, f"p{period}"):
+                        delivered_tickets.update(classroom.tickets)
+
+                group_reports.append({
+                    "name": group.name,
+                    "classrooms": group.num_classrooms,
+                    "serenades": group.num_serenades,
+                    "non_serenades": group.num_non_serenades,
+                    "total": group.num_tickets,
+                })
+
+        self.special_classrooms = [
+            f"{classroom} ({classroom.clean_name})" for classroom in ticket_sorter.special_classrooms]
+        self.bad_classrooms = [str(classroom) for classroom in ticket_sorter.bad_classrooms]
+
+        self.undelivered_tickets = [
+            {"pk": ticket.pk, "recipient_id": ticket.recipient_id, "item_type": ticket.item_type}
+            for ticket in ticket_sorter.all_tickets if ticket not in delivered_tickets
+        ]
+
+        self.optimiser = ticket_sorter.optimiser_result
+
+        return self
+
+    @property
+    def total_visits(self) -> int:
+        return sum(self.visits_per_period.values())
+
+    @property
+    def total_tickets(self) -> int:
+        return sum(self.item_types.values())
+
+    @property
+    def average_classroom_size(self) -> float:
+        total_tickets = sum(size * number for size, number in self.classroom_sizes.items())
+        return round(total_tickets / max(1, self.total_visits), 3)
+
+    @property
+    def total_serenading_groups(self) -> int:
+        return sum(group["total"] for group in self.serenading_groups)
+
+    @property
+    def total_non_serenading_groups(self) -> int:
+        return sum(group["non_serenades"] for group in self.non_serenading_groups)
+
+    @property
+    def group_imbalance(self) -> int:
+        """The difference in tickets between the fullest and emptiest group (summed for both types)"""
+        imbalance = 0
+        for groups in (self.serenading_groups, self.non_serenading_groups):
+            if groups:
+                totals = [group["total"] for group in groups]
+                imbalance += max(totals) - min(totals)
+        return imbalance
+
+    def to_json(self) -> dict[str, Any]:
+        """Note: JSON keys must be strings, so the keys of periods and sizes become strings"""
+        return {
+            "visits_per_period": {str(period): number
+                                  for period, number in self.visits_per_period.items()},
+            "total_visits": self.total_visits,
+            "item_types": self.item_types,
+            "total_tickets": self.total_tickets,
+            "classroom_sizes": {str(size): number for size, number in self.classroom_sizes.items()},
+            "average_classroom_size": self.average_classroom_size,
+            "serenading_groups": self.serenading_groups,
+            "total_serenading_groups": self.total_serenading_groups,
+            "non_serenading_groups": self.non_serenading_groups,
+            "total_non_serenading_groups": self.total_non_serenading_groups,
+            "group_imbalance": self.group_imbalance,
+            "special_classrooms": self.special_classrooms,
+            "bad_classrooms": self.bad_classrooms,
+            "undelivered_tickets": self.undelivered_tickets,
+            "starts": self.starts,
+            "optimiser": self.optimiser,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]):
+        self = cls()
+        self.visits_per_period = {int(period): number
+                                  for period, number in data["visits_per_period"].items()}
+        self.item_types = data["item_types"]
+        self.classroom_sizes = {int(size): number for size, number in data["classroom_sizes"].items()}
+        self.serenading_groups = data["serenading_groups"]
+        self.non_serenading_groups = data["non_serenading_groups"]
+        self.special_classrooms = data["special_classrooms"]
+        self.bad_classrooms = data["bad_classrooms"]
+        self.undelivered_tickets = data["undelivered_tickets"]
+        self.starts = data.get("starts", [])
+        self.optimiser = data.get("optimiser")
+        return self
+
+    def __str__(self):
+        lines = ["Number of Classroom Visits Per Period:"]
+        for period, number in self.visits_per_period.items():
+            lines.append(f"\tPeriod {period}: {number}")
+        lines.append(f"Total: {self.total_visits}")
+
+        lines.append("\nNumber of Tickets Per Item Type:")
+        for item_type, number in self.item_types.items():
+            lines.append(f"\t{item_type}: {number}")
+        lines.append(f"Total: {self.total_tickets}")
+
+        lines.append("\nNumber of items per classroom visit:")
+        for size, number in self.classroom_sizes.items():
+            lines.append(f"\t{size}: {number}\t{'|' * number}")
+        lines.append(f"Average: {self.average_classroom_size}")
+
+        lines.append("\nTickets per serenading group:")
+        for group in self.serenading_groups:
+            lines.append(f"\tClassrooms: {group['classrooms']} \t| "
+                         f"Serenades: {group['serenades']}\t"
+                         f"+ Non-serenades: {group['non_serenades']} "
+                         f"= Total: {group['total']}")
+        lines.append(f"Total: {self.total_serenading_groups}")
+
+        lines.append("\nTickets per non-serenading group:")
+        for group in self.non_serenading_groups:
+            lines.append(f"\tClassrooms: {group['classrooms']} \t| "
+                         f"Non-serenades: {group['non_serenades']}")
+        lines.append(f"Total: {self.total_non_serenading_groups}")
+        lines.append(f"\nTotal (both types): "
+                     f"{self.total_serenading_groups + self.total_non_serenading_groups}")
+
+        if len(self.special_classrooms) > 0:
+            lines.append("\nSpecial Classrooms:")
+            lines.extend(f"\t{classroom}" for classroom in self.special_classrooms)
+
+        if len(self.bad_classrooms) > 0:
+            lines.append("\nBad Classrooms:")
+            lines.extend(f"\t{classroom}" for classroom in self.bad_classrooms)
+
+        if len(self.undelivered_tickets) > 0:
+            lines.append("\nUndelivered Tickets:")
+            lines.extend(f"\t<{ticket['pk']} {ticket['recipient_id']} {ticket['item_type']}>"
+                         for ticket in self.undelivered_tickets)
+
+        if self.optimiser is not None:
+            lines.append(f"\nExact Optimiser ({self.optimiser['status']}):")
+            if self.optimiser.get("found_solution") is False:
+                lines.append(f"\tNo solution found (visits unchanged at {self.optimiser['visits_before']})")
+            else:
+                lines.append(f"\tVisits: {self.optimiser['visits_before']} -> {self.optimiser['visits_after']}")
+            if self.optimiser["lower_bound"] is None:
+                lines.append("\tNo lower bound found")
+            else:
+                lines.append(f"\tLower bound: {self.optimiser['lower_bound']}\tGap: {self.optimiser['gap']}")
+
+        if len(self.starts) > 0:
+            lines.append(f"\nSeeds Tried (used seed {self.starts[0]['seed']}):")
+            lines.extend(f"\tSeed {start['seed']}: Visits: {start['visits']}\t"
+                         f"Imbalance: {start['group_imbalance']}\tSeconds: {start['seconds']}"
+                         for start in self.starts)
+            visits = [start["visits"] for start in self.starts]
+            lines.append(f"Visits: {min(visits)} to {max(visits)}")
+
+        return "\n".join(lines)
+
+
+class ClassroomCache:
+    """
+    Keeps the chosen_classrooms of recent sorts (least recently used are removed first).
+    The key is a hash of the tickets and every option which affects which classrooms are chosen.
+
+    Entries are kept in memory, which only lasts as long as the process. If a directory is given,
+    they're also saved there as JSON files so that they're shared with every other process using
+    the same directory (e.g. each sort worker) and survive restarts. Values must be JSON
+    serialisable (tuples come back as lists).
+    """
+    def __init__(self, max_entries: int = 8, directory: str | None = None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self._entries: collections.OrderedDict[str, Any] = collections.OrderedDict()
+
+    def __len__(self):
+        if self.directory is not None:
+            return len(self.get_paths())
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(tickets: TicketList, options: dict[str, Any]) -> str:
+        """Must be made before sorting (while the classrooms of the tickets are still names)"""
+        key = hashlib.sha256()
+        for ticket in tickets:
+            key.update(repr((ticket.pk, ticket.recipient_id, ticket.item_type, ticket.ss_period,
+                             ticket.classrooms)).encode())
+        key.update(json.dumps(options, sort_keys=True).encode())
+        return key.hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get_paths(self) -> list[str]:
+        """The files of the entries in the directory, least recently used first"""
+        paths = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                path = os.path.join(self.directory, name)
+                with contextlib.suppress(FileNotFoundError):
+                    paths.append((os.path.getmtime(path), path))
+        return [path for modified, path in sorted(paths)]
+
+    def get(self, key: str) -> Any | None:
+        if key not in self._entries and self.directory is not None:
+            try:
+                with open(self.get_path(key)) as file:
+                    self._entries[key] = json.load(file)
+            except FileNotFoundError:
+                return None
+
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        value = self._entries[key]
+
+        if self.directory is not None:
+            # marks the entry as recently used for every process
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(self.get_path(key))
+        self.remove_old_entries()
+        return value
+
+    def set(self, key: str, value: Any):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        if self.directory is not None:
+            # other processes may be reading it, so never leave a half-written file
+            path = self.get_path(key)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "w") as file:
+                json.dump(value, file)
+            os.replace(temp_path, path)
+
+        self.remove_old_entries()
+
+    def remove_old_entries(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        if self.directory is not None:
+            paths = self.get_paths()
+            for path in paths[:max(0, len(paths) - self.max_entries)]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+    def clear(self):
+        self._entries.clear()
+        if self.directory is not None:
+            for path in self.get_paths():
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+
+# Shared by every sort in this process (see sorting.py for the cache shared by every process)
+CLASSROOM_CACHE = ClassroomCache()
+
+
+class SortProfile:
+    """
+    Records how long each phase of a TicketSorter takes, how many tickets and classrooms the
+    sorter has after it, and (if measuring memory) the peak memory allocated during it.
+    """
+    def __init__(self, ticket_sorter: TicketSorter, measure_memory: bool = False,
+                 on_phase: Callable[[str], None] | None = None):
+        self.ticket_sorter = ticket_sorter
+        # Measuring memory uses tracemalloc, which slows down sorting
+        self.measure_memory = measure_memory
+        # Called with the name of each phase as it starts
+        self.on_phase = on_phase
+        # One dict for each phase with its name, seconds, tickets, classrooms (and peak_memory)
+        self.phases: list[dict[str, Any]] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        if self.on_phase is not None:
+            self.on_phase(name)
+        if self.measure_memory:
+            start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start_time = time.perf_counter()
+
+        yield
+
+        phase = {
+            "name": name,
+            "seconds": round(time.perf_counter() - start_time, 4),
+            "tickets": len(self.ticket_sorter.tickets),
+            "classrooms": len(self.ticket_sorter.classrooms),
+        }
+        if self.measure_memory:
+            phase["peak_memory"] = tracemalloc.get_traced_memory()[1] - start_memory  # noqa
+        self.phases.append(phase)
+
+    @property
+    def total_seconds(self) -> float:
+        return round(sum(phase["seconds"] for phase in self.phases), 4)
+
+    def to_json(self) -> dict[str, Any]:
+        return {"phases": self.phases, "total_seconds": self.total_seconds}
+
+    def __str__(self):
+        lines = ["Phase\tSeconds\tTickets\tClassrooms\tPeak Memory (KB)"]
+        for phase in self.phases:
+            peak_memory = round(phase["peak_memory"] / 1024) if "peak_memory" in phase else "-"
+            lines.append(f"{phase['name']}\t{phase['seconds']}\t{phase['tickets']}\t"
+                         f"{phase['classrooms']}\t{peak_memory}")
+        lines.append(f"Total: {self.total_seconds}")
+        return "\n".join(lines)
+
+
 class TicketSorter:
     def __init__(self, tickets: list, serenading_groups: int, non_serenading_groups: int,
                  max_serenades_per_class: int = 2, max_non_serenades_per_serenading_class: int = 3,
-                 extra_special_serenades: bool = True, enforce_distribution: bool = True):
+                 extra_special_serenades: bool = True, enforce_distribution: bool = True,
+                 improve_time_budget: float = 0, optimise_time_limit: float = 0,
+                 split_components: bool = False, use_arrays: bool = False, measure_memory: bool = False,
+                 choose_classrooms_only: bool = False,
+                 chosen_classrooms: list[tuple[str, PeriodType, bool, list[int]]] | None = None,
+                 on_phase: Callable[[str], None] | None = None):
+        """
+        chosen_classrooms: the chosen_classrooms of a previous TicketSorter with the same tickets and
+            options (besides the number of groups). Skips straight to assigning them to groups.
+        on_phase: called with the name of each phase as it starts (to show progress)
+        """
         """Options (Disclaimer: enabling an option does not guarantee that it is always true)"""
         # Special serenades will not be grouped with regular serenades (ignores non-serenades).
         # Less efficient but nicer for those who receive special serenades.
@@ -991,6 +2313,23 @@ class TicketSorter:
         # set to 0 to disable limiting
         self.MAX_NON_SERENADES_PER_SERENADING_CLASS = max_non_serenades_per_serenading_class
 
+        # How many seconds to spend trying to improve the sort after eliminating classrooms.
+        # Set to 0 to skip improving.
+        self.IMPROVE_TIME_BUDGET = improve_time_budget
+
+        # How many seconds the exact optimiser (needs scipy) can spend improving the sort and
+        # finding how far from optimal it is. Set to 0 to skip optimising.
+        self.OPTIMISE_TIME_LIMIT = optimise_time_limit
+
+        # Tickets only affect each other if they share a classroom, so the tickets can be split into
+        # groups which don't share any (components) and each component sorted separately
+        # (in parallel). Faster for big schools, but the periods may be less evenly balanced.
+        self.SPLIT_COMPONENTS = split_components
+
+        # Chooses the classrooms with numpy arrays (see ArraySorter) instead of the objects below.
+        # Faster for very large schools, but follows the options above less strictly.
+        self.USE_ARRAYS = use_arrays
+
         """Constants"""
         # These two are mutually exclusive
         # (you cannot be both a serenading group AND a non-serenading group)
@@ -1002,53 +2341,322 @@ class TicketSorter:
         # with their assigned tickets as attributes
         self.output_serenading_groups = DeliveryGroupList()
         self.output_non_serenading_groups = DeliveryGroupList()
+        # Statistics about the output
+        self.report: SortReport | None = None
+        # Statistics about the exact optimiser (if used)
+        self.optimiser_result: dict[str, Any] | None = None
+        # How long each phase of the sort took
+        self.profile = SortProfile(self, measure_memory, on_phase)
+
+        started_tracing = measure_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
 
         """Methods"""
         self.all_tickets = TicketList(tickets)
+        # How many tickets have been fixed to each period. Kept up to date by the tickets themselves
+        self.period_distribution = PeriodDistribution()
+        for ticket in self.all_tickets:
+            self.period_distribution.track(ticket)
         # Classrooms which are bad (difficult to visit) but have special serenade so must be visited
         self.bad_classrooms = ClassroomList()
         # Duplicate classrooms because extra_special_serenades
         self.special_classrooms = ClassroomList()
 
+        self.tickets = self.all_tickets
+        self.classrooms = ClassroomList()
+
+        """Stage 1: choose the classrooms (doesn't depend on the number of groups)"""
+        if chosen_classrooms is not None:
+            with self.profile.phase("restore_chosen_classrooms"):
+                self.restore_chosen_classrooms(chosen_classrooms)
+
+        elif self.USE_ARRAYS:
+            self.choose_classrooms_with_arrays()
+
+        elif self.SPLIT_COMPONENTS:
+            with self.profile.phase("sort_components"):
+                self.sort_components()
+        else:
+            self.choose_classrooms()
+
+        # Sorting a component stops here (the components are finished together)
+        if not choose_classrooms_only and chosen_classrooms is None:
+            if self.IMPROVE_TIME_BUDGET > 0:
+                with self.profile.phase("improve_classrooms"):
+                    self.improve_classrooms(self.IMPROVE_TIME_BUDGET)
+
+            if self.OPTIMISE_TIME_LIMIT > 0:
+                with self.profile.phase("optimise_classrooms"):
+                    self.optimise_classrooms(self.OPTIMISE_TIME_LIMIT)
+
+            if self.EXTRA_SPECIAL_SERENADES:
+                with self.profile.phase("fill_special_classrooms"):
+                    self.fill_special_classrooms()
+
+        """Stage 2: assign the classrooms to groups"""
+        if not choose_classrooms_only:
+            with self.profile.phase("assign_tickets_to_groups"):
+                self.assign_tickets_to_groups()
+
+            with self.profile.phase("report"):
+                self.report = SortReport.from_ticket_sorter(self)
+
+        if started_tracing:
+            tracemalloc.stop()
+
+    @property
+    def chosen_classrooms(self) -> list[tuple[str, PeriodType, bool, list[int]]]:
+        """
+        The result of stage 1 (choosing classrooms). For each classroom (in order): its name, period,
+        whether it is special and the indices of its tickets (in order).
+
+        Can be given to a new TicketSorter with the same tickets to skip stage 1, which gives exactly
+        the same groups as this TicketSorter would have with the same number of groups.
+        """
+        ticket_indices = {ticket: index for index, ticket in enumerate(self.all_tickets)}
+        return [(classroom.original_name, classroom.period, classroom.is_special,
+                 [ticket_indices[ticket] for ticket in classroom.tickets])
+                for classroom in self.classrooms]
+
+    def restore_chosen_classrooms(self, chosen_classrooms: list[tuple[str, PeriodType, bool, list[int]]]):
+        """Puts the tickets back in the classrooms chosen by a previous TicketSorter"""
+        self.tickets = self.all_tickets
+        for ticket in self.all_tickets:
+            ticket.set_available(0)
+
+        for original_name, period, is_special, ticket_indices in chosen_classrooms:
+            classroom = Classroom(original_name, period)
+            if is_special:
+                classroom.is_special = True
+                self.special_classrooms.append(classroom)
+            elif not classroom.is_valid:
+                self.bad_classrooms.append(classroom)
+            self.classrooms.append(classroom)
+
+            for index in ticket_indices:
+                ticket = self.all_tickets[index]
+                ticket.classrooms[period - 1] = classroom
+                ticket.set_available(1 << (period - 1))
+                classroom.tickets.add(ticket)
+
+        # The classrooms of the other periods are only needed for their names (e.g. ticket.p1)
+        classrooms_by_name: dict[tuple[int, str], Classroom] = {}
+        for ticket in self.all_tickets:
+            for period in range(1, 5):
+                name = ticket.classrooms[period - 1]
+                if isinstance(name, str):
+                    if (period, name) not in classrooms_by_name:
+                        classrooms_by_name[(period, name)] = Classroom(name, period)
+                    ticket.classrooms[period - 1] = classrooms_by_name[(period, name)]
+
+    def choose_classrooms(self):
+        """Chooses a classroom for every ticket (eliminating as many classrooms as possible)"""
+
         """First pass with only serenades"""
         self.tickets = self.all_tickets.filter_serenades
-        self.classrooms = ClassroomList.from_tickets(self.tickets)
 
-        self.initialise_special_serenades()
+        with self.profile.phase("from_tickets (serenades)"):
+            self.classrooms = ClassroomList.from_tickets(self.tickets)
+
+        with self.profile.phase("initialise_special_serenades"):
+            self.initialise_special_serenades()
 
         if self.EXTRA_SPECIAL_SERENADES:
-            self.make_special_serenades_extra_special()
+            with self.profile.phase("make_special_serenades_extra_special"):
+                self.make_special_serenades_extra_special()
 
-        self.distribute_tickets(("Serenade",))
+        with self.profile.phase("distribute_tickets"):
+            self.distribute_tickets(("Serenade",))
 
         if not self.ENFORCE_DISTRIBUTION:
-            self.eliminate_classrooms(True)
+            with self.profile.phase("eliminate_classrooms (serenades)"):
+                self.eliminate_classrooms(True)
 
         """Second pass with all item types"""
-        self.classrooms = ClassroomList.from_tickets(self.all_tickets, self.tickets)
+        with self.profile.phase("from_tickets (all)"):
+            self.classrooms = ClassroomList.from_tickets(self.all_tickets, self.tickets)
 
-        if self.EXTRA_SPECIAL_SERENADES:
-            self.classrooms.extend(self.special_classrooms)
-        self.classrooms.extend(self.bad_classrooms)
-        self.tickets = self.all_tickets
+            # (special classrooms may already be there from the special serenades' classrooms)
+            if self.EXTRA_SPECIAL_SERENADES:
+                self.classrooms.extend(classroom for classroom in self.special_classrooms
+                                       if classroom not in self.classrooms)
+            self.classrooms.extend(classroom for classroom in self.bad_classrooms
+                                   if classroom not in self.classrooms)
+            self.tickets = self.all_tickets
 
         # Optional. massively decreases efficiency (~2x)
         # self.distribute_tickets(("Chocolate", "Rose"))
 
-        self.eliminate_classrooms(False)
+        with self.profile.phase("eliminate_classrooms (all)"):
+            self.eliminate_classrooms(False)
 
-        if self.EXTRA_SPECIAL_SERENADES:
-            self.fill_special_classrooms()
+    def choose_classrooms_with_arrays(self):
+        """Chooses the classrooms with an ArraySorter, then puts the tickets in this sorter's classrooms"""
+        array_sorter = ArraySorter(self.all_tickets, self.MAX_SERENADES_PER_CLASS,
+                                   self.MAX_NON_SERENADES_PER_SERENADING_CLASS,
+                                   self.EXTRA_SPECIAL_SERENADES, self.ENFORCE_DISTRIBUTION, self.profile)
+
+        with self.profile.phase("put_tickets_in_classrooms"):
+            self.tickets = self.all_tickets
+            # (special and bad classrooms are added to self.classrooms as they're used)
+            self.classrooms = ClassroomList()
+            classrooms = array_sorter.classrooms
+
+            for ticket, rooms, (period, is_special) in zip(
+                    self.all_tickets, array_sorter.rooms.tolist(), array_sorter.choices):
+                ticket.classrooms = [classrooms[room] for room in rooms]
+                self.put_ticket_in_classroom(ticket, period, is_special)
+
+            self.classrooms = ClassroomList([
+                *(classroom for classroom in classrooms if classroom.is_valid and len(classroom.tickets) > 0),
+                *self.classrooms])
+
+    def find_components(self) -> list[list[int]]:
+        """
+        Splits the tickets into components: groups of tickets which share no classrooms with any
+        other group (uses union-find). Special serenades only use the classroom of their period.
+        Tickets with no classrooms at all are put in one component together.
+
+        :return: the indices (in self.all_tickets) of the tickets in each component
+        """
+        # Key: (period, clean name). Value: the parent of the classroom in the union-find
+        parents: dict[tuple[int, str], tuple[int, str]] = {}
+
+        def find(classroom_key):
+            root = classroom_key
+            while parents[root] != root:
+                root = parents[root]
+            # compress the path so later finds are faster
+            while parents[classroom_key] != root:
+                parents[classroom_key], classroom_key = root, parents[classroom_key]
+            return root
+
+        # Key: (period, name in the ticket). Value: (period, clean name), or None if never visited
+        classroom_keys: dict[tuple[int, str], tuple[int, str] | None] = {}
+        ticket_roots: list[tuple[int, str] | None] = []
+
+        for ticket in self.all_tickets:
+            if ticket.item_type == "Special Serenade":
+                periods = (ticket.ss_period,)
+            else:
+                periods = (1, 2, 3, 4)
+
+            root = None
+            for period in periods:
+                name = ticket.classrooms[period - 1]
+                if (period, name) not in classroom_keys:
+                    classroom = Classroom(name, period)
+                    # bad classrooms are only visited for special serenades
+                    if classroom.is_valid or (classroom.is_bad and ticket.item_type == "Special Serenade"):
+                        classroom_keys[(period, name)] = (period, classroom.clean_name)
+                    else:
+                        classroom_keys[(period, name)] = None
+                classroom_key = classroom_keys[(period, name)]
+                if classroom_key is None:
+                    continue
+
+                parents.setdefault(classroom_key, classroom_key)
+                if root is None:
+                    root = find(classroom_key)
+                else:
+                    other_root = find(classroom_key)
+                    if other_root != root:
+                        parents[other_root] = root
+            ticket_roots.append(root)
+
+        # Group the tickets by their final root (components are in order of their first ticket)
+        components: dict[tuple[int, str] | None, list[int]] = {}
+        for index, root in enumerate(ticket_roots):
+            if root is not None:
+                root = find(root)
+            components.setdefault(root, []).append(index)
+        return list(components.values())
+
+    def sort_components(self):
+        """
+        Chooses the classrooms of each component separately (in a pool of processes), then puts
+        the tickets back into this sorter's classrooms
+        """
+        components = self.find_components()
+        if len(components) <= 1:
+            # nothing to split
+            self.choose_classrooms()
+            return
+
+        sorter_kwargs = {
+            "max_serenades_per_class": self.MAX_SERENADES_PER_CLASS,
+            "max_non_serenades_per_serenading_class": self.MAX_NON_SERENADES_PER_SERENADING_CLASS,
+            "extra_special_serenades": self.EXTRA_SPECIAL_SERENADES,
+            "enforce_distribution": self.ENFORCE_DISTRIBUTION,
+        }
+        # One seed per component, so the result only depends on the current random state
+        seeds = [random.random() for _ in components]
+
+        # Split the components between the processes, biggest first, to the process with the least
+        num_processes = min(len(components), os.cpu_count() or 1)
+        batches: list[list[int]] = [[] for _ in range(num_processes)]
+        batch_sizes = [(0, batch_index) for batch_index in range(num_processes)]
+        for component_index in sorted(range(len(components)), key=lambda index: -len(components[index])):
+            size, batch_index = heapq.heappop(batch_sizes)
+            batches[batch_index].append(component_index)
+            heapq.heappush(batch_sizes, (size + len(components[component_index]), batch_index))
+
+        tasks = [(pickle.dumps([TicketList(self.all_tickets[index] for index in components[component_index])
+                                for component_index in batch]),
+                  [seeds[component_index] for component_index in batch],
+                  sorter_kwargs)
+                 for batch in batches]
+        if num_processes > 1:
+            with get_process_pool(num_processes) as pool:
+                batch_results = pool.starmap(choose_component_classrooms, tasks)
+        else:
+            batch_results = [choose_component_classrooms(*task) for task in tasks]
+
+        """Put the tickets in the classrooms they were given"""
+        self.tickets = self.all_tickets
+        self.classrooms = ClassroomList.from_tickets(self.all_tickets)
+
+        for batch, results in zip(batches, batch_results):
+            for component_index, component_results in zip(batch, results):
+                for index, (period, is_special) in zip(components[component_index], component_results):
+                    self.put_ticket_in_classroom(self.all_tickets[index], period, is_special)
+
+        self.cleanup_classrooms()
+
+    def put_ticket_in_classroom(self, ticket: TicketToSort, period: PeriodType | None, is_special: bool):
+        """Puts the ticket in its classroom of the period (or in no classroom if period is None)"""
+        if period is None:
+            for classroom in ticket.classrooms:
+                classroom.tickets.discard(ticket)
+            ticket.set_available(0)
+            return
+
+        classroom = ticket.classrooms[period - 1]
+        if is_special:
+            special_classroom = Classroom(classroom.original_name, period)
+            special_classroom.is_special = True
+            if special_classroom not in self.special_classrooms:
+                self.classrooms.append(special_classroom)
+                self.special_classrooms.append(special_classroom)
+            else:
+                special_classroom = self.special_classrooms.get_existing_classroom(special_classroom)
+            classroom.tickets.discard(ticket)
+            ticket.classrooms[period - 1] = special_classroom
+
+        elif not classroom.is_valid and classroom not in self.bad_classrooms:
+            # a bad classroom with a special serenade
+            self.classrooms.append(classroom)
+            self.bad_classrooms.append(classroom)
 
-        self.assign_tickets_to_groups()
-        self.print_statistics()
+        ticket.choose_period(period)
 
     def initialise_special_serenades(self):
         for ticket in self.tickets:
             if ticket.item_type != "Special Serenade":
                 continue
 
-            classroom = getattr(ticket, f"p{ticket.ss_period}")
+            classroom = ticket.classrooms[ticket.ss_period - 1]
 
             if classroom.is_valid:
                 ticket.choose_period(ticket.ss_period)
@@ -1062,7 +2670,7 @@ class TicketSorter:
                 self.classrooms.append(classroom)
                 self.bad_classrooms.append(classroom)
             else:
-                print(f"ERROR: Classroom name unknown: {classroom.extended_name}")
+                logger.warning("Classroom name unknown: %s", classroom.extended_name)
 
     def make_special_serenades_extra_special(self):
         # removes regular serenades from classrooms that have special serenades
@@ -1071,15 +2679,16 @@ class TicketSorter:
                 continue
 
             period = ticket.chosen_period
-            classroom = getattr(ticket, f"p{period}")
+            classroom = ticket.classrooms[period - 1]
 
-            for other_ticket in classroom.tickets:
+            # iterate over a copy since tickets get removed from the classroom along the way
+            for other_ticket in classroom.tickets.copy():
                 if other_ticket.item_type != "Serenade":
                     continue
 
                 if not other_ticket.has_no_choice:
                     # If still more than one choice
-                    setattr(other_ticket, f"is_p{period}", False)
+                    other_ticket.remove_period(period)
                     classroom.tickets.remove(other_ticket)
                 elif other_ticket.chosen_period != period:
                     classroom.tickets.remove(other_ticket)
@@ -1098,12 +2707,16 @@ class TicketSorter:
 
                     if ticket not in special_classroom.tickets:
                         classroom.tickets.remove(ticket)
-                        setattr(ticket, f"p{period}", special_classroom)
+                        ticket.classrooms[period - 1] = special_classroom
                         ticket.choose_period(period)
 
         for classroom in self.special_classrooms:
             classroom.is_special = True
 
+        # special classrooms have been renamed, so the indices are out of date
+        self.classrooms.refresh_index()
+        self.special_classrooms.refresh_index()
+
     def distribute_tickets(self, items: Sequence[ItemType]):
         """
         Distributes each person's tickets so that they receive them all over many periods instead of
@@ -1112,7 +2725,6 @@ class TicketSorter:
         :param items: Only tickets of these item types are considered
         :return: None
         """
-        period_distribution = self.tickets.period_distribution
         item_period_distribution: dict[PeriodType, int] = {1: 0, 2: 0, 3: 0, 4: 0}
 
         for num_tickets, people in People(self.tickets).grouped_by_num_items(items).items():
@@ -1130,8 +2742,7 @@ class TicketSorter:
 
                     for ticket in person_tickets:
                         if not ticket.has_no_choice:
-                            self.choose_emptiest_period(
-                                ticket, item_period_distribution, period_distribution)
+                            self.choose_emptiest_period(ticket, item_period_distribution)
                 else:
                     for num_periods_available, tickets in (
                             person_tickets.grouped_by_num_periods_available.items()):
@@ -1141,32 +2752,28 @@ class TicketSorter:
                             continue
 
                         for ticket in tickets:
-                            self.choose_emptiest_period(
-                                ticket, item_period_distribution, period_distribution)
+                            self.choose_emptiest_period(ticket, item_period_distribution)
 
         self.cleanup_classrooms()
 
-    @staticmethod
-    def choose_emptiest_period(
-            ticket: TicketToSort,
-            item_period_distribution: dict,
-            period_distribution: dict):
-
+    def choose_emptiest_period(self, ticket: TicketToSort, item_period_distribution: dict):
         available_periods = ticket.available_periods
+        period_distribution = self.period_distribution
         # evenly distribute the tickets among the available classes
         # if already even, try to keep the global distribution even
         chosen_period = min(available_periods,
                             key=lambda period: (item_period_distribution[period],
                                                 period_distribution[period]))
+        # choosing the period also updates self.period_distribution
         ticket.choose_period(chosen_period)
-        period_distribution[chosen_period] += 1
         item_period_distribution[chosen_period] += 1
 
     def eliminate_classrooms(self, serenade_only_pass: bool):
         eliminated_period_distribution: dict[PeriodType, int] = {1: 0, 2: 0, 3: 0, 4: 0}
+        queue = EliminationQueue(self.classrooms)
 
         for classroom in self.classrooms.sorted_by_eliminated_period_distribution_then_length(
-                eliminated_period_distribution):
+                eliminated_period_distribution, queue):
 
             period = classroom.period
             tickets = classroom.tickets
@@ -1180,17 +2787,35 @@ class TicketSorter:
                         classroom.limit_non_serenades(self.MAX_NON_SERENADES_PER_SERENADING_CLASS)
 
                 # if classroom must be kept, make every other ticket stay in this class
+                changed_classrooms: dict[Classroom, None] = {}
                 for ticket in tickets:
+                    for other_classroom in ticket.classrooms:
+                        if other_classroom is not classroom and ticket in other_classroom.tickets:
+                            changed_classrooms[other_classroom] = None
                     ticket.choose_period(period)
+
+                # the tickets were removed from their other classrooms, so re-sort them
+                for changed_classroom in changed_classrooms:
+                    queue.update(changed_classroom)
             else:
                 # if classroom can be destroyed, remove tickets associated with it
                 # (destroy the actual classroom later)
-                for ticket in tickets[:]:
-                    setattr(ticket, f'is_p{period}', False)
+                for ticket in tickets.copy():
+                    ticket.remove_period(period)
                     tickets.remove(ticket)
                     eliminated_period_distribution[period] += 1
         self.cleanup_classrooms()
 
+    def improve_classrooms(self, time_budget: float):
+        local_search = LocalSearch(self)
+        local_search.run(time_budget)
+        self.cleanup_classrooms()
+
+    def optimise_classrooms(self, time_limit: float):
+        optimiser = ExactOptimiser(self)
+        optimiser.run(time_limit)
+        self.optimiser_result = optimiser.result
+
     def cleanup_classrooms(self):
         # delete empty classrooms
         for classroom in self.classrooms[:]:
@@ -1199,34 +2824,37 @@ class TicketSorter:
 
     def fill_special_classrooms(self):
         # Adds non-serenades to special classrooms, so it's not just a single special serenade
+        # Key: (period, clean name). Value: the classrooms in that class (in order)
+        same_classes: dict[tuple[int, str], list[Classroom]] = {}
+        for classroom in self.classrooms:
+            same_classes.setdefault((classroom.period, classroom.clean_name), []).append(classroom)
+
         for special_classroom in self.special_classrooms:
-            for classroom in self.classrooms:
+            same_class = same_classes.get((special_classroom.period, special_classroom.clean_name), ())
+            for classroom in same_class:
                 if len(special_classroom.tickets) >= \
                         self.MAX_SERENADES_PER_CLASS + self.MAX_NON_SERENADES_PER_SERENADING_CLASS:
                     break
 
-                if classroom.period == special_classroom.period and \
-                        classroom.clean_name == special_classroom.clean_name:    # If the same class
-
-                    people = People(classroom.tickets.filter_by_item_type(("Chocolate", "Rose")))
+                people = People(classroom.tickets.filter_by_item_type(("Chocolate", "Rose")))
 
-                    for num_tickets, people in people.grouped_by_num_items().items():
-                        for person in people:
-                            if (len(special_classroom.tickets) >=
-                                    self.MAX_SERENADES_PER_CLASS
-                                    + self.MAX_NON_SERENADES_PER_SERENADING_CLASS):
-                                break
+                for num_tickets, people in people.grouped_by_num_items().items():
+                    for person in people:
+                        if (len(special_classroom.tickets) >=
+                                self.MAX_SERENADES_PER_CLASS
+                                + self.MAX_NON_SERENADES_PER_SERENADING_CLASS):
+                            break
 
-                            # Pick random ticket (doesn't really matter since non-serenade)
-                            ticket = person.tickets[0]
+                        # Pick random ticket (doesn't really matter since non-serenade)
+                        ticket = person.tickets[0]
 
-                            if (len(special_classroom.tickets) >=
-                                    self.MAX_SERENADES_PER_CLASS
-                                    + self.MAX_NON_SERENADES_PER_SERENADING_CLASS):
-                                break
-                            else:
-                                classroom.tickets.remove(ticket)
-                                special_classroom.tickets.append(ticket)
+                        if (len(special_classroom.tickets) >=
+                                self.MAX_SERENADES_PER_CLASS
+                                + self.MAX_NON_SERENADES_PER_SERENADING_CLASS):
+                            break
+                        else:
+                            classroom.tickets.remove(ticket)
+                            special_classroom.tickets.append(ticket)
 
     def assign_tickets_to_groups(self):
         self.output_serenading_groups = DeliveryGroupList(
@@ -1255,134 +2883,639 @@ class TicketSorter:
         classrooms = classrooms.sorted_by_geography
         return PeriodGroupList(classrooms, num_groups)
 
-    def print_statistics(self):
-        print("\nNumber of Classroom Visits Per Period:")
-        classrooms_per_period = {1: 0, 2: 0, 3: 0, 4: 0}
-        for classroom in self.classrooms:
-            classrooms_per_period[classroom.period] += 1
-        for period, number in classrooms_per_period.items():
-            print(f"\tPeriod {period}: {number}")
-        print(f"Total: {len(self.classrooms)}")
 
-        print("\nNumber of Tickets Per Item Type:")
-        item_type_distribution = {"Chocolate": 0, "Rose": 0, "Serenade": 0, "Special Serenade": 0}
-        for ticket in self.tickets:
-            item_type_distribution[ticket.item_type] += 1
-        for item_type, number in item_type_distribution.items():
-            print(f"\t{item_type}: {number}")
-        print(f"Total: {len(self.tickets)}")
-
-        print("\nNumber of items per classroom visit:")
-        total_tickets = 0
-        for size, classrooms in self.classrooms.grouped_by_length.items():
-            print(f"\t{size}: {len(classrooms)}\t{'|' * len(classrooms)}")
-            total_tickets += size * len(classrooms)
-        average_classroom_size = round(total_tickets / len(self.classrooms), 3)
-        print(f"Average: {average_classroom_size}")
-
-        print("\nTickets per serenading group:")
-        total_serenading_groups = 0
-        for group in self.output_serenading_groups:
-            print(f"\tClassrooms: {group.num_classrooms} \t| "
-                  f"Serenades: {group.tickets.num_serenades}\t"
-                  f"+ Non-serenades: {group.tickets.num_non_serenades} "
-                  f"= Total: {group.tickets.num_serenades + group.tickets.num_non_serenades}")
-            total_serenading_groups += group.tickets.num_serenades + group.tickets.num_non_serenades
-        print(f"Total: {total_serenading_groups}")
-
-        print("\nTickets per non-serenading group:")
-        total_non_serenading_groups = 0
-        for group in self.output_non_serenading_groups:
-            print(f"\tClassrooms: {group.num_classrooms} \t| "
-                  f"Non-serenades: {group.tickets.num_non_serenades}")
-            total_non_serenading_groups += group.tickets.num_non_serenades
-        print(f"Total: {total_non_serenading_groups}")
-        print(f"\nTotal (both types): {total_serenading_groups + total_non_serenading_groups}")
+class ArraySorter:
+    """
+    Chooses a classroom for every ticket like TicketSorter.choose_classrooms, but with the tickets
+    encoded as numpy arrays so that each step is a few operations over every ticket at once
+    instead of a walk over the TicketToSort and Classroom objects. Visits about as many classrooms,
+    but each step decides many tickets at once, so the options are followed less strictly (e.g.
+    the limits per class are only checked when a classroom is kept). Used by TicketSorter if
+    use_arrays.
+
+    Each ticket is a row of rooms (the id of its classroom in each period, index 0 is period 1) and
+    available (whether it can still go to each of those classrooms). Its recipient and item type
+    are integer codes. The steps are the same as TicketSorter's:
+        1. Special serenades are pinned to their period, and regular serenades are kept out of
+           their classrooms (if extra_special_serenades).
+        2. Each recipient's serenades are spread over their periods, one round per serenade: each
+           goes to the available period the recipient has the fewest serenades in so far.
+        3. Classrooms are eliminated. Classrooms which a ticket has no other choice but are kept,
+           and every ticket which can go to a kept classroom does (up to the limits per class).
+           Otherwise a batch of the smallest classrooms (with serenades first) in the period with
+           the fewest eliminated tickets is eliminated. A ticket has one classroom per period, so
+           it can't lose its last one in a batch (that classroom would have been kept).
+    """
+    # The fraction of the remaining classrooms of a period which are eliminated at once
+    ELIMINATION_BATCH = 0.1
+    ITEM_CODES: dict[ItemType, int] = {item_type: code for code, item_type in enumerate(ITEM_TYPES)}
+
+    def __init__(self, tickets: Sequence[TicketToSort], max_serenades_per_class: int = 2,
+                 max_non_serenades_per_serenading_class: int = 3, extra_special_serenades: bool = True,
+                 enforce_distribution: bool = True, profile: SortProfile | None = None):
+        """The classrooms of the tickets must still be names (i.e. before ClassroomList.from_tickets)"""
+        self.MAX_SERENADES_PER_CLASS = max_serenades_per_class
+        self.MAX_NON_SERENADES_PER_SERENADING_CLASS = max_non_serenades_per_serenading_class
+        self.EXTRA_SPECIAL_SERENADES = extra_special_serenades
+        self.ENFORCE_DISTRIBUTION = enforce_distribution
 
-        if len(self.special_classrooms) > 0:
-            print("\nSpecial Classrooms:")
-            for classroom in self.special_classrooms:
-                print(f"\t{classroom} ({classroom.clean_name})")
+        self.profile = profile
+        # Seeded from the random module so that random.seed() makes the sort repeatable
+        self.rng = np.random.default_rng(random.getrandbits(64))
 
-        if len(self.bad_classrooms) > 0:
-            print("\nBad Classrooms:")
-            for classroom in self.bad_classrooms:
-                print(f"\t{classroom}")
-
-        delivered_tickets = []
-        for group in self.output_serenading_groups:
-            for ticket in group.tickets:
-                delivered_tickets.append(ticket)
-        for group in self.output_non_serenading_groups:
-            for ticket in group.tickets:
-                delivered_tickets.append(ticket)
-        print_header = True
-        for ticket in self.all_tickets:
-            if ticket not in delivered_tickets:
-                if print_header:
-                    print("\nUndelivered Tickets:")
-                    print_header = False
-                print(f"\t{ticket}")
+        with self.phase("encode_tickets"):
+            self.encode_tickets(tickets)
 
+        with self.phase("initialise_special_serenades"):
+            self.initialise_special_serenades()
 
-"""Dev/Testing Stuff"""
+        with self.phase("distribute_tickets"):
+            self.distribute_tickets()
 
+        with self.phase("eliminate_classrooms"):
+            self.eliminate_classrooms()
 
-def load_tickets() -> TicketList:
-    tickets = TicketList()
+    def phase(self, name: str):
+        if self.profile is None:
+            return contextlib.nullcontext()
+        return self.profile.phase(f"{name} (arrays)")
 
-    # Load student timetables
-    students = {}
-    with open(f"{DirectoryLocations.DEV_STUFF}/people_2023.csv") as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            row: dict
+    def encode_tickets(self, tickets: Sequence[TicketToSort]):
+        self.tickets = tickets
+        num_tickets = len(tickets)
+        self.item_types = np.array([self.ITEM_CODES[ticket.item_type] for ticket in tickets], dtype=np.int8)
+        self.is_serenade = (self.item_types == self.ITEM_CODES["Serenade"]) \
+            | (self.item_types == self.ITEM_CODES["Special Serenade"])
+        self.recipients = np.unique([ticket.recipient_id for ticket in tickets],
+                                    return_inverse=True)[1].astype(np.int32)
+        self.ss_periods = np.array([ticket.ss_period or 0 for ticket in tickets], dtype=np.int8)
 
-            students[row['ID']] = row
+        # Classrooms have the same id (their index here) if they have the same period and clean name
+        classroom_ids: dict[tuple[int, str], int] = {}
+        self.classrooms: list[Classroom] = []
 
-    # Create tickets from file
-    with open(f"{DirectoryLocations.DEV_STUFF}/tickets_2023.json") as tickets_file:
-        data = json.load(tickets_file)
+        self.rooms = np.zeros((num_tickets, 4), dtype=np.int32)
+        for period in range(1, 5):
+            names, name_indices = np.unique([ticket.classrooms[period - 1] for ticket in tickets],
+                                            return_inverse=True)
+            name_ids = np.zeros(len(names), dtype=np.int32)
+            for name_index, name in enumerate(names.tolist()):
+                classroom = Classroom(name, period)
+                key = (period, classroom.clean_name)
+                if key not in classroom_ids:
+                    classroom_ids[key] = len(self.classrooms)
+                    self.classrooms.append(classroom)
+                name_ids[name_index] = classroom_ids[key]
+            self.rooms[:, period - 1] = name_ids[name_indices]
+
+        self.num_classrooms = len(self.classrooms)
+        self.classroom_periods = np.array([classroom.period for classroom in self.classrooms], dtype=np.int8)
+        self.is_valid = np.array([classroom.is_valid for classroom in self.classrooms], dtype=bool)
+        self.is_bad = np.array([classroom.is_bad for classroom in self.classrooms], dtype=bool)
+        # Non-existent and bad classrooms are never chosen (besides bad ones for special serenades)
+        self.available = self.is_valid[self.rooms]
+        # Special serenades which go in a special classroom
+        self.is_special = np.zeros(num_tickets, dtype=bool)
 
-        for ticket in data:
-            fields = ticket["fields"]
-            recipient_id = fields["recipient_id"]
+    def initialise_special_serenades(self):
+        special_serenades = np.flatnonzero(self.item_types == self.ITEM_CODES["Special Serenade"])
+        columns = self.ss_periods[special_serenades].astype(np.intp) - 1
+        special_rooms = self.rooms[special_serenades, columns]
 
-            ticket = TicketToSort(
-                pk=ticket["pk"],
-                recipient_id=recipient_id,
-                item_type=fields["item_type"],
-                p1=students[recipient_id]["P1"],
-                p2=students[recipient_id]["P2"],
-                p3=students[recipient_id]["P3"],
-                p4=students[recipient_id]["P4"],
-                ss_period=fields["ss_period"]
-            )
+        is_known = self.is_valid[special_rooms] | self.is_bad[special_rooms]
+        for room in special_rooms[~is_known]:
+            logger.warning("Classroom name unknown: %s", self.classrooms[room].extended_name)
+        special_serenades = special_serenades[is_known]
+        columns = columns[is_known]
+        special_rooms = special_rooms[is_known]
 
-            tickets.append(ticket)
+        self.available[special_serenades] = False
+        self.available[special_serenades, columns] = True
 
-    return tickets
+        if not self.EXTRA_SPECIAL_SERENADES:
+            return
 
+        # keep regular serenades out of classrooms with special serenades (if they have another choice)
+        has_special_serenade = np.zeros(self.num_classrooms, dtype=bool)
+        has_special_serenade[special_rooms] = True
+        serenades = np.flatnonzero(self.item_types == self.ITEM_CODES["Serenade"])
+        available = self.available[serenades]
+        is_blocked = available & has_special_serenade[self.rooms[serenades]]
+        unblocked = available & ~is_blocked
+        has_choice = unblocked.any(axis=1)
+        self.available[serenades[has_choice]] = unblocked[has_choice]
+
+        # serenades with no other choice stay in one of those classrooms, so the special serenades
+        # there are put in a special classroom instead
+        stuck = serenades[~has_choice & is_blocked.any(axis=1)]
+        stuck_columns = np.argmax(self.available[stuck], axis=1)
+        self.available[stuck] = False
+        self.available[stuck, stuck_columns] = True
+        is_shared = np.zeros(self.num_classrooms, dtype=bool)
+        is_shared[self.rooms[stuck, stuck_columns]] = True
+        self.is_special[special_serenades] = is_shared[special_rooms]
+
+    def distribute_tickets(self):
+        """Spreads each recipient's serenades over their periods (see TicketSorter.distribute_tickets)"""
+        serenades = np.flatnonzero(self.item_types == self.ITEM_CODES["Serenade"])
+        num_periods = self.available[serenades].sum(axis=1)
+        num_recipients = int(self.recipients.max(initial=-1)) + 1
+
+        # how many of each recipient's serenades are in each period so far
+        fixed = serenades[num_periods == 1]
+        recipient_periods = np.zeros((num_recipients, 4), dtype=np.int32)
+        np.add.at(recipient_periods, (self.recipients[fixed], np.argmax(self.available[fixed], axis=1)), 1)
+
+        if self.ENFORCE_DISTRIBUTION:
+            to_distribute = serenades[num_periods > 1]
+        else:
+            # only the serenades which would otherwise be likely to end up together
+            num_serenades = np.bincount(self.recipients[serenades], minlength=num_recipients)
+            to_distribute = serenades[(num_periods > 1)
+                                      & (num_periods <= num_serenades[self.recipients[serenades]])]
+
+        # one round per serenade of a recipient, so that each round knows where the earlier ones went
+        to_distribute = to_distribute[np.argsort(self.recipients[to_distribute], kind="stable")]
+        rounds = self.rank_within_groups(self.recipients[to_distribute])
+        for round_number in range(int(rounds.max(initial=-1)) + 1):
+            tickets = to_distribute[rounds == round_number]
+            recipients = self.recipients[tickets]
+            # the emptiest available period of each recipient (ties broken randomly)
+            keys = np.where(self.available[tickets],
+                            recipient_periods[recipients] + self.rng.random((len(tickets), 4)), np.inf)
+            columns = np.argmin(keys, axis=1)
+            self.available[tickets] = False
+            self.available[tickets, columns] = True
+            np.add.at(recipient_periods, (recipients, columns), 1)
+
+    def eliminate_classrooms(self):
+        num_periods = self.available.sum(axis=1)
+        fixed = np.flatnonzero(num_periods == 1)
+        open_tickets = np.flatnonzero(num_periods > 1)
+
+        # classrooms which a ticket has no other choice but
+        self.kept = np.zeros(self.num_classrooms, dtype=bool)
+        # the number of serenades and non-serenades which have no other choice but each classroom
+        self.fixed_serenades = np.zeros(self.num_classrooms, dtype=np.int64)
+        self.fixed_non_serenades = np.zeros(self.num_classrooms, dtype=np.int64)
+        self.fix(fixed)
+        eliminated_period_distribution = np.zeros(4, dtype=np.int64)
+
+        while len(open_tickets) > 0:
+            open_available = self.available[open_tickets]
+            open_rooms = self.rooms[open_tickets]
+            kept_options = open_available & self.kept[open_rooms]
+            has_kept_option = kept_options.any(axis=1)
+
+            if has_kept_option.any():
+                # every ticket which can go to a kept classroom does (its first one), up to the limits
+                tickets = open_tickets[has_kept_option]
+                columns = np.argmax(kept_options[has_kept_option], axis=1)
+                is_admitted = self.limit(tickets, self.rooms[tickets, columns])
+                # tickets over the limit can't go to that classroom
+                self.available[tickets[~is_admitted], columns[~is_admitted]] = False
+                self.available[tickets[is_admitted]] = False
+                self.available[tickets[is_admitted], columns[is_admitted]] = True
+            else:
+                # none of the classrooms of the open tickets are kept, so they can all be eliminated
+                load = np.bincount(open_rooms[open_available], minlength=self.num_classrooms)
+                serenade_load = np.bincount(open_rooms[open_available & self.is_serenade[open_tickets, None]],
+                                            minlength=self.num_classrooms)
+                classrooms = np.flatnonzero(load)
+                periods = self.classroom_periods[classrooms].astype(np.intp) - 1
+
+                # the period with the fewest eliminated tickets (out of those with classrooms left)
+                period_counts = np.bincount(periods, minlength=4)
+                column = int(np.argmin(np.where(period_counts > 0, eliminated_period_distribution,
+                                                np.iinfo(np.int64).max)))
+
+                # classrooms with serenades first, then the smallest (ties broken randomly)
+                candidates = classrooms[periods == column]
+                order = np.lexsort((self.rng.random(len(candidates)), load[candidates],
+                                    serenade_load[candidates] == 0))
+                batch = candidates[order[:max(1, math.ceil(len(candidates) * self.ELIMINATION_BATCH))]]
+
+                is_eliminated = np.zeros(self.num_classrooms, dtype=bool)
+                is_eliminated[batch] = True
+                is_removed = open_available[:, column] & is_eliminated[open_rooms[:, column]]
+                self.available[open_tickets[is_removed], column] = False
+                eliminated_period_distribution[column] += np.count_nonzero(is_removed)
+
+            num_periods = self.available[open_tickets].sum(axis=1)
+            self.fix(open_tickets[num_periods == 1])
+            open_tickets = open_tickets[num_periods > 1]
+
+    def fix(self, tickets: np.ndarray):
+        """Keeps the classrooms of tickets which have no other choice"""
+        rooms = self.rooms[tickets, np.argmax(self.available[tickets], axis=1)]
+        self.kept[rooms] = True
+        is_serenade = self.is_serenade[tickets]
+        self.fixed_serenades += np.bincount(rooms[is_serenade], minlength=self.num_classrooms)
+        self.fixed_non_serenades += np.bincount(rooms[~is_serenade], minlength=self.num_classrooms)
+
+    def limit(self, tickets: np.ndarray, rooms: np.ndarray) -> np.ndarray:
+        """
+        Which of the tickets can go to their classroom in rooms without going over the limits per
+        class. Tickets with the fewest other choices go first.
+        """
+        is_admitted = np.ones(len(tickets), dtype=bool)
+        is_serenade = self.is_serenade[tickets]
+        num_periods = self.available[tickets].sum(axis=1)
+
+        serenades = np.flatnonzero(is_serenade)
+        if self.MAX_SERENADES_PER_CLASS > 0:
+            ranks = self.rank_within_rooms(rooms[serenades], num_periods[serenades])
+            is_admitted[serenades] = ranks < self.MAX_SERENADES_PER_CLASS - self.fixed_serenades[rooms[serenades]]
+
+        non_serenades = np.flatnonzero(~is_serenade)
+        if self.MAX_NON_SERENADES_PER_SERENADING_CLASS > 0:
+            # only limited in classrooms with a serenade
+            has_serenade = self.fixed_serenades > 0
+            has_serenade[rooms[serenades[is_admitted[serenades]]]] = True
+            ranks = self.rank_within_rooms(rooms[non_serenades], num_periods[non_serenades])
+            is_admitted[non_serenades] = ~has_serenade[rooms[non_serenades]] | (
+                ranks < self.MAX_NON_SERENADES_PER_SERENADING_CLASS - self.fixed_non_serenades[rooms[non_serenades]])
+
+        return is_admitted
 
-def main():
-    start_time = datetime.now()
+    @classmethod
+    def rank_within_rooms(cls, rooms: np.ndarray, priorities: np.ndarray) -> np.ndarray:
+        """The rank of each ticket in its room, in order of priority (lowest first)"""
+        order = np.lexsort((priorities, rooms))
+        ranks = np.empty(len(rooms), dtype=np.int64)
+        ranks[order] = cls.rank_within_groups(rooms[order])
+        return ranks
+
+    @staticmethod
+    def rank_within_groups(groups: np.ndarray) -> np.ndarray:
+        """The index of each item within its run of equal (i.e. sorted) groups, e.g. [5, 5, 7] -> [0, 1, 0]"""
+        if len(groups) == 0:
+            return np.zeros(0, dtype=np.int64)
+        starts = np.flatnonzero(np.concatenate(([True], groups[1:] != groups[:-1])))
+        return np.arange(len(groups)) - np.repeat(starts, np.diff(np.append(starts, len(groups))))
 
-    # Load dummy data for testing
-    tickets = load_tickets()
+    @property
+    def choices(self) -> list[tuple[PeriodType | None, bool]]:
+        """Each ticket's chosen period (None if it has none) and whether it goes in a special classroom"""
+        has_period = self.available.any(axis=1)
+        periods = np.argmax(self.available, axis=1) + 1
+        return [(period if ok else None, bool(is_special))
+                for period, ok, is_special in zip(periods.tolist(), has_period.tolist(), self.is_special.tolist())]
+
+
+class PreviewSorter:
+    """
+    A much faster (but less efficient) sort for previewing, ported from dev/cupid.py. Runs in O(n):
+        - The modulo trick: with the tickets ordered by recipient, the nth ticket goes to period
+          n % 4 (or the next period with a valid classroom), which spreads out each recipient's
+          tickets between periods.
+        - Each classroom has a cost (1 per non-serenade, 7 per serenade). In each block, the
+          cheapest classrooms are paired with the most expensive ones and given to the same group.
+          Each block gets a share of the groups proportional to its number of classrooms
+          (so that groups stay in the same area), and each pair goes to the least loaded of them.
+
+    Doesn't limit serenades or non-serenades per class, and doesn't keep special serenades away
+    from serenades. Has the same outputs as TicketSorter.
+    """
+    SERENADE_COST = 7
 
+    def __init__(self, tickets: list, serenading_groups: int, non_serenading_groups: int,
+                 measure_memory: bool = False, on_phase: Callable[[str], None] | None = None):
+        self.NUM_SERENADING_GROUPS = serenading_groups
+        self.NUM_NON_SERENADING_GROUPS = non_serenading_groups
+
+        """Output Variables"""
+        self.output_serenading_groups = DeliveryGroupList()
+        self.output_non_serenading_groups = DeliveryGroupList()
+        self.report: SortReport | None = None
+        self.optimiser_result: dict[str, Any] | None = None
+        self.profile = SortProfile(self, measure_memory, on_phase)
+
+        started_tracing = measure_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+
+        self.all_tickets = TicketList(tickets)
+        self.tickets = self.all_tickets
+        self.classrooms = ClassroomList()
+        self.bad_classrooms = ClassroomList()
+        # Special serenades aren't separated from serenades, so there are never special classrooms
+        self.special_classrooms = ClassroomList()
+
+        with self.profile.phase("from_tickets"):
+            self.classrooms = ClassroomList.from_tickets(self.all_tickets)
+
+        with self.profile.phase("choose_periods"):
+            self.choose_periods()
+
+        with self.profile.phase("assign_tickets_to_groups"):
+            self.assign_tickets_to_groups()
+
+        with self.profile.phase("report"):
+            self.report = SortReport.from_ticket_sorter(self)
+
+        if started_tracing:
+            tracemalloc.stop()
+
+    def choose_periods(self):
+        # the modulo trick works best if the tickets are ordered by recipient
+        tickets = sorted(self.all_tickets, key=lambda ticket: ticket.recipient_id)
+
+        for index, ticket in enumerate(tickets):
+            if ticket.item_type == "Special Serenade":
+                period = ticket.ss_period
+                classroom = ticket.classrooms[period - 1]
+                if classroom.is_valid:
+                    pass
+                elif classroom.is_bad:
+                    if classroom not in self.bad_classrooms:
+                        self.classrooms.append(classroom)
+                        self.bad_classrooms.append(classroom)
+                else:
+                    logger.warning("Classroom name unknown: %s", classroom.extended_name)
+                    period = None
+            else:
+                # try each period, starting from the ticket's turn, until one has a valid classroom
+                period = None
+                for attempt in range(4):
+                    possible_period = (index + attempt) % 4 + 1
+                    if ticket.available & (1 << (possible_period - 1)):
+                        period = possible_period
+                        break
+
+            if period is None:
+                # can't be delivered
+                for classroom in ticket.classrooms:
+                    classroom.tickets.discard(ticket)
+                ticket.set_available(0)
+            else:
+                ticket.choose_period(period)
+
+        # delete empty classrooms
+        for classroom in self.classrooms[:]:
+            if len(classroom.tickets) < 1:
+                self.classrooms.remove(classroom)
+
+    def assign_tickets_to_groups(self):
+        self.output_serenading_groups = DeliveryGroupList(
+            [DeliveryGroup(i + 1, True) for i in range(self.NUM_SERENADING_GROUPS)]
+        )
+        self.output_non_serenading_groups = DeliveryGroupList(
+            [DeliveryGroup(i + 1, False) for i in range(self.NUM_NON_SERENADING_GROUPS)]
+        )
+
+        # the total cost of each group so far (so that the periods even each other out)
+        serenading_loads = [0] * self.NUM_SERENADING_GROUPS
+        non_serenading_loads = [0] * self.NUM_NON_SERENADING_GROUPS
+
+        for period, classrooms_in_period in self.classrooms.grouped_by_period.items():
+            for delivery_groups, classrooms, loads in (
+                    (self.output_serenading_groups, classrooms_in_period.filter_has_serenades,
+                     serenading_loads),
+                    (self.output_non_serenading_groups, classrooms_in_period.filter_has_no_serenades,
+                     non_serenading_loads)):
+                for delivery_group, group_classrooms in zip(
+                        delivery_groups, self.pair_classrooms(classrooms, loads)):
+                    delivery_group.set_classrooms(period, group_classrooms.sorted_by_geography)
+
+    def cost(self, classroom: Classroom) -> int:
+        return classroom.tickets.num_non_serenades + classroom.tickets.num_serenades * self.SERENADE_COST
+
+    def pair_classrooms(self, classrooms: ClassroomList, loads: list[int]) -> list[ClassroomList]:
+        """Splits the classrooms of a period between the groups, adding their costs to loads"""
+        num_groups = len(loads)
+        groups = [ClassroomList() for _ in range(num_groups)]
+        if num_groups == 0 or len(classrooms) == 0:
+            return groups
+
+        last_fraction = 0
+        for block_classrooms in classrooms.grouped_by_geography.values():
+            if len(block_classrooms) == 0:
+                continue
+
+            # the groups this block is shared between
+            fraction = len(block_classrooms) / len(classrooms)
+            minimum = last_fraction
+            maximum = last_fraction + fraction
+            last_fraction = maximum
+            first_group = min(math.floor(num_groups * minimum), num_groups - 1)
+            block_groups = range(first_group, max(min(math.ceil(num_groups * maximum), num_groups),
+                                                  first_group + 1))
+
+            # pair off the cheapest and most expensive classrooms (low_cost is never shorter)
+            block_classrooms = sorted(block_classrooms, key=self.cost)
+            half = math.ceil(len(block_classrooms) / 2)
+            low_cost = block_classrooms[:half]
+            high_cost = block_classrooms[half:][::-1]
+
+            for i, classroom in enumerate(low_cost):
+                pair = [classroom] if i >= len(high_cost) else [classroom, high_cost[i]]
+                group_index = min(block_groups, key=lambda index: loads[index])
+                groups[group_index].extend(pair)
+                loads[group_index] += sum(self.cost(paired_classroom) for paired_classroom in pair)
+
+        return groups
+
+
+class IncrementalSorter:
+    """
+    Adds new tickets to a sort which has already been committed (and maybe printed), without moving
+    any of the committed tickets. Each new ticket goes:
+        1. into a classroom which is already being visited in one of the recipient's periods
+           (only by serenading groups if it's a serenade), otherwise
+        2. into a new classroom visit of the least loaded group (of the right type).
+    Periods which the recipient has fewer tickets in are preferred, then less loaded groups.
+
+    Tickets with the fewest choices are placed first (special serenades, then serenades).
+    Doesn't limit serenades or non-serenades per class, and doesn't keep special serenades away
+    from serenades.
+    """
+    def __init__(self, committed_groups: dict[str, tuple[bool, list[tuple[str, PeriodType, str]]]],
+                 new_tickets: list):
+        """
+        committed_groups: key is the name of a delivery group, value is whether it is a serenading
+            group and the (recipient_id, period, classroom name) of each of its tickets
+        """
+        self.serenading_groups = [name for name, (is_serenading, _) in committed_groups.items() if is_serenading]
+        self.non_serenading_groups = [name for name, (is_serenading, _) in committed_groups.items()
+                                      if not is_serenading]
+        # The number of tickets in each group
+        self.loads: dict[str, int] = {}
+        # Key: (period, clean name). Value: the names of the groups visiting that classroom
+        self.visits: dict[tuple[int, str], list[str]] = {}
+        # Key: recipient_id. Value: the number of tickets the recipient has in each period
+        self.recipient_periods: dict[str, list[int]] = {}
+
+        for name, (_, tickets) in committed_groups.items():
+            self.loads[name] = len(tickets)
+            for recipient_id, period, classroom_name in tickets:
+                self.add_visit(name, period, Classroom.to_clean_name(classroom_name))
+                self.recipient_periods.setdefault(recipient_id, [0, 0, 0, 0])[period - 1] += 1
+
+        """Output Variables"""
+        # The new tickets of each group (in the order they should be delivered)
+        self.output: dict[str, TicketList] = {name: TicketList() for name in committed_groups}
+        self.undelivered_tickets = TicketList()
+
+        self.all_tickets = TicketList(new_tickets)
+        # Replaces the classroom names of the tickets with Classrooms (and removes invalid periods)
+        self.classrooms = ClassroomList.from_tickets(self.all_tickets)
+
+        for ticket in sorted(self.all_tickets, key=self.get_priority):
+            self.place_ticket(ticket)
+
+        for tickets in self.output.values():
+            tickets.sort(key=lambda ticket: (ticket.chosen_period,
+                                             CLASSROOM_GEOGRAPHIC_ORDER.find(ticket.chosen_classroom.clean_name[0]),
+                                             ticket.chosen_classroom.clean_name))
+
+    @staticmethod
+    def get_priority(ticket: TicketToSort) -> tuple[int, int]:
+        item_type_priority = {"Special Serenade": 0, "Serenade": 1}.get(ticket.item_type, 2)
+        return item_type_priority, ticket.num_periods_available
+
+    def add_visit(self, group_name: str, period: PeriodType, clean_name: str):
+        group_names = self.visits.setdefault((period, clean_name), [])
+        if group_name not in group_names:
+            group_names.append(group_name)
+
+    def place_ticket(self, ticket: TicketToSort):
+        if ticket.item_type == "Special Serenade":
+            classroom = ticket.classrooms[ticket.ss_period - 1]
+            periods = (ticket.ss_period,) if classroom.is_valid or classroom.is_bad else ()
+        else:
+            periods = ticket.available_periods
+
+        if ticket.item_type in ("Serenade", "Special Serenade"):
+            visiting_groups = new_visit_groups = self.serenading_groups
+        else:
+            # non-serenades can join any visit, but only start new visits in non-serenading groups
+            visiting_groups = self.serenading_groups + self.non_serenading_groups
+            new_visit_groups = self.non_serenading_groups or self.serenading_groups
+        recipient_periods = self.recipient_periods.setdefault(ticket.recipient_id, [0, 0, 0, 0])
+
+        # (tickets of the recipient in the period, load of the group, period, group)
+        options = [
+            (recipient_periods[period - 1], self.loads[group_name], period, group_name)
+            for period in periods
+            for group_name in self.visits.get((period, ticket.classrooms[period - 1].clean_name), ())
+            if group_name in visiting_groups
+        ]
+        if not options and periods and new_visit_groups:
+            group_name = min(new_visit_groups, key=lambda name: self.loads[name])
+            period = min(periods, key=lambda period_: recipient_periods[period_ - 1])
+            options.append((recipient_periods[period - 1], self.loads[group_name], period, group_name))
+
+        if not options:
+            for classroom in ticket.classrooms:
+                classroom.tickets.discard(ticket)
+            ticket.set_available(0)
+            self.undelivered_tickets.append(ticket)
+            return
+
+        _, _, period, group_name = min(options)
+        ticket.choose_period(period)
+        self.add_visit(group_name, period, ticket.chosen_classroom.clean_name)
+        self.loads[group_name] += 1
+        recipient_periods[period - 1] += 1
+        self.output[group_name].append(ticket)
+
+
+"""Command Line Interface"""
+
+
+def load_people(path: str) -> dict[str, dict[str, str]]:
+    """Reads a people CSV (with the columns ID, P1, P2, P3 and P4) into a dictionary of people by ID"""
+    with open(path, newline="") as file:
+        return {row["ID"]: row for row in csv.DictReader(file)}
+
+
+def load_ticket_records(path: str, people: dict[str, dict[str, str]]) -> list[TicketRecord]:
+    """
+    Reads tickets from a JSON list, either exported from the website (python manage.py dumpdata ticketing.ticket)
+    or as plain objects with the keys pk, recipient_id, item_type and ss_period.
+    """
+    with open(path) as file:
+        data = json.load(file)
+
+    records = []
+    for ticket in data:
+        fields = ticket.get("fields", ticket)
+        person = people[fields["recipient_id"]]
+        records.append(TicketRecord(
+            ticket["pk"], fields["recipient_id"], fields["item_type"],
+            person["P1"], person["P2"], person["P3"], person["P4"],
+            fields.get("ss_period")
+        ))
+    return records
+
+
+def write_assignments(assignments: list[Assignment], path: str):
+    """Writes the assignments as JSON if the path ends with .json, otherwise as CSV"""
+    if path.endswith(".json"):
+        with open(path, "w") as file:
+            json.dump([assignment.to_json() for assignment in assignments], file, indent=2)
+    else:
+        with open(path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=(*Assignment._fields, "sort_order"))
+            writer.writeheader()
+            writer.writerows(assignment.to_json() for assignment in assignments)
+
+
+def load_tickets(people_path: str = DEV_PEOPLE, tickets_path: str = DEV_TICKETS) -> TicketList:
+    return TicketList(TicketToSort(*record) for record in load_ticket_records(tickets_path, load_people(people_path)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sorts tickets into delivery groups without the website (by default, the 2023 tickets in dev/)")
+    parser.add_argument("--people", default=DEV_PEOPLE, help="CSV of everyone's timetable")
+    parser.add_argument("--tickets", default=DEV_TICKETS, help="JSON list of the tickets to sort")
+    parser.add_argument("-o", "--output", help="file to write the assignments to (.json or .csv)")
+    parser.add_argument("--serenading-groups", type=int, default=10)
+    parser.add_argument("--non-serenading-groups", type=int, default=10)
+    parser.add_argument("--max-serenades-per-class", type=int, default=2)
+    parser.add_argument("--max-non-serenades-per-serenading-class", type=int, default=3)
+    parser.add_argument("--no-extra-special-serenades", action="store_true")
+    parser.add_argument("--no-enforce-distribution", action="store_true")
+    parser.add_argument("--engine", choices=("full", "numpy", "preview"), default="full")
+    parser.add_argument("--starts", type=int, default=1, help="number of random starts")
+    parser.add_argument("--time-budget", type=float, help="seconds to stop starting new random starts after")
+    parser.add_argument("--improve", type=float, default=0, help="seconds to improve the sort for")
+    parser.add_argument("--optimise", type=float, default=0, help="seconds to run the exact optimiser for")
+    parser.add_argument("--split-components", action="store_true")
+    parser.add_argument("--seed", type=int, default=56)
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    records = load_ticket_records(args.tickets, load_people(args.people))
     loaded_time = datetime.now()
 
-    ticket_sorter = TicketSorter(
-        tickets, 10, 10,
-        max_serenades_per_class=2,
-        max_non_serenades_per_serenading_class=3,
-        extra_special_serenades=True,
-        enforce_distribution=True
+    assignments, report, profile = sort_records(
+        records, args.serenading_groups, args.non_serenading_groups,
+        max_serenades_per_class=args.max_serenades_per_class,
+        max_non_serenades_per_serenading_class=args.max_non_serenades_per_serenading_class,
+        extra_special_serenades=not args.no_extra_special_serenades,
+        enforce_distribution=not args.no_enforce_distribution,
+        improve_time_budget=args.improve,
+        optimise_time_limit=args.optimise,
+        split_components=args.split_components,
+        measure_memory=True,
+        num_starts=args.starts,
+        time_budget=args.time_budget,
+        engine=args.engine,
+        seed=args.seed,
+        use_cache=False
     )
-
     end_time = datetime.now()
 
-    print(f"Done! Loading: {loaded_time - start_time} Sorting: {end_time - loaded_time}")
+    print(report)
+    print(f"\n{profile}")
+    print(f"\nDone! Loading: {loaded_time - start_time} Sorting: {end_time - loaded_time}")
+
+    if args.output:
+        write_assignments(assignments, args.output)
+        print(f"Wrote {len(assignments)} assignments to {args.output}")
 
 
 if __name__ == "__main__":
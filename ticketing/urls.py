@@ -21,6 +21,8 @@ urlpatterns = [
     path('api/redeem/', views.ApiRedeem.as_view(), name='api_redeem'),
     path('api/validate_code/', views.ApiRedeem.as_view(), name='api_validate_code'),
     path('api/print/', views.ApiPrintTicket.as_view(), name='api_print'),
+    path('api/print_status/<int:pk>', views.ApiPrintStatus.as_view(), name='api_print_status'),
+    path('api/sort_status/<int:pk>', views.ApiSortStatus.as_view(), name='api_sort_status'),
     path('api/count', views.ApiCount.as_view(), name='api_count'),
     path('api/graph', views.ApiGraph.as_view(), name='api_graph'),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
@@ -1,4 +1,5 @@
 from django.http import HttpResponseRedirect, FileResponse
+from django.db import transaction
 from django.shortcuts import render
 from django.contrib.admin.views.decorators import staff_member_required
 from django.urls import reverse
@@ -8,14 +9,13 @@ from rest_framework.authentication import SessionAuthentication
 from rest_framework.permissions import IsAdminUser
 from rest_framework.request import Request
 from rest_framework.response import Response
-from vdaywebsite.settings import CONTACT_EMAIL, NUM_TICKETS_PER_PDF
-from .models import Ticket, TicketCode, SortTicketsRequest
+from vdaywebsite.settings import CONTACT_EMAIL
+from .models import Ticket, TicketCode, SortTicketsRequest, PrintJob
 from .forms import CSVFileForm
 from .input_validation import is_code_exists, is_code_unconsumed, is_recipient_exists
 from .constants import DirectoryLocations, FileNames, STUDENTS, TEMPLATES, STUDENTS_LIST, FONTS
-from .ticket_printer import TicketsToPDF
+from .printing import queue_parts, start_print_workers
 from .timetable_parser import get_student_classes
-import os
 import re
 import csv
 import json
@@ -142,16 +142,32 @@ def page_tickets(request, pk):
     for group in sort_tickets_request.deliverygroup_set.all():
         group_data[group.code] = {}
         group_data[group.code]["num_tickets"] = group.tickets.count()
+        group_data[group.code]["num_parts"] = group.num_parts
         group_data[group.code]["parts"] = group.parts_printed
+    print_jobs = get_print_jobs(pk)
 
     return render(request, 'ticketing/tickets.html', {
         'pk': pk,
-        'num_tickets_per_pdf': NUM_TICKETS_PER_PDF,
         'date': sort_tickets_request.date,
-        'group_data': json.dumps(group_data)
+        'status': sort_tickets_request.status,
+        'group_data': json.dumps(group_data),
+        'print_jobs': json.dumps(print_jobs),
+        'report': sort_tickets_request.report
     })
 
 
+def get_print_jobs(pk: int) -> dict[str, dict[int, dict]]:
+    """The status of each part in the print queue, by group code then part"""
+    print_jobs = {}
+    for print_job in PrintJob.objects.filter(delivery_group__sort_request=pk).select_related('delivery_group'):
+        print_jobs.setdefault(print_job.delivery_group.code, {})[print_job.part] = {
+            "status": print_job.status,
+            "attempts": print_job.attempts,
+            "error": print_job.error,
+        }
+    return print_jobs
+
+
 @staff_member_required
 def file_delivery_group(request, pk, group_id, part):
     return FileResponse(open(f'{DirectoryLocations.SORTED_TICKETS}/{pk}/{group_id}_{part}.pdf', 'rb'))
@@ -218,11 +234,14 @@ class ApiRedeem(APIView):
         )
         if ticket.item_type == "Special Serenade":
             ticket.ss_period = data['period']
-        ticket.save()
+        # The print worker renders the message ahead of printing (see claim_next_message),
+        # so it mustn't see the ticket before its file exists
+        with transaction.atomic():
+            ticket.save()
 
-        # Create the ticket file
-        with open(f'{DirectoryLocations.REDEEMED_TICKETS}/{ticket.pk}.svg', 'wb') as file:
-            file.write(bytes(data['message'], 'utf-8'))
+            # Create the ticket file
+            with open(f'{DirectoryLocations.REDEEMED_TICKETS}/{ticket.pk}.svg', 'wb') as file:
+                file.write(bytes(data['message'], 'utf-8'))
 
         # Mark the ticket code as consumed
         ticket_code.is_unconsumed = False
@@ -232,32 +251,55 @@ class ApiRedeem(APIView):
         return Response(data={"success": "true"}, status=status.HTTP_200_OK)
 
 
+class ApiSortStatus(APIView):
+    authentication_classes = [SessionAuthentication]
+    permission_classes = [IsAdminUser]
+
+    @staticmethod
+    def get(request: Request, pk: int):
+        """
+        Endpoint for the tickets page to check on a sort running in the background
+        """
+        sort_tickets_request = SortTicketsRequest.objects.get(pk=pk)
+        progress = sort_tickets_request.progress
+        data = {
+            'status': sort_tickets_request.status,
+            'status_display': sort_tickets_request.get_status_display(),
+            'phase': progress[-1] if progress else None,
+            'phases': progress,
+            'error': sort_tickets_request.error,
+        }
+        return Response(data=data, status=status.HTTP_200_OK)
+
+
 class ApiPrintTicket(APIView):
     authentication_classes = [SessionAuthentication]
     permission_classes = [IsAdminUser]
 
     @staticmethod
     def post(request: Request):
-        pk = request.data['pk']
-        group_code = request.data['group']
-        part = int(request.data['part'])
+        """
+        Endpoint to add parts of delivery groups to the print queue (printed in the background)
+        """
+        sort_tickets_request = SortTicketsRequest.objects.get(pk=request.data['pk'])
         padding = int(request.data['padding'])
         enforce_boundaries = request.data['boundary'] == "true"
 
-        group = SortTicketsRequest.objects.get(pk=pk).deliverygroup_set.get(code=group_code)
+        parts = [(sort_tickets_request.deliverygroup_set.get(code=part['group']), int(part['part']))
+                 for part in request.data['parts']]
+        queue_parts(parts, padding=padding, enforce_boundaries=enforce_boundaries)
+        start_print_workers()
 
-        if not os.path.exists(f"{DirectoryLocations().SORTED_TICKETS}/{pk}"):
-            os.mkdir(f"{DirectoryLocations().SORTED_TICKETS}/{pk}")
+        return Response(data={"success": "true"}, status=status.HTTP_200_OK)
 
-        TicketsToPDF(group.tickets.all()[(part - 1) * NUM_TICKETS_PER_PDF:
-                                         min(part * NUM_TICKETS_PER_PDF, group.tickets.count())],
-                     f"{DirectoryLocations().SORTED_TICKETS}/{pk}/{group_code}_{part}.pdf",
-                     group_code,
-                     starting_index=(part - 1) * NUM_TICKETS_PER_PDF,
-                     padding=padding,
-                     enforce_boundaries=enforce_boundaries)
 
-        group.parts_printed.append(part)
-        group.save()
+class ApiPrintStatus(APIView):
+    authentication_classes = [SessionAuthentication]
+    permission_classes = [IsAdminUser]
 
-        return Response(data={"success": "true"}, status=status.HTTP_200_OK)
+    @staticmethod
+    def get(request: Request, pk: int):
+        """
+        Endpoint for the tickets page to check on the parts being printed
+        """
+        return Response(data=get_print_jobs(pk), status=status.HTTP_200_OK)
\ No newline at end of file
@@ -0,0 +1,43 @@
+"""Keeps track of which rows the background workers (sorting.py and printing.py) are still working on"""
+from django.db import connection, DatabaseError
+from django.db.models import Q, QuerySet
+from django.utils import timezone
+from datetime import timedelta
+import threading
+import contextlib
+
+# How often a worker marks the row it's working on as still being worked on (seconds)
+HEARTBEAT_INTERVAL = 10
+# Rows which haven't been marked for this long were left by a worker which died (seconds)
+STALE_AFTER = 60
+
+
+def is_stale() -> Q:
+    """Matches rows whose worker hasn't marked them for STALE_AFTER seconds (or never has)"""
+    return Q(heartbeat__lt=timezone.now() - timedelta(seconds=STALE_AFTER)) | Q(heartbeat=None)
+
+
+@contextlib.contextmanager
+def heartbeat(rows: QuerySet):
+    """Sets the heartbeat of the rows to now every HEARTBEAT_INTERVAL seconds (in a thread) until the block exits"""
+    stopped = threading.Event()
+
+    def beat():
+        try:
+            while not stopped.wait(HEARTBEAT_INTERVAL):
+                try:
+                    rows.update(heartbeat=timezone.now())
+                except DatabaseError:
+                    # e.g. SQLite is locked while the worker saves its result. Try again next time
+                    pass
+        finally:
+            # the thread has its own database connection
+            connection.close()
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
@@ -38,6 +38,7 @@ DATA_UPLOAD_MAX_MEMORY_SIZE = 5242880
 
 CONTACT_EMAIL = os.getenv("CONTACT_EMAIL")
 ORG_NAME = os.getenv("ORG_NAME")
+PRINT_WORKERS = int(os.getenv("PRINT_WORKERS") or os.cpu_count() or 1)    # processes printing PDFs at once
 
 # Global Constants
 